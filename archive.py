@@ -0,0 +1,300 @@
+import os
+import io
+import json
+import fnmatch
+import tarfile
+import collections
+from concurrent.futures import ThreadPoolExecutor
+import compress
+import fileindex
+
+'''
+Indexed tar archive of the Wordpress site folder
+
+The tar stream is cut in blocks of at least BLOCK_SIZE bytes, always between
+two members. Each block is made of independent gzip members, zstd or lz4
+frames, compressed by a pool of threads, so that a block can be decompressed
+without the blocks before it. Put end to end, the blocks are still a valid
+compressed tar, read by tar, zcat or a sequential restore.
+
+The index wordpress.site.tar.index.json, stored next to the archive, gives the
+offset and size of each block in the compressed archive and the block of each
+member :
+
+    {"version": 1, "blocks": [[offset, size], ...], "members": [[name, block], ...]}
+
+A member is restored by reading and decompressing its block only. The .bin
+files are made of frames of a fixed size (see encrypt.py), so the frames
+holding a block are read without the rest of the file.
+
+Hard links are stored as regular files so that each block can be extracted
+without the others.
+'''
+
+BLOCK_SIZE = 4 * 1024 * 1024
+# Consecutive blocks are read with a single request, up to this size
+RUN_SIZE = 64 * 1024 * 1024
+DEFAULT_WORKERS = 4
+BUFFER_SIZE = 1024 * 1024
+
+
+def _compress_block(data, codec, level):
+    output = io.BytesIO()
+    writer = compress.open_writer(codec, output, level, 1)
+    writer.write(data)
+    writer.close()
+    return output.getvalue()
+
+
+class _BlockWriter:
+    '''
+    File object receiving the tar stream and writing it compressed to fout
+    The data is compressed by parts of block_size bytes in a pool of threads,
+    end_member() ends the current block once it holds block_size bytes
+    '''
+    def __init__(self, fout, codec, level, workers, block_size):
+        self.fout = fout
+        self.codec = codec
+        self.level = level
+        self.workers = workers or os.cpu_count() or 1
+        self.block_size = block_size
+        self.pool = ThreadPoolExecutor(self.workers)
+        self.pending = collections.deque()
+        self.buffer = bytearray()
+        self.position = 0
+        # Index and uncompressed size of the current block
+        self.block = 0
+        self.block_data = 0
+        # Offset and size of each compressed block
+        self.blocks = []
+        self.offset = 0
+
+    def _submit(self, data):
+        self.pending.append((self.block, self.pool.submit(_compress_block, data, self.codec, self.level)))
+        # Keep a bounded number of parts in memory
+        while len(self.pending) > 2 * self.workers:
+            self._write_next()
+
+    def _write_next(self):
+        block, future = self.pending.popleft()
+        data = future.result()
+        self.fout.write(data)
+        if block == len(self.blocks):
+            self.blocks.append([self.offset, 0])
+        self.blocks[block][1] += len(data)
+        self.offset += len(data)
+
+    def write(self, data):
+        self.buffer += data
+        self.position += len(data)
+        self.block_data += len(data)
+        while len(self.buffer) >= self.block_size:
+            self._submit(bytes(self.buffer[:self.block_size]))
+            del self.buffer[:self.block_size]
+        return len(data)
+
+    def tell(self):
+        return self.position
+
+    def end_member(self):
+        if self.block_data >= self.block_size:
+            self._end_block()
+
+    def _end_block(self):
+        if self.buffer:
+            self._submit(bytes(self.buffer))
+            self.buffer = bytearray()
+        self.block += 1
+        self.block_data = 0
+
+    def close(self):
+        if self.block_data:
+            self._end_block()
+        while self.pending:
+            self._write_next()
+        self.pool.shutdown()
+
+
+def _walk(path):
+    '''
+    Yield path and, for a folder, everything under it in the order of tar
+    '''
+    yield path
+    if os.path.isdir(path) and not os.path.islink(path):
+        for name in sorted(os.listdir(path)):
+            yield from _walk(os.path.join(path, name))
+
+
+def write_archive(fout, paths, codec=compress.DEFAULT_CODEC, level=None, workers=None, recursive=True, block_size=BLOCK_SIZE, files=None, limiter=None):
+    '''
+    Write to fout an indexed tar archive of paths compressed with codec and return its index
+        - recursive: if False, the content of the folders of paths is not added
+        - level, workers: compression level and number of compression threads
+        - files: optional, list to which [name, size, modification time, hash, block]
+          of each regular file is added, the hash being the one of fileindex.file_hash
+        - limiter: optional, pipeline.RateLimiter of the read of the files
+    '''
+    writer = _BlockWriter(fout, codec, level, workers, block_size)
+    members = []
+    tar = tarfile.open(fileobj=writer, mode="w")
+    for path in paths:
+        for member in _walk(path) if recursive else [path]:
+            block = writer.block
+            try:
+                tarinfo = tar.gettarinfo(member)
+                if tarinfo is None:
+                    # Sockets are not saved
+                    continue
+                if tarinfo.isreg():
+                    # The file is hashed while it is read
+                    with open(member, "rb") as f:
+                        reader = fileindex.HashReader(f, limiter)
+                        tar.addfile(tarinfo, reader)
+                    if files is not None:
+                        files.append([tarinfo.name, tarinfo.size, int(tarinfo.mtime), reader.hexdigest(), block])
+                else:
+                    tar.addfile(tarinfo)
+            except FileNotFoundError:
+                # Deleted since the walk
+                continue
+            # No hard link to a member of another block
+            tar.inodes.clear()
+            members.append([member.lstrip("/"), block])
+            writer.end_member()
+    tar.close()
+    writer.close()
+    return {"version": 1, "blocks": writer.blocks, "members": members}
+
+
+def write_index(index, path, codec=compress.DEFAULT_CODEC):
+    with open(path, "wb") as f:
+        compressor = compress.open_writer(codec, f)
+        compressor.write(json.dumps(index).encode())
+        compressor.close()
+
+
+def read_index(path, codec=compress.DEFAULT_CODEC):
+    with open(path, "rb") as f:
+        return json.loads(compress.open_reader(codec, f).read())
+
+
+def selector(include=None, exclude=None, root="/"):
+    '''
+    Return a function telling if a path is selected by the glob patterns of
+    include and exclude, or None if there is no pattern
+    The patterns are matched against the paths relative to the folder root, a
+    pattern matching a folder selects everything under it
+    '''
+    if not include and not exclude:
+        return None
+    prefix = root.strip("/") + "/"
+    include = [pattern.strip("/") for pattern in include or []]
+    exclude = [pattern.strip("/") for pattern in exclude or []]
+
+    def matches(path, patterns):
+        while path:
+            if any(fnmatch.fnmatchcase(path, pattern) for pattern in patterns):
+                return True
+            path = os.path.dirname(path)
+        return False
+
+    def select(path):
+        path = path.strip("/")
+        if (path + "/").startswith(prefix):
+            path = path[len(prefix):]
+        return (not include or matches(path, include)) and not matches(path, exclude)
+    return select
+
+
+class _Slice:
+    '''
+    File object returning the next size bytes of fileobj
+    '''
+    def __init__(self, fileobj, size):
+        self.fileobj = fileobj
+        self.size = size
+
+    def read(self, size=-1):
+        if size < 0 or size > self.size:
+            size = self.size
+        data = self.fileobj.read(size) if size else b""
+        self.size -= len(data)
+        return data
+
+    def readable(self):
+        return True
+
+    def close(self):
+        pass
+
+
+def _extract_block(fin, codec, dest, names, folders):
+    '''
+    Extract in dest the members of names read from the compressed block fin
+    Folders are created without their attributes, they are added to folders
+    '''
+    def members(tar):
+        for tarinfo in tar:
+            if tarinfo.name not in names:
+                continue
+            if tarinfo.isdir():
+                os.makedirs(os.path.join(dest, tarinfo.name), exist_ok=True)
+                folders.append(tarinfo)
+            else:
+                yield tarinfo
+    tar = tarfile.open(fileobj=compress.open_reader(codec, fin), mode="r|")
+    tar.extractall(dest, members=members(tar))
+    tar.close()
+    # The end of the block is read so that the next block starts at its offset
+    while fin.read(BUFFER_SIZE):
+        pass
+
+
+def extract_archive(index, read_range, dest="/", select=None, workers=DEFAULT_WORKERS, codec=compress.DEFAULT_CODEC):
+    '''
+    Extract in dest the members of the indexed archive selected by select, or all its members
+        - index: index of the archive
+        - read_range: function called with an offset, a size and a consumer, calling
+          consumer with a file object returning these bytes of the compressed archive
+        - workers: number of runs of consecutive blocks extracted at the same time
+    Return the number of members extracted
+    '''
+    selected = collections.defaultdict(set)
+    for name, block in index["members"]:
+        if select is None or select(name):
+            selected[block].add(name)
+    # Upper folders are created first, the blocks are extracted in any order
+    for names in selected.values():
+        for name in names:
+            os.makedirs(os.path.join(dest, os.path.dirname(name)), exist_ok=True)
+
+    runs = []
+    for block in sorted(selected):
+        offset, size = index["blocks"][block]
+        if runs and runs[-1][-1] == block - 1 and offset + size - index["blocks"][runs[-1][0]][0] <= RUN_SIZE:
+            runs[-1].append(block)
+        else:
+            runs.append([block])
+
+    folders = []
+
+    def extractRun(run):
+        def consumer(fin):
+            for block in run:
+                _extract_block(_Slice(fin, index["blocks"][block][1]), codec, dest, selected[block], folders)
+        first = index["blocks"][run[0]]
+        last = index["blocks"][run[-1]]
+        read_range(first[0], last[0] + last[1] - first[0], consumer)
+
+    with ThreadPoolExecutor(max(1, workers)) as pool:
+        list(pool.map(extractRun, runs))
+
+    # Folders last, their modification time changes while files are created
+    for tarinfo in sorted(folders, key=lambda tarinfo: tarinfo.name, reverse=True):
+        fullpath = os.path.join(dest, tarinfo.name)
+        # Like tar, the owner is only restored when running as root
+        if os.geteuid() == 0:
+            os.chown(fullpath, tarinfo.uid, tarinfo.gid)
+        os.chmod(fullpath, tarinfo.mode)
+        os.utime(fullpath, (tarinfo.mtime, tarinfo.mtime))
+    return sum(len(names) for names in selected.values())
@@ -0,0 +1,321 @@
+#!/usr/bin/python3
+
+###########################################################
+#
+# This python script is used to backup several Wordpress websites of the same server
+# with backup-wp.py, several sites at the same time.
+# The configuration file has the sections of backup-wp.conf shared by all the sites,
+# a section SITES and a section "SITE name" per site
+#
+# Written by : Imane AMIRAT
+# Created date: Sept 30, 2021
+# Last modified: Oct 22, 2021
+# Tested with : Python 3.8
+# Script Revision: 0.9
+#
+##########################################################
+
+# Import required python libraries
+
+import os
+import sys
+import json
+import time
+import ftplib
+import argparse
+import configparser
+import subprocess
+import tools
+import dedup
+from concurrent.futures import ThreadPoolExecutor
+
+'''
+1) Write the configuration of each site in its own LOCALBKPATH/name folder : the shared
+   sections, with the values of the section of the site. LOCALBKPATH and FTP_PATH are
+   sub folders named after the site. The rates, FTP sessions and compression threads
+   of the server are divided between the sites backed up at the same time. The sites
+   backed up with SITE_BACKUP=dedup share the chunk store LOCALBKPATH/chunks and its
+   copy on BACKUP_DEST, unless they have their own KEYPATH or CODEC
+2) Run backup-wp.py for each site, CONCURRENCY sites at the same time, the biggest
+   sites first so that the last ones to start are the shortest
+3) Send a single mail with the result of each site, and write the report of the
+   whole run in LOCALBKPATH/sites-report.json
+'''
+
+SCRIPT_PATH = os.path.dirname(os.path.abspath(__file__))
+SITE_PREFIX = "SITE "
+
+# create parser
+parser = argparse.ArgumentParser()
+
+# add arguments to the parser
+parser.add_argument("-v","--verbose",type=int,default=0,choices=[0,1,2],help="0 disable verbose, 1 minimal verbose, 2 debug mode")
+parser.add_argument("-f","--config",default="/etc/backup-wp.conf",help="Configuration file, /etc/backup-wp.conf by default")
+parser.add_argument("--site",action='append',metavar="NAME",help="Backup only the site NAME. Can be repeated")
+parser.add_argument("-s","--stream",action='store_true',help="Run backup-wp.py with --stream")
+parser.add_argument("--no-local",action='store_true',help="Run backup-wp.py with --stream --no-local")
+parser.add_argument("--resume",action='store_true',help="Run backup-wp.py with --resume, for the sites whose copy was interrupted")
+parser.add_argument("--binlog",action='store_true',help="Run backup-wp.py with --binlog")
+
+# parse the arguments
+args = parser.parse_args()
+
+VERBOSE = args.verbose
+CONFIG_FILE = args.config
+OPTIONS = (["-s"] if args.stream or args.no_local else []) + (["--no-local"] if args.no_local else []) + (["--resume"] if args.resume else []) + (["--binlog"] if args.binlog else [])
+
+config = configparser.ConfigParser()
+# Names of the parameters are kept as written
+config.optionxform = str
+config.read(CONFIG_FILE)
+
+SMTP_HOST = config.get('SMTP','SMTP_HOST')
+SMTP_FROM = config.get('SMTP','SMTP_FROM')
+SMTP_TO = config.get('SMTP','SMTP_TO')
+
+BACKUP_DEST = config.get('BACKUP','BACKUP_DEST')
+BACKUP_ROOT_PATH = config.get('BACKUP','LOCALBKPATH')
+
+# Number of sites backed up at the same time
+CONCURRENCY = config.getint('SITES','CONCURRENCY',fallback=4)
+
+# Chunk store shared by the sites, and its copy : FTP folder relative to FTP_PATH, S3 bucket
+CHUNK_STORE = config.get('BACKUP','CHUNK_STORE',fallback=BACKUP_ROOT_PATH + "/" + dedup.REMOTE_FOLDER)
+CHUNK_FTP_PATH = config.get('BACKUP','CHUNK_FTP_PATH',fallback=dedup.REMOTE_FOLDER)
+CHUNK_S3_BUCKET = config.get('BACKUP','CHUNK_S3_BUCKET',fallback=config.get('BACKUP','S3_BUCKET',fallback=None))
+
+TODAY = time.strftime('%Y%m%d')
+
+def fail(message):
+    if VERBOSE >= 1:
+        print(message + ". Exiting")
+    MESSAGE="""Backup failed
+    """ + message + ". Exiting"
+    tools.sendmail(mailfrom=SMTP_FROM,mailto=SMTP_TO,message=MESSAGE,subject="Backup of Wordpress sites", smtphost=SMTP_HOST)
+    exit(1)
+
+SITES = [section[len(SITE_PREFIX):] for section in config.sections() if section.startswith(SITE_PREFIX)]
+if args.site:
+    for name in args.site:
+        if name not in SITES:
+            fail("No section \"" + SITE_PREFIX + name + "\" in " + CONFIG_FILE)
+    SITES = [name for name in SITES if name in args.site]
+if not SITES:
+    fail("No section \"" + SITE_PREFIX + "name\" in " + CONFIG_FILE)
+if CONCURRENCY < 1:
+    fail("Bad value in " + CONFIG_FILE + ". Value of CONCURRENCY should be 1 or more")
+CONCURRENCY = min(CONCURRENCY, len(SITES))
+
+# Part 1 : Configuration of each site
+
+# Budgets of the server, divided between the sites backed up at the same time : [section, parameter, default, type]
+SHARED_BUDGETS = [["THROTTLE", "DISK_READ_RATE", 0, float], ["THROTTLE", "NETWORK_RATE", 0, float],
+                  ["DB", "DB_DUMP_RATE", 0, float], ["BACKUP", "FTP_SESSIONS", 4, int],
+                  ["COMPRESS", "WORKERS", os.cpu_count(), int]]
+
+def siteSection(key):
+    '''
+    Return the section of the configuration of backup-wp.py of a parameter of a site section
+    '''
+    if key == "WP_PATH":
+        return "WP"
+    if key.startswith("DB_"):
+        return "DB"
+    for section in config.sections():
+        if not section.startswith(SITE_PREFIX) and section != "SITES" and config.has_option(section, key):
+            return section
+    return "BACKUP"
+
+def siteConfig(name):
+    '''
+    Return the configuration of backup-wp.py for the site name
+    '''
+    site = configparser.ConfigParser()
+    site.optionxform = str
+    for section in config.sections():
+        if not section.startswith(SITE_PREFIX) and section != "SITES":
+            site[section] = dict(config[section])
+    for section in ["WP", "DB", "BACKUP", "REPORT"]:
+        if not site.has_section(section):
+            site.add_section(section)
+    site.set("BACKUP", "LOCALBKPATH", BACKUP_ROOT_PATH + "/" + name)
+    if BACKUP_DEST == 'FTP':
+        site.set("BACKUP", "FTP_PATH", config.get('BACKUP','FTP_PATH') + "/" + name)
+    # One file of report per site, and the name of the site in the metrics
+    for key in ["JSON_FILE", "PROMETHEUS_FILE"]:
+        if config.has_option("REPORT", key):
+            root, extension = os.path.splitext(config.get("REPORT", key))
+            site.set("REPORT", key, root + "-" + name + extension)
+    site.set("REPORT", "SITE", name)
+    # The chunk store is shared only if the chunks are copied to the same place for all the sites
+    if BACKUP_DEST != 'S3' or CHUNK_S3_BUCKET:
+        site.set("BACKUP", "CHUNK_STORE", CHUNK_STORE)
+        if BACKUP_DEST == 'FTP':
+            site.set("BACKUP", "CHUNK_FTP_PATH", "../" + CHUNK_FTP_PATH)
+        elif BACKUP_DEST == 'S3':
+            site.set("BACKUP", "CHUNK_S3_BUCKET", CHUNK_S3_BUCKET)
+    for section, key, default, kind in SHARED_BUDGETS:
+        value = kind(config.get(section, key, fallback=default) or 0)
+        if value:
+            if not site.has_section(section):
+                site.add_section(section)
+            site.set(section, key, str(max(kind(1), kind(value / CONCURRENCY)) if kind is int else value / CONCURRENCY))
+    for key, value in config[SITE_PREFIX + name].items():
+        section = siteSection(key)
+        if not site.has_section(section):
+            site.add_section(section)
+        site.set(section, key, value)
+    # The ids of the chunks depend on the key, and the codec of the chunks is the one of the site
+    if not config.has_option(SITE_PREFIX + name, "CHUNK_STORE") and (
+            site.get("ENCRYPT", "KEYPATH", fallback=None) != config.get("ENCRYPT", "KEYPATH", fallback=None) or
+            site.get("COMPRESS", "CODEC", fallback=None) != config.get("COMPRESS", "CODEC", fallback=None)):
+        for key in ["CHUNK_STORE", "CHUNK_FTP_PATH", "CHUNK_S3_BUCKET"]:
+            site.remove_option("BACKUP", key)
+    for section, key in [("WP", "WP_PATH"), ("DB", "DB_HOST"), ("DB", "DB_NAME")]:
+        if not site.has_option(section, key):
+            raise ValueError(key + " is missing in the section \"" + SITE_PREFIX + name + "\"")
+    return site
+
+def siteSize(site):
+    '''
+    Return the bytes read by the last backup of the site, or the size of its folder if it has no report
+    '''
+    try:
+        with open(site["report"]) as f:
+            last = json.load(f)
+        size = sum(stage["bytes_in"] for stage in last["stages"] if stage["name"] in ["site", "dump"])
+        if size:
+            return size
+    except (OSError, ValueError, KeyError):
+        pass
+    size = 0
+    for root, dirs, files in os.walk(site["wp_path"]):
+        for filename in files:
+            try:
+                size += os.lstat(os.path.join(root, filename)).st_size
+            except OSError:
+                pass
+    return size
+
+RUNS = []
+try:
+    buckets = {}
+    for name in SITES:
+        if BACKUP_ROOT_PATH + "/" + name == CHUNK_STORE:
+            raise ValueError("The name of site " + name + " is the folder of the chunk store")
+        site_config = siteConfig(name)
+        path = site_config.get("BACKUP", "LOCALBKPATH")
+        if BACKUP_DEST == 'S3':
+            # The backups of a site are at the root of its bucket
+            bucket = site_config.get("BACKUP", "S3_BUCKET")
+            if bucket in buckets:
+                raise ValueError("Sites " + buckets[bucket] + " and " + name + " have the same S3_BUCKET, set S3_BUCKET in each site section")
+            buckets[bucket] = name
+        os.makedirs(path, exist_ok=True)
+        # The configuration of the site is kept to run restore-wp.py and catalog-wp.py -f on it
+        site_file = path + "/backup-wp.conf"
+        with open(os.open(site_file, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), "w") as f:
+            site_config.write(f)
+        RUNS.append({"name": name, "config": site_file, "log": path + "/backup.log",
+                     "report": site_config.get("REPORT", "JSON_FILE", fallback=path + "/report.json"),
+                     "wp_path": site_config.get("WP", "WP_PATH")})
+except (ValueError, configparser.Error, OSError) as e:
+    fail("Bad value in " + CONFIG_FILE + ". " + str(e))
+
+if BACKUP_DEST == 'FTP':
+    # Folder of each site in FTP_PATH
+    try:
+        ftpserver = tools.connectftp(config.get('BACKUP','FTP_SERVER'),config.get('BACKUP','FTP_USER'),config.get('BACKUP','FTP_PASSWD'))
+        ftpserver.cwd(config.get('BACKUP','FTP_PATH'))
+        for run in RUNS:
+            try:
+                ftpserver.mkd(run["name"])
+            except ftplib.error_perm:
+                # Already created by a previous run
+                pass
+        tools.closeftp(ftpserver)
+    except ftplib.all_errors as e:
+        fail("Error during creation of the folders of the sites in " + config.get('BACKUP','FTP_PATH') + " : " + str(e))
+
+# Part 2 : Backup of the sites, the biggest first
+
+for run in RUNS:
+    run["size"] = siteSize(run)
+RUNS.sort(key=lambda run: -run["size"])
+
+def backupSite(run):
+    if VERBOSE >= 1:
+        print("Starting backup of site " + run["name"])
+    start = time.monotonic()
+    # Each backup-wp.py prints its mail instead of sending it
+    with open(run["log"], "w") as log:
+        process = subprocess.run([sys.executable, SCRIPT_PATH + "/backup-wp.py", "-f", run["config"], "--no-mail", "-v", str(max(1, VERBOSE))] + OPTIONS,
+                                 stdout=log, stderr=subprocess.STDOUT)
+    run["seconds"] = time.monotonic() - start
+    run["returncode"] = process.returncode
+    try:
+        with open(run["report"]) as f:
+            run_report = json.load(f)
+        # Report of a previous run if this one failed before writing it
+        if run_report.get("date") != TODAY and process.returncode != 0:
+            run_report = None
+    except (OSError, ValueError):
+        run_report = None
+    run["failed_stage"] = run_report["failed_stage"] if run_report else None
+    stages = run_report["stages"] if run_report else []
+    run["bytes_read"] = sum(stage["bytes_in"] for stage in stages if stage["name"] in ["site", "dump"])
+    run["bytes_uploaded"] = sum(stage["bytes_out"] for stage in stages if stage["name"] == "upload")
+    if VERBOSE >= 1:
+        print("Backup of site " + run["name"] + (" completed" if process.returncode == 0 else " failed") + " in " + str(round(run["seconds"], 1)) + " s")
+    return run
+
+START = time.monotonic()
+STARTED = time.time()
+with ThreadPoolExecutor(CONCURRENCY) as executor:
+    list(executor.map(backupSite, RUNS))
+WINDOW = time.monotonic() - START
+
+# Part 3 : Report and mail of the whole run
+
+FAILED = [run for run in RUNS if run["returncode"] != 0]
+TOTAL_READ = sum(run["bytes_read"] for run in RUNS)
+TOTAL_UPLOADED = sum(run["bytes_uploaded"] for run in RUNS)
+
+try:
+    with open(BACKUP_ROOT_PATH + "/sites-report.json.tmp", "w") as f:
+        json.dump({"date": TODAY, "started": int(STARTED), "duration": round(WINDOW, 3), "concurrency": CONCURRENCY,
+                   "status": "failed" if FAILED else "success",
+                   "sites": [{"name": run["name"], "status": "failed" if run["returncode"] else "success", "failed_stage": run["failed_stage"],
+                              "duration": round(run["seconds"], 3), "bytes_read": run["bytes_read"], "bytes_uploaded": run["bytes_uploaded"]} for run in RUNS]}, f, indent=1)
+    os.replace(BACKUP_ROOT_PATH + "/sites-report.json.tmp", BACKUP_ROOT_PATH + "/sites-report.json")
+except OSError as e:
+    if VERBOSE >= 1:
+        print("Error during write of the report : " + str(e))
+
+lines = ["%-24s %8s %9s %11s %11s  %s" % ("Site", "Status", "Seconds", "MB read", "MB uploaded", "Failed stage")]
+for run in RUNS:
+    lines.append("%-24s %8s %9.1f %11.1f %11.1f  %s" % (run["name"], "failed" if run["returncode"] else "ok", run["seconds"],
+                                                       run["bytes_read"] / 1048576, run["bytes_uploaded"] / 1048576, run["failed_stage"] or ""))
+lines.append("%-24s %8s %9.1f %11.1f %11.1f" % ("Total", "", WINDOW, TOTAL_READ / 1048576, TOTAL_UPLOADED / 1048576))
+lines.append("Upload throughput of the run : %.1f MB/s, sum of the durations of the sites : %.1f s" % (TOTAL_UPLOADED / 1048576 / max(WINDOW, 1e-6), sum(run["seconds"] for run in RUNS)))
+
+if FAILED:
+    MESSAGE = "Backup failed for " + str(len(FAILED)) + " of " + str(len(RUNS)) + " sites\n\n" + "\n".join(lines)
+    for run in FAILED:
+        # The end of the output of backup-wp.py gives the error
+        try:
+            with open(run["log"]) as f:
+                tail = f.read().strip().splitlines()[-10:]
+        except OSError:
+            tail = []
+        MESSAGE += "\n\n" + run["name"] + " (" + run["log"] + ") :\n" + "\n".join(tail)
+else:
+    MESSAGE = "Backup completed for " + str(len(RUNS)) + " sites, " + str(CONCURRENCY) + " at the same time\n\n" + "\n".join(lines)
+
+if VERBOSE >= 1:
+    print("")
+    print(MESSAGE)
+
+tools.sendmail(mailfrom=SMTP_FROM,mailto=SMTP_TO,message=MESSAGE,subject="Backup of Wordpress sites of " + TODAY, smtphost=SMTP_HOST)
+if FAILED:
+    exit(1)
@@ -24,6 +24,7 @@
 # Import required python libraries
 
 import os
+import atexit
 import shutil
 import errno
 import time
@@ -31,20 +32,33 @@ import datetime
 import pipes
 import sys
 import configparser
-import tarfile
+import json
 import boto3
 import ftplib
 import tools
 import argparse
 import Crypto
 import encrypt
+import pipeline
+import compress
+import dedup
+import fileindex
+import journal
+import dbdump
+import binlog
+import archive
+import catalog
+import report
+import throttle
+import checksums
+import transfer
 from botocore.config import Config
 
 
 
 
 # By Default, this script will read configuration from file /etc/backup-wp.conf
-# Todo : Add the option -f to read parameters from a specified filename in the command line parameter
+# The option -f reads the configuration from another file
 '''
 Init :
 
@@ -85,13 +99,38 @@ parser = argparse.ArgumentParser()
 
 # add arguments to the parser
 parser.add_argument("-v","--verbose",type=int,default=0,choices=[0,1,2],help="0 disable verbose, 1 minimal verbose, 2 debug mode")
+parser.add_argument("-f","--config",default="/etc/backup-wp.conf",help="Configuration file, /etc/backup-wp.conf by default")
+parser.add_argument("-s","--stream",action='store_true',help="Dump, compress and encrypt directly into the upload to BACKUP_DEST")
+parser.add_argument("--no-local",action='store_true',help="With --stream, do not keep a local copy of the backup files in DAYJ")
+parser.add_argument("--resume",action='store_true',help="Resume the copy to BACKUP_DEST of the last backup, interrupted by an error, without making a new backup")
+parser.add_argument("--binlog",action='store_true',help="Copy the binary logs of MySQL written since the daily backup of DAYJ, without making a new backup")
+parser.add_argument("--bench-codecs",action='store_true',help="Benchmark compression codecs on a sample of WP_PATH and of the database dump then exit")
+parser.add_argument("--bench-size",type=int,default=64,help="Size in MB of each sample used by --bench-codecs")
+parser.add_argument("--no-mail",action='store_true',help="Print the mail of the end of the backup instead of sending it, used by backup-sites-wp.py")
 
 # parse the arguments
 args = parser.parse_args()
 
 VERBOSE = args.verbose
+STREAM = args.stream
+NOLOCAL = args.no_local
+RESUME = args.resume
+BINLOG = args.binlog
+# No new backup is made, files already in DAYJ are copied to BACKUP_DEST
+COPY_ONLY = RESUME or BINLOG
+NOMAIL = args.no_mail
+
+def sendmail(**kwargs):
+    '''
+    Send the mail of the end of the backup with tools.sendmail
+    With --no-mail, the mail is printed instead, for the aggregated mail of backup-sites-wp.py
+    '''
+    if NOMAIL:
+        print(kwargs["subject"] + " : " + kwargs["message"])
+    else:
+        tools.sendmail(**kwargs)
 
-CONFIG_FILE = "/etc/backup-wp.conf"
+CONFIG_FILE = args.config
 
 config = configparser.ConfigParser()
 config.read(CONFIG_FILE)
@@ -99,6 +138,14 @@ config.read(CONFIG_FILE)
 WP_PATH = config.get('WP','WP_PATH')
 DB_HOST = config.get('DB','DB_HOST')
 DB_NAME = config.get('DB','DB_NAME')
+# single (one mysqldump of the database) or tables (one dump per table or part of table, dumped in parallel)
+DB_DUMP = config.get('DB','DB_DUMP',fallback='single')
+DB_DUMP_WORKERS = config.getint('DB','DB_DUMP_WORKERS',fallback=dbdump.DEFAULT_WORKERS)
+DB_DUMP_CHUNK_ROWS = config.getint('DB','DB_DUMP_CHUNK_ROWS',fallback=0)
+# Maximum read rate of the dump in MB/s, 0 for no limit
+DB_DUMP_RATE = config.getfloat('DB','DB_DUMP_RATE',fallback=0)
+# Binary log position recorded with each daily dump for point-in-time recovery
+DB_BINLOG = config.getboolean('DB','DB_BINLOG',fallback=False)
 
 SMTP_HOST = config.get('SMTP','SMTP_HOST')
 SMTP_FROM = config.get('SMTP','SMTP_FROM')
@@ -107,26 +154,125 @@ SMTP_TO = config.get('SMTP','SMTP_TO')
 BACKUP_RETENTION = config.get('BACKUP','BACKUP_RETENTION')
 BACKUP_DEST = config.get('BACKUP','BACKUP_DEST')
 BACKUP_ROOT_PATH = config.get('BACKUP','LOCALBKPATH')
+SITE_BACKUP = config.get('BACKUP','SITE_BACKUP',fallback='tar')
+DIFF_FULL_EVERY = config.getint('BACKUP','DIFF_FULL_EVERY',fallback=int(BACKUP_RETENTION))
+# SITE_BACKUP=dedup only : folder of the chunks, shared by the sites of the host with backup-sites-wp.py
+CHUNK_STORE = config.get('BACKUP','CHUNK_STORE',fallback=BACKUP_ROOT_PATH + "/chunks")
+# S3 only : slots (DAYJ, DAYJ-1... moved at each rotation) or dated (immutable prefixes and an index)
+S3_LAYOUT = config.get('BACKUP','S3_LAYOUT',fallback='slots')
 
 ENCRYPTION_KEYPATH = config.get('ENCRYPT','KEYPATH')
 
+COMPRESS_CODEC = config.get('COMPRESS','CODEC',fallback=compress.DEFAULT_CODEC)
+COMPRESS_LEVEL = config.getint('COMPRESS','LEVEL',fallback=None)
+COMPRESS_WORKERS = config.getint('COMPRESS','WORKERS',fallback=os.cpu_count())
+
+# JSON report of each run, and optional textfile for the textfile collector of Prometheus node_exporter
+REPORT_FILE = config.get('REPORT','JSON_FILE',fallback=BACKUP_ROOT_PATH + "/report.json")
+PROMETHEUS_FILE = config.get('REPORT','PROMETHEUS_FILE',fallback=None)
+# Name of the site in the reports and in the references of the chunk store, set by backup-sites-wp.py
+REPORT_SITE = config.get('REPORT','SITE',fallback=None)
+
+# Throttling so that the backup does not slow down the site : read rate of the files of the site and upload rate in MB/s, 0 for no limit
+DISK_READ_RATE = config.getfloat('THROTTLE','DISK_READ_RATE',fallback=0)
+NETWORK_RATE = config.getfloat('THROTTLE','NETWORK_RATE',fallback=0)
+# CPU and IO priority of the script and of the processes it starts
+NICE = config.getint('THROTTLE','NICE',fallback=0)
+IONICE_CLASS = config.get('THROTTLE','IONICE_CLASS',fallback=None)
+IONICE_LEVEL = config.getint('THROTTLE','IONICE_LEVEL',fallback=None)
+# Adaptive mode : the rates are lowered while the load average per CPU or the iowait percentage is above its threshold, 0 to disable
+LOAD_THRESHOLD = config.getfloat('THROTTLE','LOAD_THRESHOLD',fallback=0)
+IOWAIT_THRESHOLD = config.getfloat('THROTTLE','IOWAIT_THRESHOLD',fallback=0)
+ADAPTIVE_MIN_RATE = config.getfloat('THROTTLE','ADAPTIVE_MIN_RATE',fallback=1)
+ADAPTIVE_INTERVAL = config.getfloat('THROTTLE','ADAPTIVE_INTERVAL',fallback=throttle.DEFAULT_INTERVAL)
+ADAPTIVE = LOAD_THRESHOLD > 0 or IOWAIT_THRESHOLD > 0
+
+if args.bench_codecs:
+    # Benchmark of each available codec on samples of the real data then exit
+    SAMPLES = [("Wordpress site", pipeline.sampleFolder(WP_PATH, args.bench_size * 1048576)),
+               ("MySQL dump", pipeline.sampleMysqldump(DB_HOST, DB_NAME, args.bench_size * 1048576))]
+    for sample_name, sample in SAMPLES:
+        print("")
+        print("Sample of " + sample_name + " : " + str(round(len(sample) / 1048576, 1)) + " MB")
+        print("%-6s %6s %16s %18s %8s" % ("codec", "level", "compress MB/s", "decompress MB/s", "ratio"))
+        for result in compress.benchmark(sample, level=COMPRESS_LEVEL, workers=COMPRESS_WORKERS):
+            print("%-6s %6d %16.1f %18.1f %8.2f" % (result["codec"], result["level"], result["compress_mbps"], result["decompress_mbps"], result["ratio"]))
+    exit(0)
+
+try:
+    compress.check_codec(COMPRESS_CODEC)
+    if SITE_BACKUP not in ['tar','dedup','diff']:
+        raise ValueError("Value of SITE_BACKUP should be tar, dedup or diff only")
+    if S3_LAYOUT not in ['slots','dated']:
+        raise ValueError("Value of S3_LAYOUT should be slots or dated only")
+    if DB_DUMP not in ['single','tables']:
+        raise ValueError("Value of DB_DUMP should be single or tables only")
+    if DB_BINLOG and DB_DUMP != 'single':
+        raise ValueError("DB_BINLOG needs DB_DUMP=single, the parts of DB_DUMP=tables have no common binary log position")
+    if BINLOG and not DB_BINLOG:
+        raise ValueError("--binlog needs DB_BINLOG=yes")
+    if BINLOG and (RESUME or STREAM):
+        raise ValueError("--binlog can not be used with --resume or --stream")
+    if DB_BINLOG and STREAM:
+        raise ValueError("DB_BINLOG can not be used with --stream, the binary log position is only known at the end of the dump")
+    if BACKUP_DEST == 'LOCAL' and (STREAM or NOLOCAL):
+        raise ValueError("--stream and --no-local need BACKUP_DEST=S3 or FTP, with BACKUP_DEST=LOCAL the backups are only kept in the local folders")
+    if IONICE_CLASS and IONICE_CLASS not in throttle.IONICE_CLASSES:
+        raise ValueError("Value of IONICE_CLASS should be " + ", ".join(throttle.IONICE_CLASSES) + " only")
+    if ADAPTIVE and ADAPTIVE_MIN_RATE <= 0:
+        raise ValueError("Value of ADAPTIVE_MIN_RATE should be more than 0")
+except ValueError as e:
+    if VERBOSE >= 1:
+        print("Bad value in " + CONFIG_FILE + ". " + str(e) + ". Exiting")
+    MESSAGE="""Backup failed
+    Bad value in """ +  CONFIG_FILE + ". " + str(e) + ". Exiting"
+    sendmail(mailfrom=SMTP_FROM,mailto=SMTP_TO,message=MESSAGE,subject="Backup of Wordpress", smtphost=SMTP_HOST)
+    exit(1)
+
 
 if BACKUP_DEST == 'S3':
     S3_BUCKET = config.get('BACKUP','S3_BUCKET')
     S3_ACCESS_KEY = config.get('BACKUP','S3_ACCESS_KEY')
     S3_SECRET_ACCESS_KEY = config.get('BACKUP','S3_SECRET_ACCESS_KEY')
     S3_DEFAULT_REGION = config.get('BACKUP','S3_DEFAULT_REGION')
+    # Optional, S3 compatible storage (MinIO, Ceph...)
+    S3_ENDPOINT_URL = config.get('BACKUP','S3_ENDPOINT_URL',fallback=None)
+    # Multipart transfers : size of the parts in MB, threads per file and files transferred at the same time
+    S3_MULTIPART_CHUNKSIZE = config.getint('BACKUP','S3_MULTIPART_CHUNKSIZE',fallback=8)
+    S3_MAX_CONCURRENCY = config.getint('BACKUP','S3_MAX_CONCURRENCY',fallback=10)
+    S3_FILES_IN_FLIGHT = config.getint('BACKUP','S3_FILES_IN_FLIGHT',fallback=3)
+    # Bucket of the chunks of CHUNK_STORE
+    CHUNK_S3_BUCKET = config.get('BACKUP','CHUNK_S3_BUCKET',fallback=S3_BUCKET)
 elif BACKUP_DEST == 'FTP':
     FTP_SERVER = config.get('BACKUP','FTP_SERVER')
     FTP_USER = config.get('BACKUP','FTP_USER')
     FTP_PASSWD = config.get('BACKUP','FTP_PASSWD')
     FTP_ROOT_PATH = config.get('BACKUP','FTP_PATH')
+    # Parallel transfers : number of FTPS sessions, block size in KB and segment size in MB of downloads
+    FTP_SESSIONS = config.getint('BACKUP','FTP_SESSIONS',fallback=4)
+    FTP_BLOCK_SIZE = config.getint('BACKUP','FTP_BLOCK_SIZE',fallback=256) * 1024
+    # Folder of the chunks of CHUNK_STORE, relative to FTP_PATH
+    CHUNK_FTP_PATH = config.get('BACKUP','CHUNK_FTP_PATH',fallback=dedup.REMOTE_FOLDER)
+elif BACKUP_DEST == 'LOCAL':
+    # No copy, the backups are only kept in the local folders
+    pass
 else:
     if VERBOSE >= 1:
-        print("Bad value in " + CONFIG_FILE + ". Value of BACKUP_DEST should be S3 or FTP only. Exiting")
+        print("Bad value in " + CONFIG_FILE + ". Value of BACKUP_DEST should be S3, FTP or LOCAL only. Exiting")
         MESSAGE="""Backup failed
-        Bad value in """ +  CONFIG_FILE + ". Value of BACKUP_DEST should be S3 or FTP only. Exiting"
-        tools.sendmail(mailfrom=SMTP_FROM,mailto=SMTP_TO,message=MESSAGE,subject="Backup of Wordpress", smtphost=SMTP_HOST)
+        Bad value in """ +  CONFIG_FILE + ". Value of BACKUP_DEST should be S3, FTP or LOCAL only. Exiting"
+        sendmail(mailfrom=SMTP_FROM,mailto=SMTP_TO,message=MESSAGE,subject="Backup of Wordpress", smtphost=SMTP_HOST)
+    exit(1)
+
+# The priority is lowered before any thread or process is started, so that they inherit it
+try:
+    throttle.set_priority(NICE,IONICE_CLASS,IONICE_LEVEL)
+except Exception as e:
+    if VERBOSE >= 1:
+        print("Error while lowering the priority of the backup : " + str(e) + ". Exiting")
+    MESSAGE="""Backup failed
+    Error while lowering the priority of the backup : """ + str(e) + ". Exiting"
+    sendmail(mailfrom=SMTP_FROM,mailto=SMTP_TO,message=MESSAGE,subject="Backup of Wordpress", smtphost=SMTP_HOST)
     exit(1)
 
 # Starting process
@@ -155,6 +301,63 @@ for index in range(int(BACKUP_RETENTION)):
 # Check if a backup already occured today
 TODAY = time.strftime('%Y%m%d')
 
+# Duration, bytes and memory of each stage of the run
+REPORT = report.RunReport("binlog" if BINLOG else "resume" if RESUME else "daily", TODAY, REPORT_SITE)
+
+def writeReport():
+    '''
+    Write the report of the run, called at exit so that failed runs are reported too
+    '''
+    if REPORT.status is None:
+        REPORT.finish(False)
+    try:
+        REPORT.write_json(REPORT.path(REPORT_FILE))
+        if PROMETHEUS_FILE:
+            REPORT.write_prometheus(REPORT.path(PROMETHEUS_FILE))
+    except Exception as e:
+        if VERBOSE >= 1:
+            print("Error during write of the report : " + str(e))
+
+atexit.register(writeReport)
+
+# Transfers to BACKUP_DEST in progress, --resume copies again the files of the interrupted backup
+TRANSFER_JOURNAL = journal.TransferJournal(BACKUP_ROOT_PATH + "/" + journal.JOURNAL_FILE,RESUME)
+if RESUME:
+    RESUMED_BACKUP = TRANSFER_JOURNAL.backup()
+    if RESUMED_BACKUP is None:
+        ERROR = "No interrupted backup to resume in " + BACKUP_ROOT_PATH + "/" + journal.JOURNAL_FILE
+    elif RESUMED_BACKUP["stream"] or STREAM:
+        ERROR = "A backup made with --stream can not be resumed"
+    else:
+        ERROR = None
+    if ERROR:
+        if VERBOSE >= 1:
+            print(ERROR + ". Exiting")
+        MESSAGE="""Backup failed
+        """ + ERROR
+        sendmail(mailfrom=SMTP_FROM,mailto=SMTP_TO,message=MESSAGE,subject="Backup of Wordpress", smtphost=SMTP_HOST)
+        exit(1)
+    # Same day and same kind of backup as the interrupted one
+    TODAY = RESUMED_BACKUP["date"]
+    SITE_BACKUP = RESUMED_BACKUP["site_mode"]
+elif BINLOG:
+    # The binary logs are copied next to the daily dump they follow
+    BINLOG_STATE = binlog.read_state(BACKUP_ROOT_PATH)
+    if BINLOG_STATE is None:
+        if VERBOSE >= 1:
+            print("No binary log position in " + BACKUP_ROOT_PATH + "/" + binlog.STATE_FILE + ", a daily backup with DB_BINLOG=yes is needed first. Exiting")
+        MESSAGE="""Backup failed
+        No binary log position in """ + BACKUP_ROOT_PATH + "/" + binlog.STATE_FILE + ", a daily backup with DB_BINLOG=yes is needed first"
+        sendmail(mailfrom=SMTP_FROM,mailto=SMTP_TO,message=MESSAGE,subject="Backup of Wordpress", smtphost=SMTP_HOST)
+        exit(1)
+    TODAY = BINLOG_STATE["date"]
+    # No site backup in this run
+    SITE_BACKUP = None
+else:
+    TRANSFER_JOURNAL.clear_backup()
+REPORT.date = TODAY
+
+REPORT.start("rotation")
 DATEFILE = BACKUP_ROOT_PATH + "/" + "DAYJ" + "/" + "date.txt"
 try:
     os.stat(DATEFILE)
@@ -168,7 +371,7 @@ else:
     datefile = open(DATEFILE,"r")
     DATEINFILE = datefile.readline()
     # Now compare DATEINFILE with TODAY
-    if DATEINFILE == TODAY:
+    if DATEINFILE == TODAY or COPY_ONLY:
         # Backup already occured today, so no ROTATION needed
         BACKUP_ROTATION = False
         if VERBOSE == 2:
@@ -191,7 +394,7 @@ else:
                 print("Error during delete of " + BACKUP_PATH)
             MESSAGE="""Backup failed
             Error during delete of """ + BACKUP_PATH
-            tools.sendmail(mailfrom=SMTP_FROM,mailto=SMTP_TO,message=MESSAGE,subject="Backup of Wordpress", smtphost=SMTP_HOST)
+            sendmail(mailfrom=SMTP_FROM,mailto=SMTP_TO,message=MESSAGE,subject="Backup of Wordpress", smtphost=SMTP_HOST)
             exit(1)
         # Move content of DAYJ-N to DAYJ-(N+1)
         for index in range(int(BACKUP_RETENTION)-2,-1,-1):
@@ -210,7 +413,7 @@ else:
                         print("Error during rename of " + BACKUP_PATH_FROM + " to " + BACKUP_PATH_TO)
                     MESSAGE="""Backup failed
                     Error during rename of """ + BACKUP_PATH_FROM + " to " + BACKUP_PATH_TO
-                    tools.sendmail(mailfrom=SMTP_FROM,mailto=SMTP_TO,message=MESSAGE,subject="Backup of Wordpress of " + TODAY, smtphost=SMTP_HOST)
+                    sendmail(mailfrom=SMTP_FROM,mailto=SMTP_TO,message=MESSAGE,subject="Backup of Wordpress of " + TODAY, smtphost=SMTP_HOST)
                     exit(1)
         # Create DAYJ folder
         BACKUP_PATH = BACKUP_ROOT_PATH + "/DAYJ"
@@ -220,106 +423,553 @@ else:
 
 BACKUP_PATH = BACKUP_ROOT_PATH + "/DAYJ"
 
-# Part1 : Database backup.
-if VERBOSE >=1 :
-    print ("")
-    print ("Starting Backup of MySQL")
+fdKey = open(ENCRYPTION_KEYPATH,'rb')
+ENCRYPTION_KEY = fdKey.read()
 
-dumpcmd = "mysqldump -h " + DB_HOST + " " + DB_NAME + " > " + BACKUP_PATH + "/" + DB_NAME + ".sql"
-try:
-    os.system(dumpcmd)
-except:
+if DB_DUMP == 'tables':
+    localMysqlBackup=BACKUP_PATH + "/" + DB_NAME + ".sql.manifest.json" + compress.extension(COMPRESS_CODEC)
+else:
+    localMysqlBackup=BACKUP_PATH + "/" + DB_NAME + ".sql" + compress.extension(COMPRESS_CODEC)
+if SITE_BACKUP == 'dedup':
+    wp_archive = BACKUP_PATH + "/" + "wordpress.site.manifest.json" + compress.extension(COMPRESS_CODEC)
+else:
+    wp_archive = BACKUP_PATH + "/" + "wordpress.site.tar" + compress.extension(COMPRESS_CODEC)
+METAFILE = BACKUP_PATH + "/" + "backup.json"
+
+# Files of the backup, each one is encrypted to a .bin file and copied to BACKUP_DEST
+BACKUP_FILES = [localMysqlBackup,wp_archive,METAFILE,DATEFILE]
+if SITE_BACKUP == 'diff':
+    wp_deleted = BACKUP_PATH + "/" + "wordpress.site.deleted.json" + compress.extension(COMPRESS_CODEC)
+    BACKUP_FILES.insert(2,wp_deleted)
+# Files written by the stream producers, copied once the other files are uploaded
+LATE_FILES = []
+if SITE_BACKUP in ['tar','diff']:
+    # Index of the blocks and members of the site archive
+    wp_index = BACKUP_PATH + "/" + "wordpress.site.tar.index.json" + compress.extension(COMPRESS_CODEC)
+    if STREAM:
+        LATE_FILES.append(wp_index)
+    else:
+        BACKUP_FILES.insert(2,wp_index)
+# Catalog of the files and tables of the backup, written after the index of a streamed site archive
+catalog_file = BACKUP_PATH + "/" + catalog.CATALOG_FILE + compress.extension(COMPRESS_CODEC)
+if STREAM and SITE_BACKUP in ['tar','diff']:
+    LATE_FILES.append(catalog_file)
+else:
+    BACKUP_FILES.insert(2,catalog_file)
+
+# Throughput of the dumps, shared by all the mysqldump processes, and time during which tables are locked
+# The adaptive mode needs a limiter even without rate, to lower its rate when the system is loaded
+DB_LIMITER = pipeline.RateLimiter(DB_DUMP_RATE * 1048576) if DB_DUMP_RATE or ADAPTIVE else None
+DB_LOCKS = dbdump.LockTimer()
+# Sessions reading the parts of DB_DUMP=tables in the same snapshot
+DB_SNAPSHOT = None
+# Binary log position of the dump
+DB_POSITION = {}
+
+# Throughput of the read of the files of the site and of the uploads to BACKUP_DEST
+DISK_LIMITER = pipeline.RateLimiter(DISK_READ_RATE * 1048576) if DISK_READ_RATE or ADAPTIVE else None
+NETWORK_LIMITER = pipeline.RateLimiter(NETWORK_RATE * 1048576) if NETWORK_RATE or ADAPTIVE else None
+THROTTLE = None
+if ADAPTIVE:
+    THROTTLE = throttle.AdaptiveThrottle([DISK_LIMITER,DB_LIMITER,NETWORK_LIMITER],LOAD_THRESHOLD,IOWAIT_THRESHOLD,ADAPTIVE_MIN_RATE * 1048576,ADAPTIVE_INTERVAL,VERBOSE)
+    THROTTLE.start()
+
+# Regular files added to the site archive, with their hash and block, and number of blocks of the archive
+SITE_FILES = []
+SITE_LAYOUT = {}
+
+def writeCatalog():
+    '''
+    Write to catalog_file the catalog of the files of the site and of the tables of the database
+    '''
+    if SITE_BACKUP == 'dedup':
+        files = catalog.files_from_manifest(manifest)
+        SITE_LAYOUT["chunks"] = len(dedup.referenced_chunks(manifest))
+    elif SITE_BACKUP == 'diff':
+        files = catalog.files_from_index(NEW_INDEX, SITE_FILES)
+    else:
+        files = catalog.files_from_archive(SITE_FILES)
+    parts = len(dbdump.part_files(DB_MANIFEST)) if DB_DUMP == 'tables' else None
+    backup_catalog = catalog.new_catalog(TODAY, COMPRESS_CODEC, SITE_BACKUP, files, SITE_LAYOUT, DB_DUMP, dbdump.table_rows(DB_HOST, DB_NAME),
+                                         parts, SITE_BASE if SITE_BACKUP == 'diff' else None)
+    catalog.write_catalog(backup_catalog, catalog_file, COMPRESS_CODEC)
+
+def writeSiteArchive(fout, paths, recursive=True):
+    '''
+    Write to fout the indexed archive of paths compressed with COMPRESS_CODEC, then its index to wp_index
+    In stream mode, the catalog is written too as it needs the files of the archive
+    '''
+    index = archive.write_archive(fout, paths, COMPRESS_CODEC, COMPRESS_LEVEL, COMPRESS_WORKERS, recursive, files=SITE_FILES, limiter=DISK_LIMITER)
+    REPORT.stage("site").add(bytes_in=sum(file[1] for file in SITE_FILES))
+    archive.write_index(index, wp_index, COMPRESS_CODEC)
+    SITE_LAYOUT["blocks"] = len(index["blocks"])
+    if STREAM:
+        writeCatalog()
+
+def reportUpload(stats):
+    '''
+    Add the bytes of the uploads to the upload stage, and the size of the streamed artifacts to their stage
+    '''
+    for stat in stats:
+        REPORT.stage("upload").add(stat["bytes"],stat["bytes"])
+        file = BACKUP_PATH + "/" + os.path.basename(stat["key"])
+        if file in STREAM_PRODUCERS:
+            REPORT.stage("site" if file == wp_archive + ".bin" else "dump").add(bytes_out=stat["bytes"])
+
+# Checksums of the .bin files of the backup, checked by verify-wp.py
+CHECKSUMS = {}
+checksums_file = BACKUP_PATH + "/" + checksums.CHECKSUMS_FILE
+
+def encryptFile(file):
+    '''
+    Encrypt file to file.bin, computing the checksums of file.bin at the same time
+    '''
+    digest = checksums.Digest()
+    encrypt.encrypt_file(file,ENCRYPTION_KEY,tee=digest)
+    CHECKSUMS[os.path.basename(file) + ".bin"] = digest
+
+def streamDigest(file):
+    '''
+    Return the checksums.Digest of a streamed artifact, a new one at each attempt of its upload
+    '''
+    digest = checksums.Digest(not NOLOCAL)
+    CHECKSUMS[os.path.basename(file)] = digest
+    return digest
+
+def writeChecksums():
+    '''
+    Write and encrypt checksums_file, once all the files of the backup are written
+    A binary log run or a resumed copy adds its files to the checksums of the daily backup
+    '''
+    data = checksums.read_checksums(checksums_file) if COPY_ONLY else {"files": {}, "chunks": {}}
+    data["date"] = TODAY
+    for file in [file + ".bin" for file in BACKUP_FILES + LATE_FILES]:
+        name = os.path.basename(file)
+        if name in CHECKSUMS:
+            data["files"][name] = CHECKSUMS[name].to_dict()
+        elif name not in data["files"] and os.path.exists(file):
+            # Encrypted by the interrupted run of a resumed copy
+            data["files"][name] = checksums.file_digest(file)
+    if not BINLOG and SITE_BACKUP == 'dedup':
+        backup_manifest = dedup.read_backup_manifest(BACKUP_PATH,ENCRYPTION_KEY)
+        if backup_manifest:
+            data["chunks"] = {chunk_id: os.path.getsize(store.chunk_path(chunk_id)) for chunk_id in dedup.referenced_chunks(backup_manifest)}
+    checksums.write_checksums(data,checksums_file)
+    encrypt.encrypt_file(checksums_file,ENCRYPTION_KEY)
+
+# Prefix of the previous DAYJ during the rotation, until it is moved to DAYJ-1
+S3_ROTATION_PATH = "DAYJ.rotation"
+
+def freeDayjS3():
+    '''
+    First step of the rotation of backup "folders" on S3 : DAYJ is moved to S3_ROTATION_PATH
+    so that the new files can be uploaded to DAYJ while the other slots are rotated
+    '''
     if VERBOSE == 2:
-        print("Error during mysqldump")
-    MESSAGE="""Backup failed
-    Error during mysqldump"""
-    tools.sendmail(mailfrom=SMTP_FROM,mailto=SMTP_TO,message=MESSAGE,subject="Backup of Wordpress of " + TODAY, smtphost=SMTP_HOST)
-    exit(1)
+        print("")
+        print ("S3 folders rotation")
+        print("Move files from DAYJ to " + S3_ROTATION_PATH)
+    try:
+        tools.moveFolderS3(s3_client,S3_BUCKET,"DAYJ",S3_ROTATION_PATH,VERBOSE,S3_MAX_CONCURRENCY)
+    except Exception as e:
+        raise Exception("Error during move of files from DAYJ to " + S3_ROTATION_PATH + " : " + str(e))
+
+def rotateSlotsS3():
+    '''
+    Rotation of backup "folders" on S3 once DAYJ is free : DAYJ-(BACKUP_RETENTION-1) is deleted,
+    then DAYJ-N is moved to DAYJ-(N+1) and the previous DAYJ to DAYJ-1
+    Run by the transfer engine while the new files are uploaded
+    '''
+    # Delete DAYJ-RETENTION-1 folder
+    S3_PATH="DAYJ-" + str(int(BACKUP_RETENTION)-1)
+    if VERBOSE == 2:
+        print("First delete all files in " + S3_PATH)
+    try:
+        tools.deleteFolderS3(s3_client,S3_BUCKET,S3_PATH,VERBOSE,S3_MAX_CONCURRENCY)
+    except Exception as e:
+        raise Exception("Error during delete of files from " + S3_PATH + " : " + str(e))
+
+    # Move content of DAYJ-N to DAYJ-(N+1)
+    for index in range(int(BACKUP_RETENTION)-2,-1,-1):
+        if index == 0:
+            S3_PATH_FROM = S3_ROTATION_PATH
+            S3_PATH_TO = "DAYJ-1"
+        else:
+            S3_PATH_FROM = "DAYJ-" + str(index)
+            S3_PATH_TO = "DAYJ-" + str(index+1)
+        if VERBOSE == 2:
+            print("Move files from " + S3_PATH_FROM + " to " + S3_PATH_TO)
+        try:
+            tools.moveFolderS3(s3_client,S3_BUCKET,S3_PATH_FROM,S3_PATH_TO,VERBOSE,S3_MAX_CONCURRENCY)
+        except Exception as e:
+            raise Exception("Error during move of files from " + S3_PATH_FROM + " to " + S3_PATH_TO + " : " + str(e))
+    if int(BACKUP_RETENTION) < 2:
+        # No DAYJ-1 slot, the previous DAYJ is expired
+        tools.deleteFolderS3(s3_client,S3_BUCKET,S3_ROTATION_PATH,VERBOSE,S3_MAX_CONCURRENCY)
+
+def submitUploads(upload, chunk_upload, transfers, after):
+    '''
+    Submit to TRANSFER_ENGINE the upload of the new chunks with chunk_upload(), and of transfers with upload(transfers) once the operations after are done
+    The manifest of a deduplicated backup is only copied once the chunks it uses are copied
+    '''
+    if CHUNKS_TO_UPLOAD:
+        if VERBOSE == 2:
+            print("Transfering " + str(len(CHUNKS_TO_UPLOAD)) + " new chunks")
+        TRANSFER_ENGINE.submit("upload of the chunks","network",lambda: reportUpload(chunk_upload()))
+    manifest = [item for item in transfers if item[0] == wp_archive + ".bin"] if CHUNKS_TO_UPLOAD else []
+    TRANSFER_ENGINE.submit("upload of the files","network",lambda: reportUpload(upload([item for item in transfers if item not in manifest])),after=after)
+    if manifest:
+        TRANSFER_ENGINE.submit("upload of the manifest","network",lambda: reportUpload(upload(manifest)),after=after + ["upload of the chunks"])
+
+# In stream mode, Part 1 and Part 2 are done during the copy to BACKUP_DEST
+# Each artifact is dumped, compressed and encrypted on the fly
+STREAM_PRODUCERS = {}
+# Producers compressing their output themselves, ie the indexed site archives
+STREAM_COMPRESSED = set()
+if STREAM:
+    if DB_DUMP == 'single':
+        STREAM_PRODUCERS[localMysqlBackup + ".bin"] = REPORT.measure("dump", lambda f: dbdump.dump_database(f, DB_HOST, DB_NAME, DB_LIMITER, DB_LOCKS))
+    if SITE_BACKUP == 'tar':
+        # The archive is compressed by the producer, the files read are counted once it is written
+        STREAM_PRODUCERS[wp_archive + ".bin"] = REPORT.measure("site", lambda f: writeSiteArchive(f, [WP_PATH]), False)
+        STREAM_COMPRESSED.add(wp_archive + ".bin")
+
+if RESUME:
+    BACKUP_FILES = RESUMED_BACKUP["files"]
+    for file in BACKUP_FILES:
+        if not os.path.exists(file + ".bin"):
+            if VERBOSE >= 1:
+                print("File " + file + ".bin of the interrupted backup not found. Exiting")
+            MESSAGE="""Backup failed
+            File """ + file + ".bin of the interrupted backup not found"
+            sendmail(mailfrom=SMTP_FROM,mailto=SMTP_TO,message=MESSAGE,subject="Backup of Wordpress of " + TODAY, smtphost=SMTP_HOST)
+            exit(1)
+    DB_POSITION.update(RESUMED_BACKUP.get("binlog_position") or {})
+
+if BINLOG:
+    # Incremental backup of the database : the binary logs closed since the last run are copied
+    if VERBOSE >=1 :
+        print ("")
+        print ("Starting Backup of MySQL binary logs")
+    REPORT.start("binlog")
+    try:
+        if not os.path.exists(DATEFILE) or DATEINFILE != TODAY:
+            raise RuntimeError("Daily backup of " + TODAY + " with its binary log position not found in " + BACKUP_PATH)
+        BINLOG_FLUSHED = binlog.now()
+        BINLOG_LOGS = binlog.logs_to_copy(BINLOG_STATE,binlog.flush_logs(DB_HOST,DB_NAME))
+        BINLOG_INDEX_FILE = BACKUP_PATH + "/" + binlog.INDEX_FILE
+        with open(BINLOG_INDEX_FILE) as f:
+            BINLOG_INDEX = json.load(f)
+        BACKUP_FILES = []
+        for log in BINLOG_LOGS:
+            file = BACKUP_PATH + "/" + log + compress.extension(COMPRESS_CODEC)
+            if VERBOSE == 2:
+                print("Copy of binary log " + log)
+            binlog.copy_log(DB_HOST,log,file,COMPRESS_CODEC,COMPRESS_LEVEL)
+            encryptFile(file)
+            BINLOG_INDEX["logs"].append({"name": log, "file": os.path.basename(file), "flushed": BINLOG_FLUSHED})
+            BACKUP_FILES.append(file)
+        binlog.write_index(BINLOG_INDEX_FILE,BINLOG_INDEX)
+        encryptFile(BINLOG_INDEX_FILE)
+        BACKUP_FILES.append(BINLOG_INDEX_FILE)
+        REPORT.stage("binlog").add(bytes_out=sum(os.path.getsize(file + ".bin") for file in BACKUP_FILES))
+    except Exception as e:
+        if VERBOSE == 2:
+            print("Error during backup of binary logs : " + str(e))
+        MESSAGE="""Backup failed
+        Error during backup of binary logs : """ + str(e)
+        sendmail(mailfrom=SMTP_FROM,mailto=SMTP_TO,message=MESSAGE,subject="Backup of Wordpress of " + TODAY, smtphost=SMTP_HOST)
+        exit(1)
+
+    if VERBOSE >=1:
+        print ("")
+        print (str(len(BINLOG_LOGS)) + " binary logs copied in " + BACKUP_PATH)
+
+# Part1 : Database backup.
+if DB_DUMP == 'tables' and not COPY_ONLY:
+    if VERBOSE >=1 :
+        print ("")
+        print ("Starting Backup of MySQL, table by table")
+    REPORT.start("dump")
+
+    # The manifest is written first, in stream mode each part is dumped during its upload
+    try:
+        DB_SNAPSHOT = dbdump.Snapshot(DB_HOST,DB_NAME,DB_DUMP_WORKERS,DB_LOCKS)
+        DB_MANIFEST = dbdump.plan_dump(DB_SNAPSHOT,DB_NAME + ".sql",COMPRESS_CODEC,DB_DUMP_CHUNK_ROWS)
+        dbdump.write_manifest(DB_MANIFEST,localMysqlBackup,COMPRESS_CODEC)
+        if STREAM:
+            # The parts holding the global read lock are dumped now, so that it is not held while waiting for the uploads
+            locked = dbdump.locked_parts(DB_MANIFEST)
+            try:
+                dbdump.dump_tables(DB_MANIFEST,DB_SNAPSHOT,BACKUP_PATH,COMPRESS_LEVEL,DB_LIMITER,locked)
+            except:
+                DB_SNAPSHOT.close()
+                DB_SNAPSHOT = None
+                raise
+            REPORT.stage("dump").add(bytes_out=sum(os.path.getsize(BACKUP_PATH + "/" + part["file"]) for table, part in locked))
+            # The other ones are dumped during their upload, the snapshot is closed once they are uploaded
+            for table, part in dbdump.parts(DB_MANIFEST):
+                if table["engine"] not in dbdump.TRANSACTIONAL_ENGINES:
+                    continue
+                STREAM_PRODUCERS[BACKUP_PATH + "/" + part["file"] + ".bin"] = REPORT.measure("dump", lambda f, table=table, part=part: dbdump.dump_part(f, DB_SNAPSHOT, table, part, DB_LIMITER))
+        else:
+            try:
+                dbdump.dump_tables(DB_MANIFEST,DB_SNAPSHOT,BACKUP_PATH,COMPRESS_LEVEL,DB_LIMITER)
+            finally:
+                DB_SNAPSHOT.close()
+                DB_SNAPSHOT = None
+            REPORT.stage("dump").add(bytes_out=sum(os.path.getsize(BACKUP_PATH + "/" + file) for file in dbdump.part_files(DB_MANIFEST)))
+    except Exception as e:
+        if VERBOSE == 2:
+            print("Error during mysqldump : " + str(e))
+        MESSAGE="""Backup failed
+        Error during mysqldump : """ + str(e)
+        sendmail(mailfrom=SMTP_FROM,mailto=SMTP_TO,message=MESSAGE,subject="Backup of Wordpress of " + TODAY, smtphost=SMTP_HOST)
+        exit(1)
+    BACKUP_FILES[1:1] = [BACKUP_PATH + "/" + file for file in dbdump.part_files(DB_MANIFEST)]
 
-gzipcmd = "gzip -f " + BACKUP_PATH + "/" + DB_NAME + ".sql"
-try:
-    os.system(gzipcmd)
-except:
     if VERBOSE == 2:
-        print("Error during Gzip of mysqldump")
-    MESSAGE="""Backup failed
-    Error during Gzip of mysqldump"""
-    tools.sendmail(mailfrom=SMTP_FROM,mailto=SMTP_TO,message=MESSAGE,subject="Backup of Wordpress of " + TODAY, smtphost=SMTP_HOST)
-    exit(1)
-localMysqlBackup=BACKUP_PATH + "/" + DB_NAME + ".sql.gz"
+            print(str(len(DB_MANIFEST["tables"])) + " tables in " + str(len(dbdump.part_files(DB_MANIFEST))) + " parts, manifest copied in " + localMysqlBackup )
 
-if VERBOSE == 2:
-        print("Local MySQL dump copied in " + localMysqlBackup )
+    if VERBOSE >=1:
+        print ("")
+        print ("Backup of MySQL completed")
 
-if VERBOSE >=1:
-    print ("")
-    print ("Backup of MySQL completed")
+elif not STREAM and not COPY_ONLY:
+    if VERBOSE >=1 :
+        print ("")
+        print ("Starting Backup of MySQL")
+    REPORT.start("dump")
+
+    # The dump is compressed while it is read, InnoDB tables are read in a snapshot without lock
+    try:
+        with open(localMysqlBackup,"wb") as f:
+            compressor = compress.open_writer(COMPRESS_CODEC,f,COMPRESS_LEVEL,COMPRESS_WORKERS)
+            try:
+                DB_POSITION.update(dbdump.dump_database(report.CountingWriter(compressor,REPORT.stage("dump")),DB_HOST,DB_NAME,DB_LIMITER,DB_LOCKS,DB_BINLOG) or {})
+            except Exception:
+                compress.abort_writer(compressor)
+                raise
+            compressor.close()
+        REPORT.stage("dump").add(bytes_out=os.path.getsize(localMysqlBackup))
+        if DB_BINLOG:
+            # Index of the binary logs which will be copied by backup-wp.py --binlog after this dump
+            binlog.write_index(BACKUP_PATH + "/" + binlog.INDEX_FILE,{"start": DB_POSITION, "logs": []})
+            BACKUP_FILES.append(BACKUP_PATH + "/" + binlog.INDEX_FILE)
+    except Exception as e:
+        if VERBOSE == 2:
+            print("Error during mysqldump : " + str(e))
+        MESSAGE="""Backup failed
+        Error during mysqldump : """ + str(e)
+        sendmail(mailfrom=SMTP_FROM,mailto=SMTP_TO,message=MESSAGE,subject="Backup of Wordpress of " + TODAY, smtphost=SMTP_HOST)
+        exit(1)
+
+    if VERBOSE == 2:
+            print("Local MySQL dump copied in " + localMysqlBackup )
+
+    if VERBOSE >=1:
+        print ("")
+        print ("Backup of MySQL completed")
 
 # Part2 : WP Site backup.
+CHUNKS_TO_UPLOAD = []
+CHUNKS_REMOVED = []
+if BINLOG:
+    pass
+elif RESUME:
+    # The backup is not made again, only the chunks still pending are copied
+    CHUNKS_REMOVED = RESUMED_BACKUP["chunks_removed"]
+    if SITE_BACKUP == 'dedup':
+        store = dedup.ChunkStore(CHUNK_STORE,ENCRYPTION_KEY,COMPRESS_CODEC,COMPRESS_LEVEL)
+        CHUNKS_TO_UPLOAD = [chunk_id for chunk_id in store.pending() if store.has(chunk_id)]
+    elif SITE_BACKUP == 'diff':
+        NEW_INDEX = fileindex.read_index(BACKUP_ROOT_PATH + "/" + fileindex.PENDING_INDEX_FILE)
+
+elif SITE_BACKUP == 'dedup':
+    if VERBOSE >=1:
+        print ("")
+        print ("Starting deduplicated backup of Wordpress Site folder")
+    REPORT.start("site")
+    try:
+        store = dedup.ChunkStore(CHUNK_STORE,ENCRYPTION_KEY,COMPRESS_CODEC,COMPRESS_LEVEL)
+        # Files not modified since the last backup are not read again
+        previous = dedup.read_backup_manifest(BACKUP_PATH,ENCRYPTION_KEY) or dedup.read_backup_manifest(BACKUP_ROOT_PATH + "/DAYJ-1",ENCRYPTION_KEY)
+        # The chunks found in the store are not deleted by the other sites until they are in the references
+        with store.lock():
+            manifest = dedup.backup_folder(store,WP_PATH,previous,DISK_LIMITER)
+            dedup.write_manifest(manifest,wp_archive,COMPRESS_CODEC)
+            # Chunks only used by backups out of BACKUP_RETENTION, of this site and of the others, are deleted
+            referenced = dedup.referenced_chunks(manifest)
+            for index in range(1,int(BACKUP_RETENTION)):
+                old_manifest = dedup.read_backup_manifest(BACKUP_ROOT_PATH + "/DAYJ-" + str(index),ENCRYPTION_KEY)
+                if old_manifest:
+                    referenced |= dedup.referenced_chunks(old_manifest)
+            store.set_refs(REPORT_SITE or "default",referenced)
+        CHUNKS_REMOVED = store.gc()
+        # Pending chunks of the other sites sharing the store are copied too
+        CHUNKS_TO_UPLOAD = [chunk_id for chunk_id in store.pending() if store.has(chunk_id)]
+        REPORT.stage("site").add(bytes_in=sum(entry["size"] for entry in manifest["entries"] if entry["type"] == "file"),
+                                 bytes_out=os.path.getsize(wp_archive) + sum(os.path.getsize(store.chunk_path(chunk_id)) for chunk_id in CHUNKS_TO_UPLOAD))
+    except:
+        if VERBOSE == 2:
+            print("Error during deduplicated backup of Wordpress site")
+        MESSAGE="""Backup failed
+        Error during deduplicated backup of Wordpress site"""
+        sendmail(mailfrom=SMTP_FROM,mailto=SMTP_TO,message=MESSAGE,subject="Backup of Wordpress of " + TODAY, smtphost=SMTP_HOST)
+        exit(1)
 
-if VERBOSE >=1:
-    print ("")
-    print ("Starting backup of Wordpress Site folder")
-# Declare filename
-wp_archive = BACKUP_PATH + "/" + "wordpress.site.tar.gz"
+    if VERBOSE == 2:
+            print(str(len(CHUNKS_TO_UPLOAD)) + " new chunks, " + str(len(CHUNKS_REMOVED)) + " chunks deleted")
+            ref_counts = store.ref_counts()
+            shared = sum(1 for chunk_id in referenced if ref_counts[chunk_id] > 1)
+            print(str(len(referenced)) + " chunks used by the site, " + str(shared) + " of them shared with other sites")
+            print("Local Wordpress site manifest copied in " + wp_archive )
+
+    if VERBOSE >= 1:
+        print ("")
+        print ("Backup of  Wordpress Site folder completed")
+
+elif SITE_BACKUP == 'diff':
+    if VERBOSE >=1:
+        print ("")
+        print ("Starting differential backup of Wordpress Site folder")
+    REPORT.start("site")
+    try:
+        base = fileindex.load_index(BACKUP_ROOT_PATH,TODAY)
+        if base and base["diffs"] + 1 >= DIFF_FULL_EVERY:
+            base = None
+        SITE_BASE = "diff" if base else "full"
+        # Files with the same size, modification time and inode as in the index are not read
+        files, changed, deleted = fileindex.scan(WP_PATH,base,DISK_LIMITER)
+        NEW_INDEX = {"version": 1, "date": TODAY, "diffs": base["diffs"] + 1 if base else 0, "files": files}
+        if STREAM:
+            STREAM_PRODUCERS[wp_archive + ".bin"] = REPORT.measure("site", lambda f: writeSiteArchive(f,changed,False), False)
+            STREAM_COMPRESSED.add(wp_archive + ".bin")
+        else:
+            with open(wp_archive,"wb") as f:
+                writeSiteArchive(f,changed,False)
+            REPORT.stage("site").add(bytes_out=os.path.getsize(wp_archive))
+        fileindex.write_deleted(deleted,wp_deleted,COMPRESS_CODEC)
+    except:
+        if VERBOSE == 2:
+            print("Error during differential backup of Wordpress site")
+        MESSAGE="""Backup failed
+        Error during differential backup of Wordpress site"""
+        sendmail(mailfrom=SMTP_FROM,mailto=SMTP_TO,message=MESSAGE,subject="Backup of Wordpress of " + TODAY, smtphost=SMTP_HOST)
+        exit(1)
 
-# Open file in write mode
-try:
-    tar = tarfile.open(wp_archive,"w:gz")
-    tar.add(WP_PATH)
-    tar.close()
-except:
     if VERBOSE == 2:
-        print("Error during Tar GZ  of Wordpress site")
-    MESSAGE="""Backup failed
-    Error during Tar GZ of of Wordpress site"""
-    tools.sendmail(mailfrom=SMTP_FROM,mailto=SMTP_TO,message=MESSAGE,subject="Backup of Wordpress of " + TODAY, smtphost=SMTP_HOST)
-    exit(1)
+            print(SITE_BASE + " backup : " + str(len(changed)) + " changed paths, " + str(len(deleted)) + " deleted paths")
+            print("Local Wordpress site dump copied in " + wp_archive )
 
-if VERBOSE == 2:
-        print("Local Wordpress site dump copied in " + wp_archive )
+    if VERBOSE >= 1:
+        print ("")
+        print ("Backup of  Wordpress Site folder completed")
 
-if VERBOSE >= 1:
-    print ("")
-    print ("Backup of  Wordpress Site folder completed")
+elif not STREAM:
+    if VERBOSE >=1:
+        print ("")
+        print ("Starting backup of Wordpress Site folder")
+    REPORT.start("site")
+    # Open file in write mode
+    try:
+        # Blocks compressed separately so that restore-wp.py can extract them in parallel
+        with open(wp_archive,"wb") as f:
+            writeSiteArchive(f,[WP_PATH])
+        REPORT.stage("site").add(bytes_out=os.path.getsize(wp_archive))
+    except:
+        if VERBOSE == 2:
+            print("Error during Tar GZ  of Wordpress site")
+        MESSAGE="""Backup failed
+        Error during Tar GZ of of Wordpress site"""
+        sendmail(mailfrom=SMTP_FROM,mailto=SMTP_TO,message=MESSAGE,subject="Backup of Wordpress of " + TODAY, smtphost=SMTP_HOST)
+        exit(1)
 
-# Part 3 : Put datefile in DAYJ
-try:
-    datefile = open(DATEFILE,"w")
-    datefile.write(TODAY)
-    datefile.close()
-except:
     if VERBOSE == 2:
-        print("Error during create of DATEFILE")
-    MESSAGE="""Backup failed
-    Error during create of DATEFILE"""
-    tools.sendmail(mailfrom=SMTP_FROM,mailto=SMTP_TO,message=MESSAGE,subject="Backup of Wordpress of " + TODAY, smtphost=SMTP_HOST)
-    exit(1)
+            print("Local Wordpress site dump copied in " + wp_archive )
+
+    if VERBOSE >= 1:
+        print ("")
+        print ("Backup of  Wordpress Site folder completed")
+
+# Part 3 : Put datefile and metadata of the backup in DAYJ
+if not COPY_ONLY:
+    REPORT.start("metadata")
+    try:
+        datefile = open(DATEFILE,"w")
+        datefile.write(TODAY)
+        datefile.close()
+        METADATA = {
+            "date": TODAY,
+            "codec": COMPRESS_CODEC,
+            "database": os.path.basename(localMysqlBackup),
+            "database_mode": DB_DUMP,
+            "site": os.path.basename(wp_archive),
+            "site_mode": SITE_BACKUP
+        }
+        if SITE_BACKUP in ['tar','diff']:
+            METADATA["site_index"] = os.path.basename(wp_index)
+        if SITE_BACKUP == 'diff':
+            METADATA["site_base"] = SITE_BASE
+            METADATA["deleted"] = os.path.basename(wp_deleted)
+        METADATA["catalog"] = os.path.basename(catalog_file)
+        METADATA["checksums"] = os.path.basename(checksums_file)
+        with open(METAFILE,"w") as metafile:
+            json.dump(METADATA, metafile)
+    except:
+        if VERBOSE == 2:
+            print("Error during create of DATEFILE")
+        MESSAGE="""Backup failed
+        Error during create of DATEFILE"""
+        sendmail(mailfrom=SMTP_FROM,mailto=SMTP_TO,message=MESSAGE,subject="Backup of Wordpress of " + TODAY, smtphost=SMTP_HOST)
+        exit(1)
+    if catalog_file not in LATE_FILES:
+        try:
+            writeCatalog()
+        except:
+            if VERBOSE == 2:
+                print("Error during create of the catalog")
+            MESSAGE="""Backup failed
+            Error during create of the catalog"""
+            sendmail(mailfrom=SMTP_FROM,mailto=SMTP_TO,message=MESSAGE,subject="Backup of Wordpress of " + TODAY, smtphost=SMTP_HOST)
+            exit(1)
+        if VERBOSE == 2:
+            print("Catalog of the backup copied in " + catalog_file)
 
 
 # Part 4 : Encrypt using AES-256
-fdKey = open(ENCRYPTION_KEYPATH,'rb')
-ENCRYPTION_KEY = fdKey.read()
-for file in [localMysqlBackup,wp_archive,DATEFILE]:
+if not COPY_ONLY:
+    REPORT.start("encrypt")
+for file in BACKUP_FILES:
+    if file + ".bin" in STREAM_PRODUCERS or COPY_ONLY:
+        continue
     file_name = os.path.basename(file)
     if VERBOSE == 2:
         print("Encrypt file " + file_name)
     try:
-        encrypt.encrypt_file(file,ENCRYPTION_KEY)
+        encryptFile(file)
+        REPORT.stage("encrypt").add(os.path.getsize(file),os.path.getsize(file + ".bin"))
     except:
         if VERBOSE == 2:
             print("Error during encryption of file " + file_name)
         MESSAGE="""Backup failed
         Error during encryption of file """ + file_name
-        tools.sendmail(mailfrom=SMTP_FROM,mailto=SMTP_TO,message=MESSAGE,subject="Backup of Wordpress of " + TODAY, smtphost=SMTP_HOST)
+        sendmail(mailfrom=SMTP_FROM,mailto=SMTP_TO,message=MESSAGE,subject="Backup of Wordpress of " + TODAY, smtphost=SMTP_HOST)
         exit(1)
 
 # Part 5 : Copy to BACKUP_DEST
 
+# Recorded before the copy so that --resume can copy the same files again
+if not COPY_ONLY:
+    if SITE_BACKUP == 'diff':
+        fileindex.write_index(BACKUP_ROOT_PATH + "/" + fileindex.PENDING_INDEX_FILE,NEW_INDEX)
+    TRANSFER_JOURNAL.start_backup({"date": TODAY, "files": BACKUP_FILES, "stream": STREAM, "site_mode": SITE_BACKUP, "chunks_removed": CHUNKS_REMOVED, "binlog_position": DB_POSITION or None})
+
 if BACKUP_DEST == 'S3':
     if VERBOSE >= 1:
         print ("")
         print ("Starting Copy to AWS S3")
+    REPORT.start("remote_rotation")
 
     bucket_name = S3_BUCKET # name of the bucket
 
@@ -328,12 +978,16 @@ if BACKUP_DEST == 'S3':
         retries = {
             'max_attempts': 10,
             'mode': 'standard'
-        }
+        },
+        # One connection per thread of the transfers, the chunks and the files are uploaded at the same time
+        max_pool_connections = max(10, 2 * S3_MAX_CONCURRENCY * S3_FILES_IN_FLIGHT)
     )
+    transfer_config = tools.s3TransferConfig(S3_MULTIPART_CHUNKSIZE, S3_MAX_CONCURRENCY)
 
     try:
         s3_client = boto3.client(
             's3',
+            endpoint_url = S3_ENDPOINT_URL,
             aws_access_key_id = S3_ACCESS_KEY,
             aws_secret_access_key = S3_SECRET_ACCESS_KEY,
             config = my_config
@@ -343,78 +997,120 @@ if BACKUP_DEST == 'S3':
             print("Error during S3 connection")
         MESSAGE="""Backup failed
         Error during S3 connection. Please check your S3 parameters in """ + CONFIG_FILE
-        tools.sendmail(mailfrom=SMTP_FROM,mailto=SMTP_TO,message=MESSAGE,subject="Backup of Wordpress of " + TODAY, smtphost=SMTP_HOST)
+        sendmail(mailfrom=SMTP_FROM,mailto=SMTP_TO,message=MESSAGE,subject="Backup of Wordpress of " + TODAY, smtphost=SMTP_HOST)
         exit(1)
 
-    if BACKUP_ROTATION == True:
-        # Rotation of backup "folders"
-        if VERBOSE == 2:
-            print("")
-            print ("S3 folders rotation")
-        # Delete DAYJ-RETENTION-1 folder
-        S3_PATH="DAYJ-" + str(int(BACKUP_RETENTION)-1)
-        if VERBOSE == 2:
-            print("")
-            print("First delete all files in " + S3_PATH    )
+    if S3_LAYOUT == 'dated':
+        # No rotation, today's backup has its own prefix and the index is updated once uploaded
+        S3_DAY_PATH = tools.datedPathS3(TODAY)
         try:
-            tools.deleteFolderS3(s3_client,S3_BUCKET,S3_PATH,VERBOSE)
+            S3_BACKUPS = tools.readBackupIndexS3(s3_client,S3_BUCKET)
         except:
             if VERBOSE == 2:
-                print("Delete files from " + S3_PATH + " failed")
+                print("Error during read of " + tools.S3_INDEX_KEY)
             MESSAGE="""Backup failed
-            Error during delete of files from """ + S3_PATH
-            tools.sendmail(mailfrom=SMTP_FROM,mailto=SMTP_TO,message=MESSAGE,subject="Backup of Wordpress of " + TODAY, smtphost=SMTP_HOST)
+            Error during read of """ + tools.S3_INDEX_KEY
+            sendmail(mailfrom=SMTP_FROM,mailto=SMTP_TO,message=MESSAGE,subject="Backup of Wordpress of " + TODAY, smtphost=SMTP_HOST)
             exit(1)
-
+    else:
+        S3_DAY_PATH = "DAYJ"
+
+    # Transfers run by the engine : the rotation of the slots overlaps the upload of the new chunks,
+    # and the upload of the files once the previous DAYJ is moved out of the way
+    REPORT.start("upload")
+    TRANSFER_ENGINE = transfer.TransferEngine({"network": transfer.OPERATIONS})
+    UPLOAD_AFTER = []
+    if BACKUP_ROTATION == True and S3_LAYOUT == 'slots':
+        TRANSFER_ENGINE.submit("rotation of DAYJ","network",REPORT.measure_call("remote_rotation",freeDayjS3))
+        TRANSFER_ENGINE.submit("rotation","network",REPORT.measure_call("remote_rotation",rotateSlotsS3),after=["rotation of DAYJ"])
+        UPLOAD_AFTER.append("rotation of DAYJ")
+
+    if SITE_BACKUP == 'dedup':
+        # Chunks copied in the meantime by another site sharing the store are not pending anymore
+        pending = set(store.pending())
+        CHUNKS_TO_UPLOAD = [chunk_id for chunk_id in CHUNKS_TO_UPLOAD if chunk_id in pending]
+
+    # Finaly copy new backup files to DAYJ folder, several files at the same time
+    transfers = []
+    for file in [file + ".bin" for file in BACKUP_FILES]:
+        file_name = os.path.basename(file)
+        new_name = S3_DAY_PATH + "/" + file_name
         if VERBOSE == 2:
-            print("")
-
-        # Move content of DAYJ-N to DAYJ-(N+1)
-        for index in range(int(BACKUP_RETENTION)-2,-1,-1):
-            if index == 0:
-                S3_PATH_FROM = "DAYJ"
-                S3_PATH_TO = "DAYJ-1"
-            else:
-                S3_PATH_FROM = "DAYJ-" + str(index)
-                S3_PATH_TO = "DAYJ-" + str(index+1)
+            print("Transfering file " + file_name + " to " + new_name)
+        if file in STREAM_PRODUCERS:
+            # The stream is only started when its upload starts
+            source = lambda file=file: pipeline.ArtifactStream(STREAM_PRODUCERS[file], ENCRYPTION_KEY, None if NOLOCAL else file, "none" if file in STREAM_COMPRESSED else COMPRESS_CODEC, COMPRESS_LEVEL, COMPRESS_WORKERS, streamDigest(file))
+        else:
+            source = file
+        transfers.append((source, new_name))
+    submitUploads(lambda transfers: tools.uploadFilesS3(s3_client,S3_BUCKET,transfers,transfer_config,S3_FILES_IN_FLIGHT,VERBOSE,TRANSFER_JOURNAL,limiter=NETWORK_LIMITER),
+                  lambda: tools.uploadChunksS3(s3_client,CHUNK_S3_BUCKET,store,CHUNKS_TO_UPLOAD,dedup.REMOTE_FOLDER,transfer_config,S3_FILES_IN_FLIGHT,VERBOSE,limiter=NETWORK_LIMITER),
+                  transfers,UPLOAD_AFTER)
+    try:
+        TRANSFER_ENGINE.wait()
+        # The index and the catalog of a streamed site archive are written at the end of its upload
+        for file in LATE_FILES:
+            encryptFile(file)
+        reportUpload(tools.uploadFilesS3(s3_client,S3_BUCKET,[(file + ".bin", S3_DAY_PATH + "/" + os.path.basename(file) + ".bin") for file in LATE_FILES],transfer_config,S3_FILES_IN_FLIGHT,VERBOSE,TRANSFER_JOURNAL,limiter=NETWORK_LIMITER))
+        # The checksums are complete once all the files are written
+        writeChecksums()
+        reportUpload(tools.uploadFilesS3(s3_client,S3_BUCKET,[(checksums_file + ".bin", S3_DAY_PATH + "/" + os.path.basename(checksums_file) + ".bin")],transfer_config,S3_FILES_IN_FLIGHT,VERBOSE,TRANSFER_JOURNAL,limiter=NETWORK_LIMITER))
+    except Exception as e:
+        if VERBOSE == 2:
+            print("Error during copy to " + S3_DAY_PATH + ", " + str(e))
+        MESSAGE="""Backup failed
+        Error during copy to """ + S3_DAY_PATH + ", " + str(e)
+        sendmail(mailfrom=SMTP_FROM,mailto=SMTP_TO,message=MESSAGE,subject="Backup of Wordpress of " + TODAY, smtphost=SMTP_HOST)
+        exit(1)
+    finally:
+        TRANSFER_ENGINE.close()
+        if DB_SNAPSHOT:
+            DB_SNAPSHOT.close()
+
+    REPORT.start("remote_rotation")
+    if S3_LAYOUT == 'dated':
+        # Rotation is a single write of the index, then the expired backups are deleted
+        S3_BACKUPS = [TODAY] + [date for date in S3_BACKUPS if date != TODAY]
+        S3_EXPIRED = S3_BACKUPS[int(BACKUP_RETENTION):]
+        if VERBOSE == 2:
+            print("Update of " + tools.S3_INDEX_KEY + ", " + str(len(S3_EXPIRED)) + " backups expired")
+        try:
+            tools.writeBackupIndexS3(s3_client,S3_BUCKET,S3_BACKUPS[:int(BACKUP_RETENTION)])
+            tools.deletePrefixesS3(s3_client,S3_BUCKET,[tools.datedPathS3(date) for date in S3_EXPIRED],VERBOSE,S3_MAX_CONCURRENCY)
+        except Exception as e:
             if VERBOSE == 2:
-                print("Move files from " + S3_PATH_FROM + " to " + S3_PATH_TO)
-    #        listObjectFolderS3(s3_client,S3_BUCKET,S3_PATH_FROM,S3_PATH_TO)
-            try:
-                tools.moveFolderS3(s3_client,S3_BUCKET,S3_PATH_FROM,S3_PATH_TO,VERBOSE)
-            except:
-                if VERBOSE == 2:
-                    print("Move files from " + S3_PATH_FROM + " to " + S3_PATH_TO + " failed")
-                MESSAGE="""Backup failed
-                Error during move of files from """ + S3_PATH_FROM + " to " + S3_PATH_TO
-                tools.sendmail(mailfrom=SMTP_FROM,mailto=SMTP_TO,message=MESSAGE,subject="Backup of Wordpress of " + TODAY, smtphost=SMTP_HOST)
-                exit(1)
+                print("Error during update of " + tools.S3_INDEX_KEY + " : " + str(e))
+            MESSAGE="""Backup failed
+            Error during update of """ + tools.S3_INDEX_KEY + " : " + str(e)
+            sendmail(mailfrom=SMTP_FROM,mailto=SMTP_TO,message=MESSAGE,subject="Backup of Wordpress of " + TODAY, smtphost=SMTP_HOST)
+            exit(1)
 
-    # Finaly copy new backup files to DAYJ folder
-    for file in [localMysqlBackup + ".bin",wp_archive + ".bin",DATEFILE + ".bin"]:
-        file_name = os.path.basename(file)
-        new_name = "DAYJ/" + file_name
+    if SITE_BACKUP == 'dedup':
+        store.clear_pending(CHUNKS_TO_UPLOAD)
         if VERBOSE == 2:
-            print("Transfering file " + file_name + " to " + new_name)
+            print("Delete " + str(len(CHUNKS_REMOVED)) + " chunks not used anymore")
         try:
-            s3_client.upload_file(file, S3_BUCKET, new_name)
+            # A chunk deleted here may have been added again since by another site
+            with store.lock(exclusive=True):
+                tools.deleteChunksS3(s3_client,CHUNK_S3_BUCKET,[chunk_id for chunk_id in CHUNKS_REMOVED if not store.has(chunk_id)],dedup.REMOTE_FOLDER,VERBOSE,S3_MAX_CONCURRENCY)
         except:
             if VERBOSE == 2:
-                print("Error during upload of file " + file_name + " in " + new_name)
+                print("Error during delete of chunks in " + dedup.REMOTE_FOLDER)
             MESSAGE="""Backup failed
-            Error during upload of file """ + file_name + " in " + new_name
-            tools.sendmail(mailfrom=SMTP_FROM,mailto=SMTP_TO,message=MESSAGE,subject="Backup of Wordpress of " + TODAY, smtphost=SMTP_HOST)
+            Error during delete of chunks in """ + dedup.REMOTE_FOLDER
+            sendmail(mailfrom=SMTP_FROM,mailto=SMTP_TO,message=MESSAGE,subject="Backup of Wordpress of " + TODAY, smtphost=SMTP_HOST)
             exit(1)
 
     if VERBOSE >= 1:
         print ("")
         print ("Copy to AWS S3 completed")
 
-else:
+elif BACKUP_DEST == 'FTP':
     if VERBOSE >= 1:
         print ("")
         print ("Starting Copy to FTP Server")
         print ("")
+    REPORT.start("remote_rotation")
 
     ftpserver=tools.connectftp(FTP_SERVER,FTP_USER,FTP_PASSWD)
     ftpserver.cwd(FTP_ROOT_PATH)
@@ -442,7 +1138,7 @@ else:
                     print("Error during Create folder of " + BACKUP_PATH + " ie Folder already exist")
                 MESSAGE="""Backup failed
                 Error during create folder of """ + FTP_PATH + " ie Folder already exist"
-                tools.sendmail(mailfrom=SMTP_FROM,mailto=SMTP_TO,message=MESSAGE,subject="Backup of Wordpress of " + TODAY, smtphost=SMTP_HOST)
+                sendmail(mailfrom=SMTP_FROM,mailto=SMTP_TO,message=MESSAGE,subject="Backup of Wordpress of " + TODAY, smtphost=SMTP_HOST)
                 exit(1)
             else:
                 if VERBOSE == 2:
@@ -452,16 +1148,34 @@ else:
                 print(FTP_PATH + " already exists")
             ftpserver.cwd("..")
 
+    # Expired slot, renamed during the rotation and deleted while the new files are uploaded
+    FTP_EXPIRED_PATH = "DAYJ-expired"
+    try:
+        ftpserver.cwd(FTP_EXPIRED_PATH)
+    except:
+        pass
+    else:
+        # Left by a backup interrupted during its upload
+        ftpserver.cwd("..")
+        if VERBOSE == 2:
+            print("Delete folder " + FTP_EXPIRED_PATH + " of a previous backup")
+        try:
+            tools.deleteFolderftp(ftpserver,FTP_EXPIRED_PATH,VERBOSE)
+        except Exception as e:
+            if VERBOSE == 2:
+                print("Error during delete of folder " + FTP_EXPIRED_PATH + " : " + str(e))
+            MESSAGE="""Backup failed
+            Error during delete of folder """ + FTP_EXPIRED_PATH + " : " + str(e)
+            sendmail(mailfrom=SMTP_FROM,mailto=SMTP_TO,message=MESSAGE,subject="Backup of Wordpress of " + TODAY, smtphost=SMTP_HOST)
+            exit(1)
+
     if BACKUP_ROTATION == True:
         # Backup Rotation
         if VERBOSE == 2:
             print("")
             print ("FTP folders rotation")
-        # Delete DAYJ-RETENTION-1 folder
+        # DAYJ-RETENTION-1 folder is renamed, its files are deleted during the upload
         FTP_PATH="DAYJ-" + str(int(BACKUP_RETENTION)-1)
-        if VERBOSE == 2:
-            print("")
-            print("First delete all files in " + FTP_PATH)
         try:
             ftpserver.cwd(FTP_PATH)
         except:
@@ -469,33 +1183,12 @@ else:
                 print("Error accessing folder " + FTP_PATH + " ie Folder does not exist")
             MESSAGE="""Backup failed
             Error accessing folder """ + FTP_PATH + " ie Folder does not exist"
-            tools.sendmail(mailfrom=SMTP_FROM,mailto=SMTP_TO,message=MESSAGE,subject="Backup of Wordpress of " + TODAY, smtphost=SMTP_HOST)
+            sendmail(mailfrom=SMTP_FROM,mailto=SMTP_TO,message=MESSAGE,subject="Backup of Wordpress of " + TODAY, smtphost=SMTP_HOST)
             exit(1)
-        try:
-            file_list = ftpserver.nlst()
-        except:
-            if VERBOSE == 2:
-                print("Error listing files in folder " + FTP_PATH )
-            MESSAGE="""Backup failed
-            Error listing files in folder """ + FTP_PATH
-            tools.sendmail(mailfrom=SMTP_FROM,mailto=SMTP_TO,message=MESSAGE,subject="Backup of Wordpress of " + TODAY, smtphost=SMTP_HOST)
-            exit(1)
-        for file in ftpserver.nlst():
-            if VERBOSE == 2:
-                print("Delete file " + file)
-            ftpserver.delete(file)
         ftpserver.cwd("..")
-        try:
-            if VERBOSE == 2:
-                print("Delete folder " + FTP_PATH)
-            ftpserver.rmd(FTP_PATH)
-        except:
-            if VERBOSE == 2:
-                print("Error during delete of folder " + FTP_PATH + " ie Folder not empty")
-                MESSAGE="""Backup failed
-                Error during delete of folder """ + FTP_PATH + " ie Folder not empty"
-                tools.sendmail(mailfrom=SMTP_FROM,mailto=SMTP_TO,message=MESSAGE,subject="Backup of Wordpress of " + TODAY, smtphost=SMTP_HOST)
-                exit(1)
+        if VERBOSE == 2:
+            print("Rename from " + FTP_PATH + " to " + FTP_EXPIRED_PATH)
+        ftpserver.rename(FTP_PATH,FTP_EXPIRED_PATH)
         if VERBOSE == 2:
             print("")
         # Move content of DAYJ-N to DAYJ-(N+1)
@@ -517,11 +1210,87 @@ else:
                 print("")
         ftpserver.mkd(FTP_PATH)
 
+    # Sessions used for the transfers, folders are created and rotated by ftpserver
+    try:
+        ftppool = tools.FTPPool(FTP_SERVER,FTP_USER,FTP_PASSWD,FTP_SESSIONS,FTP_ROOT_PATH)
+    except:
+        if VERBOSE == 2:
+            print("Error during connection of " + str(FTP_SESSIONS) + " FTP sessions")
+        MESSAGE="""Backup failed
+        Error during connection of """ + str(FTP_SESSIONS) + " FTP sessions"
+        sendmail(mailfrom=SMTP_FROM,mailto=SMTP_TO,message=MESSAGE,subject="Backup of Wordpress of " + TODAY, smtphost=SMTP_HOST)
+        exit(1)
+
+    if SITE_BACKUP == 'dedup':
+        # Chunks copied in the meantime by another site sharing the store are not pending anymore
+        pending = set(store.pending())
+        CHUNKS_TO_UPLOAD = [chunk_id for chunk_id in CHUNKS_TO_UPLOAD if chunk_id in pending]
+    if CHUNKS_TO_UPLOAD:
+        try:
+            ftpserver.mkd(CHUNK_FTP_PATH)
+        except ftplib.error_perm:
+            # Folder already exists
+            pass
+
+    # Transfers run by the engine : the expired slot is deleted by ftpserver while the sessions of ftppool upload the new files
+    REPORT.start("upload")
+    TRANSFER_ENGINE = transfer.TransferEngine({"network": transfer.OPERATIONS})
+    if BACKUP_ROTATION == True:
+        TRANSFER_ENGINE.submit("delete of " + FTP_EXPIRED_PATH,"network",REPORT.measure_call("remote_rotation",lambda: tools.deleteFolderftp(ftpserver,FTP_EXPIRED_PATH,VERBOSE)))
+
     FTP_PATH="DAYJ"
-    for file in [localMysqlBackup + ".bin",wp_archive + ".bin",DATEFILE + ".bin"]:
+    transfers = []
+    for file in [file + ".bin" for file in BACKUP_FILES]:
         if VERBOSE >= 1:
             print("Transfering " + file + " to " + FTP_PATH)
-        result=tools.uploadftp(ftpserver,file,FTP_PATH)
+        if file in STREAM_PRODUCERS:
+            source = lambda file=file: pipeline.ArtifactStream(STREAM_PRODUCERS[file], ENCRYPTION_KEY, None if NOLOCAL else file, "none" if file in STREAM_COMPRESSED else COMPRESS_CODEC, COMPRESS_LEVEL, COMPRESS_WORKERS, streamDigest(file))
+        else:
+            source = file
+        transfers.append((source, FTP_PATH + "/" + os.path.basename(file)))
+    submitUploads(lambda transfers: tools.uploadFilesftp(ftppool,transfers,FTP_BLOCK_SIZE,VERBOSE,TRANSFER_JOURNAL,limiter=NETWORK_LIMITER),
+                  lambda: tools.uploadChunksftp(ftppool,store,CHUNKS_TO_UPLOAD,CHUNK_FTP_PATH,FTP_BLOCK_SIZE,VERBOSE,limiter=NETWORK_LIMITER),
+                  transfers,[])
+    try:
+        TRANSFER_ENGINE.wait([name for name in TRANSFER_ENGINE.operations if name.startswith("upload")])
+        # The index and the catalog of a streamed site archive are written at the end of its upload
+        for file in LATE_FILES:
+            encryptFile(file)
+        reportUpload(tools.uploadFilesftp(ftppool,[(file + ".bin", FTP_PATH + "/" + os.path.basename(file) + ".bin") for file in LATE_FILES],FTP_BLOCK_SIZE,VERBOSE,TRANSFER_JOURNAL,limiter=NETWORK_LIMITER))
+        # The checksums are complete once all the files are written
+        writeChecksums()
+        reportUpload(tools.uploadFilesftp(ftppool,[(checksums_file + ".bin", FTP_PATH + "/" + os.path.basename(checksums_file) + ".bin")],FTP_BLOCK_SIZE,VERBOSE,TRANSFER_JOURNAL,limiter=NETWORK_LIMITER))
+        # ftpserver is used again once the expired slot is deleted
+        TRANSFER_ENGINE.wait()
+    except Exception as e:
+        if VERBOSE == 2:
+            print("Error during copy to " + FTP_PATH + ", " + str(e))
+        MESSAGE="""Backup failed
+        Error during copy to """ + FTP_PATH + ", " + str(e)
+        sendmail(mailfrom=SMTP_FROM,mailto=SMTP_TO,message=MESSAGE,subject="Backup of Wordpress of " + TODAY, smtphost=SMTP_HOST)
+        exit(1)
+    finally:
+        TRANSFER_ENGINE.close()
+        if DB_SNAPSHOT:
+            DB_SNAPSHOT.close()
+    ftppool.close()
+
+    if SITE_BACKUP == 'dedup':
+        REPORT.start("remote_rotation")
+        store.clear_pending(CHUNKS_TO_UPLOAD)
+        if VERBOSE == 2:
+            print("Delete " + str(len(CHUNKS_REMOVED)) + " chunks not used anymore")
+        try:
+            # A chunk deleted here may have been added again since by another site
+            with store.lock(exclusive=True):
+                tools.deleteChunksftp(ftpserver,[chunk_id for chunk_id in CHUNKS_REMOVED if not store.has(chunk_id)],CHUNK_FTP_PATH,VERBOSE)
+        except:
+            if VERBOSE == 2:
+                print("Error during delete of chunks in " + CHUNK_FTP_PATH)
+            MESSAGE="""Backup failed
+            Error during delete of chunks in """ + CHUNK_FTP_PATH
+            sendmail(mailfrom=SMTP_FROM,mailto=SMTP_TO,message=MESSAGE,subject="Backup of Wordpress of " + TODAY, smtphost=SMTP_HOST)
+            exit(1)
 
     tools.closeftp(ftpserver)
 
@@ -529,14 +1298,55 @@ else:
         print ("")
         print ("Copy to FTP Server completed")
 
-
-
-if VERBOSE >= 1:
-    print ("")
-    print ("Backup script completed")
-    print ("Your backups have also been created locally in " + BACKUP_PATH + " directory")
-
-MESSAGE="""Backup script completed
+else:
+    # BACKUP_DEST=LOCAL : the new chunks are already in the local chunk store
+    if SITE_BACKUP == 'dedup':
+        store.clear_pending(CHUNKS_TO_UPLOAD)
+    try:
+        writeChecksums()
+    except Exception as e:
+        if VERBOSE == 2:
+            print("Error during write of " + checksums_file + " : " + str(e))
+        MESSAGE="""Backup failed
+        Error during write of """ + checksums_file + " : " + str(e)
+        sendmail(mailfrom=SMTP_FROM,mailto=SMTP_TO,message=MESSAGE,subject="Backup of Wordpress of " + TODAY, smtphost=SMTP_HOST)
+        exit(1)
+    if VERBOSE >= 1:
+        print ("")
+        print ("Backup kept in the local folders only")
+
+REPORT.finish(True)
+if THROTTLE:
+    THROTTLE.stop()
+
+# The index is only saved once the differential backup is copied to BACKUP_DEST
+if SITE_BACKUP == 'diff':
+    fileindex.save_index(BACKUP_ROOT_PATH,NEW_INDEX)
+if BINLOG:
+    # An interrupted daily backup is still resumable
+    BINLOG_STATE["copied"] += BINLOG_LOGS
+    binlog.write_state(BACKUP_ROOT_PATH,BINLOG_STATE)
+else:
+    TRANSFER_JOURNAL.clear_backup()
+    # The binary logs written from now on follow this dump
+    if DB_POSITION:
+        binlog.write_state(BACKUP_ROOT_PATH,dict(DB_POSITION,date=TODAY,copied=[]))
+
+if NOLOCAL:
+    MESSAGE="""Backup script completed
+No local copy of the backups has been kept in """ + BACKUP_PATH + " directory"
+else:
+    MESSAGE="""Backup script completed
 Your backups have also been created locally in """ + BACKUP_PATH + " directory"
+if not COPY_ONLY:
+    MESSAGE += "\n" + DB_LOCKS.report()
+if THROTTLE:
+    MESSAGE += "\nThrottled " + str(THROTTLE.backoffs) + " times by the load of the system, rates lowered during " + str(round(THROTTLE.throttled)) + " s"
+MESSAGE += "\n\n" + REPORT.summary()
+
+# With --no-mail, the message is printed by sendmail
+if VERBOSE >= 1 and not NOMAIL:
+    print ("")
+    print (MESSAGE)
 
-tools.sendmail(mailfrom=SMTP_FROM,mailto=SMTP_TO,message=MESSAGE,subject="Backup of Wordpress of " + TODAY, smtphost=SMTP_HOST)
+sendmail(mailfrom=SMTP_FROM,mailto=SMTP_TO,message=MESSAGE,subject="Backup of Wordpress of " + TODAY, smtphost=SMTP_HOST)
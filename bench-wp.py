@@ -0,0 +1,562 @@
+#!/usr/bin/python3
+
+###########################################################
+#
+# This python script is used to benchmark backup-wp.py and restore-wp.py
+# on a synthetic Wordpress website and database.
+# The backups are copied to either :
+# - a local directory (BACKUP_DEST=LOCAL)
+# - a S3 stand-in (moto server started by the script, or MinIO)
+# - a local FTPS server (pyftpdlib started by the script)
+#
+# Needs a MySQL server where the database of the benchmark can be created
+#
+# Written by : Imane AMIRAT
+# Created date: Sept 30, 2021
+# Last modified: Oct 22, 2021
+# Tested with : Python 3.8
+# Script Revision: 0.9
+#
+##########################################################
+
+# Import required python libraries
+
+import os
+import sys
+import io
+import json
+import math
+import time
+import shutil
+import logging
+import importlib.util
+import random
+import socket
+import argparse
+import threading
+import subprocess
+import socketserver
+import fileindex
+import dbdump
+import pipeline
+import encrypt
+
+'''
+1) Generate in WORKDIR/site a Wordpress site : small text files (php, js, css)
+   in wp-admin, wp-includes and wp-content, and incompressible uploads, with a
+   log-normal distribution of sizes. Generate a dump of wp_posts, wp_postmeta
+   and wp_options and import it in DB_NAME. Everything is generated from --seed
+2) For each target : backup-wp.py, then the site folder and the database are
+   emptied and restore-wp.py restores them. The restored files are checked
+3) The duration, throughput, peak memory and disk used by each run are appended
+   to the results file, with the stages of the report of backup-wp.py, and
+   compared with the last run of the same benchmark, ie of the previous version
+
+With --encrypt, only encrypt.py is measured instead : a file of each size is
+encrypted by encrypt_stream (read and written through file objects) and by
+encrypt_file (memory-mapped), each one in a process of its own
+'''
+
+SCRIPT_PATH = os.path.dirname(os.path.abspath(__file__))
+
+# create parser
+parser = argparse.ArgumentParser()
+
+# add arguments to the parser
+parser.add_argument("--workdir",default="/tmp/bench-wp",help="Folder of the site, the backups and the logs of the benchmark, emptied first")
+parser.add_argument("--targets",default="local",help="Comma separated list of targets among local, s3 and ftp")
+parser.add_argument("--files",type=int,default=2000,help="Number of files of the site")
+parser.add_argument("--median-size",type=int,default=16,help="Median size of the files in KB")
+parser.add_argument("--size-sigma",type=float,default=1.5,help="Sigma of the log-normal distribution of the sizes of the files")
+parser.add_argument("--max-size",type=int,default=64,help="Maximum size of a file in MB")
+parser.add_argument("--incompressible",type=float,default=0.3,help="Fraction of the files with random content, ie uploaded images")
+parser.add_argument("--db-rows",type=int,default=20000,help="Number of rows of wp_posts")
+parser.add_argument("--seed",type=int,default=1,help="Seed of the generation of the site and of the database")
+parser.add_argument("--db-host",default="localhost",help="MySQL server of the database of the benchmark")
+parser.add_argument("--db-name",default="wpbench",help="Database of the benchmark, dropped and created again")
+parser.add_argument("--codec",default="gzip",help="CODEC of the backups")
+parser.add_argument("--site-backup",default="tar",choices=["tar","dedup","diff"],help="SITE_BACKUP of the backups")
+parser.add_argument("-s","--stream",action='store_true',help="Run backup-wp.py and restore-wp.py with --stream, targets s3 and ftp only")
+parser.add_argument("--repeat",type=int,default=1,help="Number of runs of each target")
+parser.add_argument("--s3-endpoint",help="URL of a S3 compatible storage (MinIO...), else a moto server is started")
+parser.add_argument("--ftp-server",help="host:port of a FTPS server, else a pyftpdlib server is started")
+parser.add_argument("--encrypt",help="Comma separated list of sizes in MB, only benchmark the encryption of files of these sizes")
+parser.add_argument("--results",default="bench-results.jsonl",help="File to which the results are appended")
+parser.add_argument("-v","--verbose",type=int,default=0,choices=[0,1,2],help="0 disable verbose, 1 minimal verbose, 2 debug mode")
+
+# parse the arguments
+args = parser.parse_args()
+
+VERBOSE = args.verbose
+WORKDIR = os.path.abspath(args.workdir)
+SITE_PATH = WORKDIR + "/site"
+TARGETS = args.targets.split(",")
+for target in TARGETS:
+    if target not in ["local","s3","ftp"]:
+        print("Bad target " + target + ", targets should be local, s3 or ftp only. Exiting")
+        exit(1)
+if args.stream and "local" in TARGETS:
+    print("--stream can not be used with the target local. Exiting")
+    exit(1)
+
+try:
+    ENCRYPT_SIZES = [int(size) for size in args.encrypt.split(",")] if args.encrypt else []
+except ValueError:
+    print("Bad --encrypt " + args.encrypt + ", it should be a comma separated list of sizes in MB. Exiting")
+    exit(1)
+
+# Parameters of the benchmark, the results are compared with the ones of the same parameters
+PARAMS = {key: getattr(args, key) for key in ["files","median_size","size_sigma","max_size","incompressible","db_rows","seed","codec","site_backup","stream"]}
+
+# Part 1 : Generate the site and the database
+
+WORDS = ("function", "return", "array", "string", "$post", "$wpdb", "echo", "if", "else", "foreach", "add_action",
+         "add_filter", "get_option", "esc_html", "wp_enqueue_script", "the_content", "null", "true", "false", "<div",
+         "class=", "</div>", "{", "}", "(", ");", "=>", "public", "static", "var", "const", "width:", "margin:", "0;")
+
+def textPool(rng, size):
+    '''
+    Return size bytes of text made of code-like words, compressible like the sources of Wordpress
+    '''
+    pool = io.StringIO()
+    length = 0
+    while length < size:
+        line = " ".join(rng.choice(WORDS) for index in range(rng.randint(3, 14))) + "\n"
+        pool.write(line)
+        length += len(line)
+    return pool.getvalue().encode()[:size]
+
+TEXT_POOL_SIZE = 4 * 1024 * 1024
+
+def textData(rng, pool, size):
+    '''
+    Return size bytes of text taken in pool from a random offset
+    '''
+    start = rng.randrange(len(pool))
+    data = (pool[start:] + pool * (size // len(pool) + 1))[:size]
+    return data
+
+CODE_FOLDERS = [("wp-includes", 40, [".php",".js",".css"]), ("wp-admin", 15, [".php",".js",".css"]),
+                ("wp-content/plugins", 20, [".php",".js"]), ("wp-content/themes", 10, [".php",".css"])]
+
+def generateSite(rng, pool):
+    '''
+    Write the files of the site in SITE_PATH, return their number and total size
+    '''
+    count = 0
+    total = 0
+    weights = [folder[1] for folder in CODE_FOLDERS]
+    with open(SITE_PATH + "/wp-config.php","wb") as f:
+        f.write(b"<?php\ndefine('DB_NAME', '" + args.db_name.encode() + b"');\n")
+    for index in range(args.files):
+        size = min(int(rng.lognormvariate(math.log(args.median_size * 1024), args.size_sigma)) + 1, args.max_size * 1048576)
+        if rng.random() < args.incompressible:
+            folder = "wp-content/uploads/" + str(2015 + rng.randrange(10)) + "/" + "%02d" % rng.randint(1, 12)
+            name = "image" + str(index) + rng.choice([".jpg",".png",".zip"])
+            data = rng.getrandbits(8 * size).to_bytes(size, "little")
+        else:
+            root, weight, extensions = rng.choices(CODE_FOLDERS, weights)[0]
+            folder = root + "/" + "module" + str(rng.randrange(max(1, args.files // 50)))
+            name = "file" + str(index) + rng.choice(extensions)
+            data = textData(rng, pool, size)
+        os.makedirs(SITE_PATH + "/" + folder, exist_ok=True)
+        with open(SITE_PATH + "/" + folder + "/" + name,"wb") as f:
+            f.write(data)
+        count += 1
+        total += size
+    return count, total
+
+def generateDump(rng, pool, path):
+    '''
+    Write to path a dump of wp_posts, wp_postmeta and wp_options with args.db_rows posts
+    '''
+    with open(path,"w") as f:
+        f.write("CREATE TABLE wp_posts (ID bigint(20) unsigned NOT NULL AUTO_INCREMENT, post_title text NOT NULL, "
+                "post_content longtext NOT NULL, post_date datetime NOT NULL, PRIMARY KEY (ID)) ENGINE=InnoDB;\n")
+        f.write("CREATE TABLE wp_postmeta (meta_id bigint(20) unsigned NOT NULL AUTO_INCREMENT, post_id bigint(20) unsigned NOT NULL, "
+                "meta_key varchar(255), meta_value longtext, PRIMARY KEY (meta_id), KEY post_id (post_id)) ENGINE=InnoDB;\n")
+        f.write("CREATE TABLE wp_options (option_name varchar(191) NOT NULL, option_value longtext NOT NULL, "
+                "PRIMARY KEY (option_name)) ENGINE=InnoDB;\n")
+        text = pool.decode().replace("\\", "").replace("'", "")
+        for start in range(1, args.db_rows + 1, 500):
+            rows = []
+            metas = []
+            for post in range(start, min(start + 500, args.db_rows + 1)):
+                offset = rng.randrange(len(text) - 4096)
+                content = text[offset:offset + rng.randint(200, 4000)]
+                rows.append("(%d,'%s','%s','2024-%02d-%02d 10:00:00')" % (post, text[offset:offset + 40].replace("\n", " "), content, rng.randint(1, 12), rng.randint(1, 28)))
+                metas.append("(%d,'_edit_lock','%d')" % (post, rng.randrange(10 ** 9)))
+            f.write("INSERT INTO wp_posts VALUES " + ",".join(rows) + ";\n")
+            f.write("INSERT INTO wp_postmeta (post_id,meta_key,meta_value) VALUES " + ",".join(metas) + ";\n")
+        f.write("INSERT INTO wp_options VALUES " + ",".join("('option%d','%s')" % (index, text[index * 50:index * 50 + 50]) for index in range(200)) + ";\n")
+
+def resetDatabase():
+    subprocess.run(["mysql", "-h", args.db_host, "-e", "DROP DATABASE IF EXISTS `" + args.db_name + "`; CREATE DATABASE `" + args.db_name + "`"], check=True)
+
+def siteHashes():
+    hashes = {}
+    for root, dirs, files in os.walk(SITE_PATH):
+        for name in files:
+            hashes[os.path.join(root, name)] = fileindex.file_hash(os.path.join(root, name))
+    return hashes
+
+def folderSize(path):
+    total = 0
+    for root, dirs, files in os.walk(path):
+        for name in files:
+            total += os.lstat(os.path.join(root, name)).st_size
+    return total
+
+# Part 2 : Services used by the targets
+
+def freePort():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+class SMTPSink(socketserver.StreamRequestHandler):
+    '''
+    SMTP server accepting and dropping the mails sent by backup-wp.py
+    '''
+    def handle(self):
+        self.wfile.write(b"220 bench-wp\r\n")
+        data = False
+        for line in self.rfile:
+            if data:
+                if line.rstrip(b"\r\n") == b".":
+                    data = False
+                    self.wfile.write(b"250 OK\r\n")
+                continue
+            command = line[:4].upper()
+            if command == b"DATA":
+                data = True
+                self.wfile.write(b"354 End data with <CR><LF>.<CR><LF>\r\n")
+            elif command == b"QUIT":
+                self.wfile.write(b"221 Bye\r\n")
+                return
+            else:
+                self.wfile.write(b"250 OK\r\n")
+
+def startSMTP():
+    server = socketserver.ThreadingTCPServer(("127.0.0.1", 0), SMTPSink)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return "127.0.0.1:" + str(server.server_address[1])
+
+def startS3():
+    '''
+    Return the endpoint, access key and secret key of the S3 target, starting a moto server if needed
+    '''
+    if args.s3_endpoint:
+        return args.s3_endpoint, os.environ.get("AWS_ACCESS_KEY_ID", "bench"), os.environ.get("AWS_SECRET_ACCESS_KEY", "bench")
+    port = freePort()
+    log = open(WORKDIR + "/logs/moto.log", "wb")
+    SERVICES.append(subprocess.Popen([sys.executable, "-m", "moto.server", "-p", str(port)], stdout=log, stderr=subprocess.STDOUT))
+    endpoint = "http://127.0.0.1:" + str(port)
+    for attempt in range(100):
+        try:
+            socket.create_connection(("127.0.0.1", port), 1).close()
+            break
+        except OSError:
+            time.sleep(0.1)
+    return endpoint, "bench", "bench"
+
+def startFTP():
+    '''
+    Return the server, user, password and local root folder of the FTP target, starting a pyftpdlib server if needed
+    '''
+    if args.ftp_server:
+        return args.ftp_server, os.environ.get("FTP_USER", "bench"), os.environ.get("FTP_PASSWD", "bench"), None
+    from pyftpdlib.authorizers import DummyAuthorizer
+    from pyftpdlib.handlers import TLS_FTPHandler
+    from pyftpdlib.servers import ThreadedFTPServer
+    logging.getLogger("pyftpdlib").setLevel(logging.WARNING)
+    root = WORKDIR + "/ftp"
+    os.makedirs(root)
+    subprocess.run(["openssl", "req", "-x509", "-newkey", "rsa:2048", "-nodes", "-days", "1", "-subj", "/CN=localhost",
+                    "-keyout", WORKDIR + "/ftp-key.pem", "-out", WORKDIR + "/ftp-cert.pem"], check=True, capture_output=True)
+    authorizer = DummyAuthorizer()
+    authorizer.add_user("bench", "bench", root, perm="elradfmwMT")
+    handler = TLS_FTPHandler
+    handler.certfile = WORKDIR + "/ftp-cert.pem"
+    handler.keyfile = WORKDIR + "/ftp-key.pem"
+    handler.authorizer = authorizer
+    handler.tls_data_required = True
+    handler.permit_privileged_ports = True
+    server = ThreadedFTPServer(("127.0.0.1", 0), handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return "127.0.0.1:" + str(server.address[1]), "bench", "bench", root
+
+# Part 3 : Run of the benchmark
+
+def writeConfig(target, path):
+    backup_path = WORKDIR + "/backup-" + target
+    lines = ["[WP]", "WP_PATH=" + SITE_PATH,
+             "[DB]", "DB_HOST=" + args.db_host, "DB_NAME=" + args.db_name,
+             "[SMTP]", "SMTP_HOST=" + SMTP_HOST, "SMTP_FROM=bench@localhost", "SMTP_TO=bench@localhost",
+             "[BACKUP]", "LOCALBKPATH=" + backup_path, "BACKUP_RETENTION=2", "SITE_BACKUP=" + args.site_backup]
+    if target == "local":
+        lines += ["BACKUP_DEST=LOCAL"]
+    elif target == "s3":
+        lines += ["BACKUP_DEST=S3", "S3_BUCKET=" + S3_BUCKET, "S3_ACCESS_KEY=" + S3_KEYS[0], "S3_SECRET_ACCESS_KEY=" + S3_KEYS[1],
+                  "S3_DEFAULT_REGION=us-east-1", "S3_ENDPOINT_URL=" + S3_ENDPOINT]
+    else:
+        lines += ["BACKUP_DEST=FTP", "FTP_SERVER=" + FTP_SERVER, "FTP_USER=" + FTP_USER, "FTP_PASSWD=" + FTP_PASSWD, "FTP_PATH=" + FTP_PATH]
+    lines += ["[ENCRYPT]", "KEYPATH=" + WORKDIR + "/AES.key",
+              "[COMPRESS]", "CODEC=" + args.codec,
+              "[REPORT]", "JSON_FILE=" + WORKDIR + "/report-" + target + ".json"]
+    with open(path,"w") as f:
+        f.write("\n".join(lines) + "\n")
+    return backup_path
+
+def exitCode(status):
+    '''
+    Return the exit code of a wait status, minus the signal number if the process was killed, as subprocess does
+    '''
+    if os.WIFEXITED(status):
+        return os.WEXITSTATUS(status)
+    return -os.WTERMSIG(status)
+
+def runCommand(command, log):
+    '''
+    Run command and return its duration, peak memory and exit code
+    The peak memory is the biggest one of the command and of its child processes
+    '''
+    with open(log,"ab") as f:
+        start = time.monotonic()
+        process = subprocess.Popen(command, stdout=f, stderr=subprocess.STDOUT, cwd=SCRIPT_PATH)
+        pid, status, rusage = os.wait4(process.pid, 0)
+        seconds = time.monotonic() - start
+    return {"seconds": round(seconds, 3), "peak_rss": rusage.ru_maxrss * 1024, "returncode": exitCode(status)}
+
+def runScript(script, options, log):
+    return runCommand([sys.executable, SCRIPT_PATH + "/" + script] + options, log)
+
+def remoteSize(target):
+    if target == "s3":
+        import boto3
+        s3 = boto3.client("s3", endpoint_url=S3_ENDPOINT, aws_access_key_id=S3_KEYS[0], aws_secret_access_key=S3_KEYS[1], region_name="us-east-1")
+        total = 0
+        for page in s3.get_paginator("list_objects_v2").paginate(Bucket=S3_BUCKET):
+            total += sum(item["Size"] for item in page.get("Contents", []))
+        return total
+    if target == "ftp" and FTP_ROOT:
+        return folderSize(FTP_ROOT)
+    # Not known for a remote FTP server, the backups are only in the local folders with the target local
+    return None
+
+def runTarget(target, run):
+    conf = WORKDIR + "/" + target + ".conf"
+    backup_path = writeConfig(target, conf)
+    log = WORKDIR + "/logs/" + target + "-" + str(run) + ".log"
+    stream = ["-s"] if args.stream else []
+    shutil.rmtree(backup_path, ignore_errors=True)
+    if VERBOSE >= 1:
+        print("Backup to " + target + ", run " + str(run))
+    backup = runScript("backup-wp.py", ["-f", conf] + stream, log)
+    backup["mb_per_s"] = round((SITE_BYTES + DUMP_BYTES) / 1048576 / backup["seconds"], 2)
+    backup["local_bytes"] = folderSize(backup_path)
+    backup["remote_bytes"] = remoteSize(target)
+    try:
+        with open(WORKDIR + "/report-" + target + ".json") as f:
+            backup["stages"] = json.load(f)["stages"]
+    except (OSError, ValueError):
+        backup["stages"] = []
+
+    # The site and the database are restored from scratch
+    shutil.rmtree(SITE_PATH)
+    resetDatabase()
+    if VERBOSE >= 1:
+        print("Restore from " + target + ", run " + str(run))
+    restore = runScript("restore-wp.py", ["-f", conf] + (["-l"] if target == "local" else []) + stream, log)
+    restore["mb_per_s"] = round((SITE_BYTES + DUMP_BYTES) / 1048576 / restore["seconds"], 2)
+    # Files downloaded in the RESTORE folder
+    restore["local_bytes"] = sum(folderSize(backup_path + "/" + name) for name in os.listdir(backup_path) if name.startswith("RESTORE-")) if os.path.isdir(backup_path) else 0
+    restored = siteHashes() if os.path.isdir(SITE_PATH) else {}
+    restore["files_ok"] = sum(1 for path, content_hash in SITE.items() if restored.get(path) == content_hash)
+    restore["files_missing"] = len(SITE) - restore["files_ok"]
+    try:
+        restore["db_rows"] = int(dbdump.query(args.db_host, args.db_name, "SELECT COUNT(*) FROM wp_posts")[0][0])
+    except Exception:
+        restore["db_rows"] = None
+    return {"version": VERSION, "date": time.strftime("%Y-%m-%d %H:%M:%S"), "target": target, "run": run,
+            "params": PARAMS, "site_bytes": SITE_BYTES, "dump_bytes": DUMP_BYTES, "backup": backup, "restore": restore}
+
+def previousResult(result):
+    '''
+    Return the last result of the same benchmark by another version, or None
+    '''
+    previous = None
+    with open(args.results) as f:
+        for line in f:
+            old = json.loads(line)
+            if old["params"] == result["params"] and old["target"] == result["target"] and old["version"] != result["version"]:
+                previous = old
+    return previous
+
+def change(value, old):
+    if old is None or not old:
+        return ""
+    return "%+.0f%%" % ((value - old) * 100 / old)
+
+# Encryption of the file sys.argv[1] with the key sys.argv[2], in a process of its own to measure its peak memory
+ENCRYPT_METHODS = {
+    "encrypt_stream": "import sys, encrypt\n"
+                      "with open(sys.argv[1],'rb') as fin, open(sys.argv[1] + '.bin','wb') as fout:\n"
+                      "    encrypt.encrypt_stream(fin, fout, open(sys.argv[2],'rb').read())",
+    "encrypt_file": "import sys, encrypt\n"
+                    "encrypt.encrypt_file(sys.argv[1], open(sys.argv[2],'rb').read())",
+}
+
+def writeInput(path, size):
+    '''
+    Write a file of size MB of incompressible data, made of a random block repeated
+    '''
+    block = os.urandom(16 * 1048576)
+    with open(path,"wb") as f:
+        remaining = size * 1048576
+        while remaining:
+            f.write(block[:remaining])
+            remaining -= min(remaining, len(block))
+
+def benchEncrypt():
+    '''
+    Encrypt a file of each size of ENCRYPT_SIZES with each one of ENCRYPT_METHODS, print and append the results
+    '''
+    path = WORKDIR + "/encrypt-input"
+    results = []
+    for size in ENCRYPT_SIZES:
+        if VERBOSE >= 1:
+            print("Generation of a file of " + str(size) + " MB")
+        writeInput(path, size)
+        # The output of encrypt_stream and encrypt_file has the same size
+        expected = encrypt.HEADER_SIZE + size * 1048576 + (size * 1048576 // encrypt.CHUNK_SIZE + 1) * encrypt.FRAME_OVERHEAD
+        for run in range(1, args.repeat + 1):
+            for method, code in ENCRYPT_METHODS.items():
+                if VERBOSE >= 1:
+                    print("Encryption of " + str(size) + " MB by " + method + ", run " + str(run))
+                values = runCommand([sys.executable, "-c", code, path, WORKDIR + "/AES.key"], WORKDIR + "/logs/encrypt.log")
+                values["mb_per_s"] = round(size / values["seconds"], 2)
+                values["output_ok"] = os.path.exists(path + ".bin") and os.path.getsize(path + ".bin") == expected
+                if os.path.exists(path + ".bin"):
+                    os.remove(path + ".bin")
+                result = {"version": VERSION, "date": time.strftime("%Y-%m-%d %H:%M:%S"), "target": method, "run": run,
+                          "params": {"encrypt": size}, "encrypt": values}
+                results.append(result)
+                with open(args.results,"a") as f:
+                    f.write(json.dumps(result) + "\n")
+        os.remove(path)
+
+    print("")
+    print("Version " + VERSION + " : encryption of files of " + ", ".join(str(size) for size in ENCRYPT_SIZES) + " MB")
+    print("%-15s %8s %9s %8s %10s %8s" % ("Method", "MB", "Seconds", "MB/s", "Peak RSS", "Status"))
+    failed = False
+    for result in results:
+        previous = previousResult(result)
+        values = result["encrypt"]
+        old = previous["encrypt"] if previous else {}
+        status = "ok" if values["returncode"] == 0 and values["output_ok"] else "failed"
+        failed = failed or status != "ok"
+        print("%-15s %8d %9.1f %8.1f %7.0f MB %8s   %s" % (result["target"], result["params"]["encrypt"], values["seconds"], values["mb_per_s"],
+                                                          values["peak_rss"] / 1048576, status,
+                                                          (" time " + change(values["seconds"], old.get("seconds")) + " vs " + previous["version"]) if previous else ""))
+    print("Results appended to " + args.results + ", logs in " + WORKDIR + "/logs")
+    return failed
+
+def gitVersion():
+    try:
+        return subprocess.run(["git", "describe", "--always", "--dirty"], cwd=SCRIPT_PATH, capture_output=True, check=True).stdout.decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+if os.path.exists(WORKDIR):
+    shutil.rmtree(WORKDIR)
+os.makedirs(SITE_PATH)
+os.makedirs(WORKDIR + "/logs")
+with open(WORKDIR + "/AES.key","wb") as f:
+    f.write(os.urandom(32))
+VERSION = gitVersion()
+
+if ENCRYPT_SIZES:
+    exit(1 if benchEncrypt() else 0)
+
+if VERBOSE >= 1:
+    print("Generation of the site and of the database in " + WORKDIR)
+RNG = random.Random(args.seed)
+POOL = textPool(RNG, TEXT_POOL_SIZE)
+FILE_COUNT, SITE_BYTES = generateSite(RNG, POOL)
+generateDump(RNG, POOL, WORKDIR + "/seed.sql")
+DUMP_BYTES = os.path.getsize(WORKDIR + "/seed.sql")
+SITE = siteHashes()
+try:
+    resetDatabase()
+    with open(WORKDIR + "/seed.sql","rb") as f:
+        pipeline.mysqlimport(f, args.db_host, args.db_name)
+except Exception as e:
+    print("Error during import of the database in " + args.db_name + " of " + args.db_host + " : " + str(e) + ". Exiting")
+    exit(1)
+if VERBOSE >= 1:
+    print("%d files, %.1f MB, dump of %.1f MB" % (len(SITE), SITE_BYTES / 1048576, DUMP_BYTES / 1048576))
+
+# Services of the targets, stopped at the end
+SERVICES = []
+SMTP_HOST = startSMTP()
+try:
+    # The targets whose server can not be started are skipped
+    if "s3" in TARGETS and not args.s3_endpoint and importlib.util.find_spec("moto") is None:
+        print("moto is not installed and --s3-endpoint is not given, target s3 skipped")
+        TARGETS.remove("s3")
+    if "ftp" in TARGETS and not args.ftp_server and importlib.util.find_spec("pyftpdlib") is None:
+        print("pyftpdlib is not installed and --ftp-server is not given, target ftp skipped")
+        TARGETS.remove("ftp")
+    if "s3" in TARGETS:
+        S3_ENDPOINT, *S3_KEYS = startS3()
+        S3_BUCKET = "bench-wp-" + str(os.getpid())
+        import boto3
+        boto3.client("s3", endpoint_url=S3_ENDPOINT, aws_access_key_id=S3_KEYS[0], aws_secret_access_key=S3_KEYS[1], region_name="us-east-1").create_bucket(Bucket=S3_BUCKET)
+    if "ftp" in TARGETS:
+        FTP_SERVER, FTP_USER, FTP_PASSWD, FTP_ROOT = startFTP()
+        FTP_PATH = "bench-wp-" + str(os.getpid())
+        if FTP_ROOT:
+            os.makedirs(FTP_ROOT + "/" + FTP_PATH)
+        else:
+            import tools
+            ftp = tools.connectftp(FTP_SERVER, FTP_USER, FTP_PASSWD)
+            ftp.mkd(FTP_PATH)
+            tools.closeftp(ftp)
+
+    RESULTS = []
+    for run in range(1, args.repeat + 1):
+        for target in TARGETS:
+            result = runTarget(target, run)
+            RESULTS.append(result)
+            with open(args.results,"a") as f:
+                f.write(json.dumps(result) + "\n")
+finally:
+    for service in SERVICES:
+        service.terminate()
+        service.wait()
+
+# Part 4 : Print the results and the difference with the last run of the same benchmark by another version
+
+print("")
+print("Version " + VERSION + " : %d files, %.1f MB, dump of %.1f MB, codec %s, site %s%s" % (len(SITE), SITE_BYTES / 1048576, DUMP_BYTES / 1048576, args.codec, args.site_backup, ", stream" if args.stream else ""))
+print("%-7s %-8s %9s %8s %10s %12s %12s %8s" % ("Target", "Phase", "Seconds", "MB/s", "Peak RSS", "Local MB", "Remote MB", "Status"))
+FAILED = False
+for result in RESULTS:
+    previous = previousResult(result)
+    for phase in ["backup", "restore"]:
+        values = result[phase]
+        old = previous[phase] if previous else {}
+        if phase == "backup":
+            status = "ok" if values["returncode"] == 0 else "failed"
+        else:
+            status = "ok" if values["returncode"] == 0 and values["files_missing"] == 0 and values["db_rows"] == args.db_rows else "failed"
+        FAILED = FAILED or status != "ok"
+        remote = values.get("remote_bytes")
+        print("%-7s %-8s %9.1f %8.1f %7.0f MB %12.1f %12s %8s   %s" % (result["target"], phase, values["seconds"], values["mb_per_s"], values["peak_rss"] / 1048576,
+                                                                    values["local_bytes"] / 1048576, "%.1f" % (remote / 1048576) if remote is not None else "-", status,
+                                                                    (" time " + change(values["seconds"], old.get("seconds")) + " vs " + previous["version"]) if previous else ""))
+print("Results appended to " + args.results + ", logs in " + WORKDIR + "/logs")
+if FAILED:
+    exit(1)
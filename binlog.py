@@ -0,0 +1,132 @@
+import os
+import json
+import time
+import shutil
+import subprocess
+import compress
+import encrypt
+import dbdump
+import pipeline
+
+'''
+Point-in-time recovery of the database with the binary logs of MySQL
+
+With DB_BINLOG=yes, the daily dump is made with --master-data=2 so that it
+gives the binary log file and the position of the snapshot. This position is
+kept in LOCALBKPATH/binlog.json once the backup is copied.
+
+backup-wp.py --binlog, run for instance every hour, closes the current binary
+log (FLUSH BINARY LOGS) and copies the binary logs written since the daily dump
+and not copied yet. Each one is compressed and encrypted in the folder DAYJ,
+next to the dump, with the index binlogs.json listing them :
+
+    {"start": {"file": ..., "position": ...},
+     "logs": [{"name": ..., "file": ..., "flushed": "YYYY-MM-DD HH:MM:SS"}, ...]}
+
+A log flushed at a given time only holds events older than this time.
+
+restore-wp.py --until "YYYY-MM-DD HH:MM:SS" imports the dump, then replays the
+binary logs from the position of the dump up to this time with mysqlbinlog.
+'''
+
+STATE_FILE = "binlog.json"
+INDEX_FILE = "binlogs.json"
+TIME_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+
+def read_state(folder):
+    '''
+    Return the binary log position of the last daily dump, or None
+    '''
+    try:
+        with open(os.path.join(folder, STATE_FILE)) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+
+def write_state(folder, state):
+    with open(os.path.join(folder, STATE_FILE + ".tmp"), "w") as f:
+        json.dump(state, f)
+    os.replace(os.path.join(folder, STATE_FILE + ".tmp"), os.path.join(folder, STATE_FILE))
+
+
+def flush_logs(host, name):
+    '''
+    Close the current binary log and return the names of the closed binary logs
+    '''
+    dbdump.query(host, name, "FLUSH BINARY LOGS")
+    logs = [row[0] for row in dbdump.query(host, name, "SHOW BINARY LOGS")]
+    # The last one is the new current binary log
+    return logs[:-1]
+
+
+def logs_to_copy(state, logs):
+    '''
+    Return the binary logs written since the dump of state and not copied yet
+    '''
+    if state["file"] not in logs:
+        raise RuntimeError("Binary log " + state["file"] + " of the daily dump not found on the server, it has been purged")
+    return [log for log in logs[logs.index(state["file"]):] if log not in state["copied"]]
+
+
+def copy_log(host, log, path, codec=compress.DEFAULT_CODEC, level=None):
+    '''
+    Read the binary log from the server and write it compressed to path
+    '''
+    folder = os.path.dirname(path)
+    subprocess.run(["mysqlbinlog", "--read-from-remote-server", "--host=" + host, "--raw",
+                    "--result-file=" + folder + "/", log], check=True)
+    compress.compress_file(os.path.join(folder, log), path, codec, level, 1)
+    os.remove(os.path.join(folder, log))
+
+
+def write_index(path, index):
+    with open(path, "w") as f:
+        json.dump(index, f)
+
+
+def read_index(path, key):
+    '''
+    Return the index of the binary logs read from its encrypted file
+    '''
+    with open(path, "rb") as f:
+        return json.loads(encrypt.DecryptReader(f, key).read())
+
+
+def select_logs(index, until):
+    '''
+    Return the logs of the index needed to replay the events up to until
+    '''
+    selected = []
+    for log in index["logs"]:
+        selected.append(log)
+        if log["flushed"] >= until:
+            break
+    return selected
+
+
+def replay(host, name, paths, position, until=None):
+    '''
+    Replay with mysqlbinlog the binary logs paths, the first one from position, up to until
+    '''
+    # Only the events of the database name are replayed
+    args = ["mysqlbinlog", "--database=" + name, "--start-position=" + str(position)]
+    if until:
+        args.append("--stop-datetime=" + until)
+    process = subprocess.Popen(args + paths, stdout=subprocess.PIPE)
+    try:
+        pipeline.mysqlimport(process.stdout, host, name)
+    finally:
+        process.stdout.close()
+        if process.wait() != 0:
+            raise RuntimeError("mysqlbinlog exited with code " + str(process.returncode))
+
+
+def decompress_log(path, dest, codec=compress.DEFAULT_CODEC):
+    with open(path, "rb") as fin, open(dest, "wb") as fout:
+        shutil.copyfileobj(compress.open_reader(codec, fin), fout, pipeline.BUFFER_SIZE)
+
+
+def now():
+    return time.strftime(TIME_FORMAT)
@@ -0,0 +1,212 @@
+#!/usr/bin/python3
+
+###########################################################
+#
+# This python script is used to list the backups of the Wordpress website
+# and to find the files of the site in them.
+# It reads the catalog of each backup, without the archives, from either :
+# - AWS S3
+# or
+# - FTP server
+# or
+# - the local backup folders
+#
+# Written by : Imane AMIRAT
+# Created date: Sept 30, 2021
+# Last modified: Oct 22, 2021
+# Tested with : Python 3.8
+# Script Revision: 0.9
+#
+##########################################################
+
+# Import required python libraries
+
+import io
+import time
+import configparser
+import json
+import boto3
+import ftplib
+import tools
+import argparse
+import encrypt
+import archive
+import catalog
+from botocore.config import Config
+
+
+# By Default, this script will read configuration from file /etc/backup-wp.conf
+'''
+1) Read the metadata and the catalog of each backup of BACKUP_RETENTION
+2) list : print the date, the site and the database of each backup
+   find : print the files of the site matching the glob patterns in each backup
+'''
+# create parser
+parser = argparse.ArgumentParser()
+
+# add arguments to the parser
+parser.add_argument("command",choices=["list","find"],help="list the backups, or find the files matching GLOB in the backups")
+parser.add_argument("patterns",nargs="*",metavar="GLOB",help="Glob pattern of the files to find, relative to WP_PATH")
+parser.add_argument("-l","--local",action='store_true',help="Read the catalogs of the local backup folders only")
+parser.add_argument("-v","--verbose",type=int,default=0,choices=[0,1,2],help="0 disable verbose, 1 minimal verbose, 2 debug mode")
+parser.add_argument("-f","--config",default="/etc/backup-wp.conf",help="Configuration file, /etc/backup-wp.conf by default")
+
+# parse the arguments
+args = parser.parse_args()
+
+CONFIG_FILE = args.config
+
+config = configparser.ConfigParser()
+config.read(CONFIG_FILE)
+
+WP_PATH = config.get('WP','WP_PATH')
+
+BACKUP_DEST = config.get('BACKUP','BACKUP_DEST')
+BACKUP_PATH = config.get('BACKUP','LOCALBKPATH')
+BACKUP_RETENTION = config.get('BACKUP','BACKUP_RETENTION')
+
+ENCRYPTION_KEYPATH = config.get('ENCRYPT','KEYPATH')
+
+VERBOSE = args.verbose
+
+if args.command == 'find' and not args.patterns:
+    print("find needs at least one GLOB pattern. Exiting")
+    exit(1)
+
+if args.local:
+    BACKUP_DEST = 'LOCAL'
+
+if BACKUP_DEST == 'S3':
+    S3_BUCKET = config.get('BACKUP','S3_BUCKET')
+    S3_ACCESS_KEY = config.get('BACKUP','S3_ACCESS_KEY')
+    S3_SECRET_ACCESS_KEY = config.get('BACKUP','S3_SECRET_ACCESS_KEY')
+    S3_DEFAULT_REGION = config.get('BACKUP','S3_DEFAULT_REGION')
+    S3_ENDPOINT_URL = config.get('BACKUP','S3_ENDPOINT_URL',fallback=None)
+    S3_LAYOUT = config.get('BACKUP','S3_LAYOUT',fallback='slots')
+elif BACKUP_DEST == 'FTP':
+    FTP_SERVER = config.get('BACKUP','FTP_SERVER')
+    FTP_USER = config.get('BACKUP','FTP_USER')
+    FTP_PASSWD = config.get('BACKUP','FTP_PASSWD')
+    FTP_PATH = config.get('BACKUP','FTP_PATH')
+elif BACKUP_DEST == 'LOCAL':
+    pass
+else:
+    print("Bad value in " + CONFIG_FILE + ". Value of BACKUP_DEST should be S3, FTP or LOCAL only. Exiting")
+    exit(1)
+
+fdKey = open(ENCRYPTION_KEYPATH,'rb')
+ENCRYPTION_KEY = fdKey.read()
+
+MetadataFilename = "backup.json.bin"
+SLOTS = ["DAYJ"] + ["DAYJ-" + str(index) for index in range(1,int(BACKUP_RETENTION))]
+
+# Part 1 : Read the metadata and the catalog of each backup
+# Only these small files are read, the archives are not
+
+if BACKUP_DEST == 'S3':
+    s3_client = boto3.client(
+        's3',
+        endpoint_url=S3_ENDPOINT_URL,
+        aws_access_key_id=S3_ACCESS_KEY,
+        aws_secret_access_key=S3_SECRET_ACCESS_KEY,
+        config=Config(region_name=S3_DEFAULT_REGION,retries={'max_attempts': 10,'mode': 'standard'})
+    )
+    # Prefix of DAYJ, DAYJ-1..., read from the index with the dated layout
+    PATHS = tools.slotPathsS3(s3_client,S3_BUCKET,S3_LAYOUT,BACKUP_RETENTION)
+
+    def readFile(slot, filename):
+        try:
+            return io.BytesIO(s3_client.get_object(Bucket=S3_BUCKET,Key=PATHS[slot] + "/" + filename)["Body"].read())
+        except s3_client.exceptions.NoSuchKey:
+            return None
+
+elif BACKUP_DEST == 'FTP':
+    ftpserver = tools.connectftp(FTP_SERVER,FTP_USER,FTP_PASSWD)
+    PATHS = [FTP_PATH + "/" + slot for slot in SLOTS]
+
+    def readFile(slot, filename):
+        data = io.BytesIO()
+        try:
+            ftpserver.retrbinary("RETR " + PATHS[slot] + "/" + filename,data.write,tools.FTP_BLOCK_SIZE)
+        except ftplib.error_perm:
+            return None
+        data.seek(0)
+        return data
+
+else:
+    PATHS = [BACKUP_PATH + "/" + slot for slot in SLOTS]
+
+    def readFile(slot, filename):
+        try:
+            return open(PATHS[slot] + "/" + filename,"rb")
+        except FileNotFoundError:
+            return None
+
+# [slot, metadata, catalog] of each backup, the metadata or the catalog is None if missing
+BACKUPS = []
+for slot in range(min(len(PATHS),len(SLOTS))):
+    if VERBOSE == 2:
+        print("Reading the catalog of " + PATHS[slot])
+    metadata = None
+    backup_catalog = None
+    try:
+        fin = readFile(slot,MetadataFilename)
+        if fin:
+            with fin:
+                metadata = json.loads(encrypt.DecryptReader(fin,ENCRYPTION_KEY).read())
+        # Backups made by previous versions have no catalog
+        fin = readFile(slot,metadata["catalog"] + ".bin") if metadata and "catalog" in metadata else None
+        if fin:
+            with fin:
+                backup_catalog = catalog.read_catalog(fin,ENCRYPTION_KEY,metadata["codec"])
+    except Exception as e:
+        print("Error during read of the catalog of " + PATHS[slot] + " : " + str(e) + ". Exiting")
+        exit(1)
+    BACKUPS.append([SLOTS[slot],metadata,backup_catalog])
+
+if BACKUP_DEST == 'FTP':
+    tools.closeftp(ftpserver)
+
+# Part 2 : Print the backups or the files found
+
+def formatSize(size):
+    return str(round(size / 1048576,1)) + " MB"
+
+if args.command == 'list':
+    for slot, metadata, backup_catalog in BACKUPS:
+        if metadata is None:
+            print(slot.ljust(8) + "no backup")
+        elif backup_catalog is None:
+            print(slot.ljust(8) + metadata.get("date","").ljust(10) + "no catalog")
+        else:
+            files, size, tables, rows = catalog.summary(backup_catalog)
+            site = backup_catalog["site"]
+            site_mode = site["mode"] + (" (" + site["base"] + ")" if "base" in site else "")
+            print(slot.ljust(8) + backup_catalog["date"].ljust(10) + backup_catalog["codec"].ljust(6)
+                  + site_mode.ljust(12) + (str(files) + " files").rjust(12) + formatSize(size).rjust(12)
+                  + "  " + backup_catalog["database"]["mode"].ljust(8) + (str(tables) + " tables").rjust(11) + (str(rows) + " rows").rjust(14))
+else:
+    select = archive.selector(args.patterns,None,WP_PATH)
+    found = 0
+    for slot, metadata, backup_catalog in BACKUPS:
+        if metadata is not None and backup_catalog is None:
+            if VERBOSE >= 1:
+                print(slot.ljust(8) + metadata.get("date","").ljust(10) + "no catalog")
+            continue
+        if backup_catalog is None:
+            continue
+        chunked = backup_catalog["site"]["mode"] == "dedup"
+        for path, size, mtime, content_hash, place in catalog.find(backup_catalog,select):
+            if chunked:
+                where = str(place) + " chunks"
+            elif place is None:
+                # Unchanged since an older differential backup
+                where = "older backup"
+            else:
+                where = "block " + str(place)
+            print(slot.ljust(8) + backup_catalog["date"].ljust(10) + time.strftime("%Y-%m-%d %H:%M:%S",time.localtime(mtime))
+                  + str(size).rjust(12) + "  " + (content_hash or "")[:16] + "  " + where.ljust(14) + "/" + path)
+            found += 1
+    if not found:
+        print("No file matching " + " ".join(args.patterns))
+        exit(1)
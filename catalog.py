@@ -0,0 +1,117 @@
+import json
+import encrypt
+import compress
+
+'''
+Catalog of a backup
+
+backup-wp.py writes in each backup the catalog catalog.json, compressed and
+encrypted like the other files of the backup. It describes the backup without
+its archives :
+
+    {"version": 1, "date": "YYYYMMDD", "codec": ...,
+     "site": {"mode": "tar", "diff" or "dedup", "base": "full" or "diff" (diff only),
+              "layout": {"blocks": ...} or {"chunks": ...},
+              "fields": ["path", "size", "mtime", "hash", "block" or "chunks"],
+              "files": [[...], ...]},
+     "database": {"mode": "single" or "tables", "parts": ..., "tables": [[name, engine, rows], ...]}}
+
+files lists the regular files of the site at the time of the backup with their
+size, modification time in seconds and hash of their content (BLAKE2b, see
+fileindex.file_hash). The last field gives the place of the content :
+
+    block  : block of the indexed site archive holding the file (see archive.py).
+             For a differential backup, null if the file did not change since
+             the previous backup and is in the archive of an older backup
+    chunks : number of chunks of the file in the chunk store (see dedup.py)
+
+layout gives the number of blocks of the site archive, or the number of chunks
+of the chunk store used by the backup.
+The number of rows of the InnoDB tables is an estimate of the server.
+
+catalog-wp.py lists the backups of the retention slots and finds files in them
+by fetching only the metadata and the catalog of each backup.
+'''
+
+CATALOG_FILE = "catalog.json"
+
+
+def files_from_archive(files):
+    '''
+    Return the files of a catalog from the files added to an indexed archive (archive.write_archive)
+    '''
+    return sorted(files)
+
+
+def files_from_index(index, archive_files):
+    '''
+    Return the files of a catalog from the file-state index of a differential backup
+    (fileindex.scan) and the files added to its archive
+    '''
+    added = {file[0]: file for file in archive_files}
+    files = []
+    for path, (size, mtime, inode, content_hash) in index["files"].items():
+        name = path.lstrip("/")
+        if name in added:
+            files.append(added[name])
+        elif content_hash != "dir" and not content_hash.startswith("link:"):
+            files.append([name, size, mtime // 1000000000, content_hash, None])
+    return sorted(files)
+
+
+def files_from_manifest(manifest):
+    '''
+    Return the files of a catalog from the manifest of a deduplicated backup
+    '''
+    return sorted([entry["path"], entry["size"], entry["mtime"] // 1000000000, entry.get("hash"), len(entry["chunks"])]
+                  for entry in manifest["entries"] if entry["type"] == "file")
+
+
+def new_catalog(date, codec, site_mode, files, layout, database_mode, tables, parts=None, site_base=None):
+    '''
+    Return the catalog of a backup
+        - files: files of the site, see files_from_archive, files_from_index and files_from_manifest
+        - layout: number of blocks of the site archive or of chunks used, see the format above
+        - tables: [name, engine, rows] of each table (dbdump.table_rows)
+        - parts: number of parts of a database dumped table by table
+    '''
+    site = {"mode": site_mode,
+            "layout": layout,
+            "fields": ["path", "size", "mtime", "hash", "chunks" if site_mode == "dedup" else "block"],
+            "files": files}
+    if site_base:
+        site["base"] = site_base
+    database = {"mode": database_mode, "tables": tables}
+    if parts is not None:
+        database["parts"] = parts
+    return {"version": 1, "date": date, "codec": codec, "site": site, "database": database}
+
+
+def write_catalog(catalog, path, codec=compress.DEFAULT_CODEC):
+    with open(path, "wb") as f:
+        compressor = compress.open_writer(codec, f)
+        compressor.write(json.dumps(catalog).encode())
+        compressor.close()
+
+
+def read_catalog(fin, key, codec=compress.DEFAULT_CODEC):
+    '''
+    Return the catalog read from its encrypted stream fin
+    '''
+    return json.loads(compress.open_reader(codec, encrypt.DecryptReader(fin, key)).read())
+
+
+def summary(catalog):
+    '''
+    Return the number of files and their total size, the number of tables and their total number of rows
+    '''
+    files = catalog["site"]["files"]
+    tables = catalog["database"]["tables"]
+    return len(files), sum(file[1] for file in files), len(tables), sum(table[2] for table in tables)
+
+
+def find(catalog, select):
+    '''
+    Return the files of the catalog whose path is selected by select (archive.selector)
+    '''
+    return [file for file in catalog["site"]["files"] if select(file[0])]
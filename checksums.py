@@ -0,0 +1,162 @@
+import os
+import json
+import random
+import hashlib
+
+'''
+Checksums of the encrypted files of a backup, checked by verify-wp.py
+
+The checksums are computed on the .bin files while they are written, so that
+the copies in the local folders and on BACKUP_DEST are checked without being
+decrypted : size, BLAKE2b of the whole file and BLAKE2b of each block of
+BLOCK_SIZE bytes. A truncated or corrupted copy is found by reading a sample of
+its blocks with ranged reads, instead of downloading the whole backup.
+
+The chunks of a deduplicated backup are named after the keyed BLAKE2b of their
+content, only their size is recorded.
+
+Format of checksums.json :
+
+    {"date": ..., "files": {name of the .bin file: digest}, "chunks": {chunk id: size}}
+    digest : {"size": ..., "blake2b": ..., "block_size": ..., "blocks": [...], "local": true}
+
+"local" is false for the files streamed with --no-local, only copied to BACKUP_DEST
+'''
+
+CHECKSUMS_FILE = "checksums.json"
+BLOCK_SIZE = 4 * 1024 * 1024
+BLOCK_DIGEST_SIZE = 16
+READ_SIZE = 1024 * 1024
+
+
+def block_hash(data):
+    return hashlib.blake2b(data, digest_size=BLOCK_DIGEST_SIZE).hexdigest()
+
+
+class Digest:
+    '''
+    Writable file object computing the checksums of the data written to it
+    Used as an output of pipeline.TeeWriter next to the .bin file
+    '''
+    def __init__(self, local=True, block_size=BLOCK_SIZE):
+        self.local = local
+        self.block_size = block_size
+        self.size = 0
+        self.hash = hashlib.blake2b()
+        self.block = hashlib.blake2b(digest_size=BLOCK_DIGEST_SIZE)
+        self.block_fill = 0
+        self.blocks = []
+
+    def write(self, data):
+        self.hash.update(data)
+        self.size += len(data)
+        view = memoryview(data)
+        while view:
+            size = min(len(view), self.block_size - self.block_fill)
+            self.block.update(view[:size])
+            self.block_fill += size
+            view = view[size:]
+            if self.block_fill == self.block_size:
+                self.blocks.append(self.block.hexdigest())
+                self.block = hashlib.blake2b(digest_size=BLOCK_DIGEST_SIZE)
+                self.block_fill = 0
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def to_dict(self):
+        blocks = self.blocks + ([self.block.hexdigest()] if self.block_fill else [])
+        return {"size": self.size, "blake2b": self.hash.hexdigest(), "block_size": self.block_size,
+                "blocks": blocks, "local": self.local}
+
+
+def file_digest(path, block_size=BLOCK_SIZE):
+    '''
+    Return the checksums of the local file path
+    '''
+    digest = Digest(True, block_size)
+    with open(path, "rb") as f:
+        while True:
+            data = f.read(READ_SIZE)
+            if not data:
+                break
+            digest.write(data)
+    return digest.to_dict()
+
+
+def block_range(digest, index):
+    '''
+    Return the offset and the size of the block index of the file described by digest
+    '''
+    offset = index * digest["block_size"]
+    return offset, min(digest["block_size"], digest["size"] - offset)
+
+
+def sample_blocks(digest, samples):
+    '''
+    Return the indexes of samples blocks of the file : the first, the last and others at random
+    The last block is the first one damaged by a truncated copy
+    '''
+    count = len(digest["blocks"])
+    if samples >= count:
+        return list(range(count))
+    if samples <= 0:
+        return []
+    indexes = {0, count - 1} if samples > 1 else {count - 1}
+    indexes.update(random.sample(range(1, count - 1), max(0, samples - len(indexes))))
+    return sorted(indexes)
+
+
+def check_copy(digest, size, read_range, samples):
+    '''
+    Return the errors found in a copy of the file described by digest
+        - size: size of the copy, None if it is missing
+        - read_range: function called with an offset and a size, returning these bytes of the copy
+        - samples: number of blocks read, all of them if None
+    '''
+    if size is None:
+        return ["missing"]
+    if size != digest["size"]:
+        return ["size " + str(size) + " instead of " + str(digest["size"])]
+    errors = []
+    indexes = range(len(digest["blocks"])) if samples is None else sample_blocks(digest, samples)
+    for index in indexes:
+        offset, length = block_range(digest, index)
+        if block_hash(read_range(offset, length)) != digest["blocks"][index]:
+            errors.append("block " + str(index) + " at offset " + str(offset) + " differs")
+    return errors
+
+
+def check_full(digest, fileobj):
+    '''
+    Return the errors found by reading the whole copy of the file described by digest from fileobj
+    '''
+    copy = Digest(digest["local"], digest["block_size"])
+    while True:
+        data = fileobj.read(READ_SIZE)
+        if not data:
+            break
+        copy.write(data)
+    if copy.size != digest["size"]:
+        return ["size " + str(copy.size) + " instead of " + str(digest["size"])]
+    if copy.hash.hexdigest() != digest["blake2b"]:
+        blocks = copy.to_dict()["blocks"]
+        return ["block " + str(index) + " differs" for index in range(len(blocks)) if blocks[index] != digest["blocks"][index]] or ["BLAKE2b differs"]
+    return []
+
+
+def read_checksums(path):
+    '''
+    Return the checksums of the local file path, or a new one if it does not exist
+    '''
+    if not os.path.exists(path):
+        return {"files": {}, "chunks": {}}
+    with open(path) as f:
+        return json.load(f)
+
+
+def write_checksums(checksums, path):
+    with open(path + ".tmp", "w") as f:
+        json.dump(checksums, f)
+    os.replace(path + ".tmp", path)
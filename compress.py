@@ -0,0 +1,282 @@
+import os
+import io
+import gzip
+import zlib
+import time
+import shutil
+import collections
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    import lz4.frame
+except ImportError:
+    lz4 = None
+
+'''
+Compression codecs shared by backup and restore scripts
+
+    gzip : block-parallel gzip (see ParallelGzipWriter), readable by zcat
+    zstd : zstandard with worker threads (needs the zstandard module)
+    lz4  : lz4 frame format (needs the lz4 module)
+    none : no compression
+
+Block-parallel gzip compression (same principle as pigz)
+
+The data is cut in blocks compressed by a pool of threads (zlib releases the GIL
+while compressing). Each block is written as an independent gzip member, in
+order. A file made of several gzip members is a valid gzip file and can be read
+by zcat, gzip -d or tarfile "r:gz".
+'''
+
+LEVEL = 6
+BLOCK_SIZE = 4 * 1024 * 1024
+
+
+def _gzip_block(data, level):
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 31)
+    return compressor.compress(data) + compressor.flush()
+
+
+class ParallelGzipWriter:
+    '''
+    File-like object compressing everything written to it
+        - fileobj: destination opened in binary write mode
+        - level: gzip compression level (1 to 9)
+        - workers: number of compression threads (number of CPU by default)
+        - block_size: size of the blocks compressed independently
+    close() does not close fileobj. abort() must be called instead if writing
+    fails, to stop the compression threads
+    '''
+    def __init__(self, fileobj, level=LEVEL, workers=None, block_size=BLOCK_SIZE):
+        self.fileobj = fileobj
+        self.level = level
+        self.workers = workers or os.cpu_count() or 1
+        self.block_size = block_size
+        self.pool = ThreadPoolExecutor(self.workers)
+        self.pending = collections.deque()
+        self.buffer = bytearray()
+        self.written = False
+        self.closed = False
+
+    def _submit(self, data):
+        self.pending.append(self.pool.submit(_gzip_block, data, self.level))
+        self.written = True
+        # Keep a bounded number of blocks in memory
+        while len(self.pending) > 2 * self.workers:
+            self.fileobj.write(self.pending.popleft().result())
+
+    def write(self, data):
+        self.buffer += data
+        while len(self.buffer) >= self.block_size:
+            self._submit(bytes(self.buffer[:self.block_size]))
+            del self.buffer[:self.block_size]
+        return len(data)
+
+    def writable(self):
+        return True
+
+    def flush(self):
+        pass
+
+    def close(self):
+        if self.closed:
+            return
+        # An empty input still gives a valid (empty) gzip file
+        if self.buffer or not self.written:
+            self._submit(bytes(self.buffer))
+            self.buffer = bytearray()
+        while self.pending:
+            self.fileobj.write(self.pending.popleft().result())
+        self.pool.shutdown()
+        self.closed = True
+
+    def abort(self):
+        '''
+        Stop the compression threads without writing the blocks not written yet
+        '''
+        if self.closed:
+            return
+        # shutdown(cancel_futures=True) needs python 3.9
+        for future in self.pending:
+            future.cancel()
+        self.pending.clear()
+        self.pool.shutdown()
+        self.closed = True
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+
+class _NoCloseWrapper:
+    '''
+    File-like object passing data through, used by the codec "none"
+    '''
+    def __init__(self, fileobj):
+        self.fileobj = fileobj
+
+    def write(self, data):
+        return self.fileobj.write(data)
+
+    def read(self, size=-1):
+        return self.fileobj.read(size)
+
+    def writable(self):
+        return True
+
+    def readable(self):
+        return True
+
+    def flush(self):
+        pass
+
+    def close(self):
+        pass
+
+
+def _zstd_writer(fileobj, level, workers):
+    compressor = zstandard.ZstdCompressor(level=level, threads=workers or os.cpu_count() or 1)
+    return compressor.stream_writer(fileobj, closefd=False)
+
+
+def _zstd_reader(fileobj):
+    return zstandard.ZstdDecompressor().stream_reader(fileobj, read_across_frames=True, closefd=False)
+
+
+def _lz4_writer(fileobj, level, workers):
+    return lz4.frame.LZ4FrameFile(fileobj, mode="wb", compression_level=level)
+
+
+def _lz4_reader(fileobj):
+    return lz4.frame.LZ4FrameFile(fileobj, mode="rb")
+
+
+# name : (file extension, default level, writer, reader, required module)
+CODECS = {
+    "gzip": (".gz", LEVEL, ParallelGzipWriter, lambda f: gzip.GzipFile(fileobj=f, mode="rb"), True),
+    "zstd": (".zst", 3, _zstd_writer, _zstd_reader, zstandard),
+    "lz4": (".lz4", 0, _lz4_writer, _lz4_reader, lz4),
+    "none": ("", 0, lambda f, level, workers: _NoCloseWrapper(f), _NoCloseWrapper, True),
+}
+DEFAULT_CODEC = "gzip"
+
+
+def check_codec(codec):
+    '''
+    Raise ValueError if codec is unknown or if its python module is not installed
+    '''
+    if codec not in CODECS:
+        raise ValueError("Unknown compression codec " + codec + ". Possible values : " + ", ".join(CODECS))
+    if not CODECS[codec][4]:
+        raise ValueError("Python module for compression codec " + codec + " is not installed")
+
+
+def available_codecs():
+    return [codec for codec in CODECS if CODECS[codec][4]]
+
+
+def extension(codec):
+    return CODECS[codec][0]
+
+
+def default_level(codec):
+    return CODECS[codec][1]
+
+
+def open_writer(codec, fileobj, level=None, workers=None):
+    '''
+    Return a file object compressing with codec everything written to it into fileobj
+    close() must be called at the end and does not close fileobj
+    '''
+    check_codec(codec)
+    if level is None:
+        level = default_level(codec)
+    return CODECS[codec][2](fileobj, level, workers)
+
+
+def abort_writer(writer):
+    '''
+    Release a writer returned by open_writer after an error, instead of close()
+    '''
+    abort = getattr(writer, "abort", None)
+    if abort:
+        abort()
+
+
+def open_reader(codec, fileobj):
+    '''
+    Return a file object returning the data of fileobj decompressed with codec
+    '''
+    check_codec(codec)
+    return CODECS[codec][3](fileobj)
+
+
+def compress_file(path, path_dest, codec=DEFAULT_CODEC, level=None, workers=None):
+    '''
+    Compress the file path to path_dest with codec
+    '''
+    with open(path, "rb") as f, open(path_dest, "wb") as file_out:
+        writer = open_writer(codec, file_out, level, workers)
+        try:
+            shutil.copyfileobj(f, writer, BLOCK_SIZE)
+        except BaseException:
+            abort_writer(writer)
+            raise
+        writer.close()
+
+
+class _CountingWriter:
+    def __init__(self):
+        self.size = 0
+
+    def write(self, data):
+        self.size += len(data)
+        return len(data)
+
+    def flush(self):
+        pass
+
+
+def benchmark(data, codecs=None, level=None, workers=None):
+    '''
+    Compress then decompress data with each codec
+    Return a list of dict with the codec, the level, the compression and
+    decompression speed in MB/s and the compression ratio
+    '''
+    results = []
+    for codec in codecs or available_codecs():
+        codec_level = default_level(codec) if level is None else level
+        compressed = io.BytesIO()
+        start = time.perf_counter()
+        writer = open_writer(codec, compressed, codec_level, workers)
+        for offset in range(0, len(data), BLOCK_SIZE):
+            writer.write(data[offset:offset + BLOCK_SIZE])
+        writer.close()
+        compress_time = time.perf_counter() - start
+        compressed.seek(0)
+        start = time.perf_counter()
+        reader = open_reader(codec, compressed)
+        output = _CountingWriter()
+        shutil.copyfileobj(reader, output, BLOCK_SIZE)
+        decompress_time = time.perf_counter() - start
+        if output.size != len(data):
+            raise ValueError("Codec " + codec + " returned " + str(output.size) + " bytes instead of " + str(len(data)))
+        compressed_size = len(compressed.getvalue())
+        results.append({
+            "codec": codec,
+            "level": codec_level,
+            "compress_mbps": len(data) / 1048576 / max(compress_time, 1e-9),
+            "decompress_mbps": len(data) / 1048576 / max(decompress_time, 1e-9),
+            "ratio": len(data) / max(compressed_size, 1),
+        })
+    return results
@@ -0,0 +1,560 @@
+import re
+import json
+import math
+import time
+import queue
+import subprocess
+import threading
+import compress
+import encrypt
+import pipeline
+from concurrent.futures import ThreadPoolExecutor
+
+'''
+Dump and import of the database table by table, with a pool of workers
+
+With DB_DUMP=tables, the database is not dumped by a single mysqldump :
+
+    - a pool of sessions of the mysql client is opened, all of them reading the
+      database in the same snapshot (see Snapshot)
+    - the schema is dumped without data, the secondary indexes (KEY, FULLTEXT KEY,
+      SPATIAL KEY) and the foreign keys are removed from each CREATE TABLE
+    - the rows of each table are dumped as INSERT statements, in one or several
+      parts, by the sessions of the pool. A table whose primary key is a single
+      integer column can be cut in parts of about DB_DUMP_CHUNK_ROWS rows, each
+      one a range of its primary key
+    - the triggers are dumped with the schema and created last by the import
+
+As mydumper does, a global read lock (FLUSH TABLES WITH READ LOCK) is held while
+the transaction of each session is started and while the schema is dumped, so
+all the parts and the schema are read at the same point in time. The lock is
+then released if all the tables are transactional (InnoDB), else it is kept
+until the other ones (MyISAM, Aria...), which are not in the snapshot, are
+dumped. With DB_DUMP=single, the database is read in a single snapshot by
+mysqldump if all its tables are transactional, else all its tables are locked
+during the dump.
+
+Each part is compressed and encrypted in its own file <DB_NAME>.sql.<number>.
+The manifest <DB_NAME>.sql.manifest.json lists the tables, their parts and the
+indexes removed from the schema, with the schema and the triggers.
+
+The import creates the tables, loads the parts with a pool of mysql clients,
+then builds the secondary indexes of each table, once its rows are loaded, and
+creates the triggers.
+'''
+
+DEFAULT_WORKERS = 4
+# Lines of CREATE TABLE created after the load of the rows
+_DEFERRED = re.compile(r"^\s+((?:FULLTEXT |SPATIAL )?KEY |CONSTRAINT )")
+_CREATE_TABLE = re.compile(r"CREATE TABLE `((?:[^`]|``)+)` \(")
+_FIRST_COLUMN = re.compile(r"\(`((?:[^`]|``)+)`")
+_INTEGER_TYPES = ["tinyint", "smallint", "mediumint", "int", "bigint"]
+TRANSACTIONAL_ENGINES = ["InnoDB", "TokuDB", "RocksDB"]
+# The position is written by mysqldump in the first lines of the dump
+_POSITION = re.compile(rb"CHANGE (?:MASTER|REPLICATION SOURCE) TO (?:MASTER|SOURCE)_LOG_FILE='([^']+)', (?:MASTER|SOURCE)_LOG_POS=(\d+)")
+_HEADER_SIZE = 64 * 1024
+# Types whose values are written without quotes, and as hexadecimal strings
+_NUMERIC_TYPES = _INTEGER_TYPES + ["decimal", "float", "double"]
+_BINARY_TYPES = ["binary", "varbinary", "tinyblob", "blob", "mediumblob", "longblob", "geometry", "point", "linestring",
+                 "polygon", "multipoint", "multilinestring", "multipolygon", "geometrycollection", "geomcollection"]
+# Line written by a session after the result of each statement
+_END = "-- end of result"
+# Size of the INSERT statements of the parts, as the extended inserts of mysqldump
+INSERT_SIZE = 1024 * 1024
+# Statements at the beginning of each part, the values are read in UTC
+_PART_HEADER = (b"/*!40101 SET NAMES utf8mb4 */;\n"
+                b"/*!40103 SET TIME_ZONE='+00:00' */;\n"
+                b"/*!40014 SET UNIQUE_CHECKS=0, FOREIGN_KEY_CHECKS=0 */;\n"
+                b"/*!40101 SET SQL_MODE='NO_AUTO_VALUE_ON_ZERO' */;\n")
+
+
+def quote_name(name):
+    return "`" + name.replace("`", "``") + "`"
+
+
+def quote_value(value):
+    return "'" + value.replace("\\", "\\\\").replace("'", "\\'") + "'"
+
+
+def query(host, name, sql):
+    '''
+    Return the rows of the result of sql as lists of strings
+    '''
+    output = subprocess.run(["mysql", "-h", host, "-N", "-B", "-e", sql, name], stdout=subprocess.PIPE, check=True).stdout
+    return [line.split("\t") for line in output.decode().splitlines()]
+
+
+def execute(host, name, sql):
+    '''
+    Run the SQL statements sql with the mysql client
+    '''
+    subprocess.run(["mysql", "-h", host, name], input=sql.encode(), check=True)
+
+
+class PositionWriter:
+    '''
+    File-like object writing to fout and reading the binary log position in the first bytes of the dump
+    '''
+    def __init__(self, fout):
+        self.fout = fout
+        self.header = b""
+        self.position = None
+
+    def write(self, data):
+        if self.position is None and len(self.header) < _HEADER_SIZE:
+            self.header += data[:_HEADER_SIZE]
+            match = _POSITION.search(self.header)
+            if match:
+                self.position = {"file": match.group(1).decode(), "position": int(match.group(2))}
+        return self.fout.write(data)
+
+    def flush(self):
+        self.fout.flush()
+
+
+def table_engines(host, name):
+    '''
+    Return a dict table -> storage engine of the tables of the database name
+    '''
+    return dict(query(host, name, "SELECT TABLE_NAME, ENGINE FROM information_schema.TABLES "
+                      "WHERE TABLE_SCHEMA = DATABASE() AND TABLE_TYPE = 'BASE TABLE'"))
+
+
+def table_rows(host, name):
+    '''
+    Return [table, storage engine, number of rows] for each table of the database name
+    The number of rows of InnoDB tables is an estimate of the server
+    '''
+    return [[table, engine, int(rows)] for table, rows, engine in query(host, name, "SELECT TABLE_NAME, COALESCE(TABLE_ROWS, 0), ENGINE FROM information_schema.TABLES "
+                                                                     "WHERE TABLE_SCHEMA = DATABASE() AND TABLE_TYPE = 'BASE TABLE' ORDER BY TABLE_NAME")]
+
+
+def snapshot_options(engines):
+    '''
+    Return the mysqldump options to read tables using engines
+    Transactional tables only are read in a consistent snapshot without lock,
+    else the tables are locked during the dump
+    '''
+    if all(engine in TRANSACTIONAL_ENGINES for engine in engines):
+        return ["--single-transaction", "--skip-lock-tables"]
+    return ["--lock-tables"]
+
+
+class LockTimer:
+    '''
+    Time during which tables were locked by the dumps, shared by the dump threads
+    '''
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.tables = {}
+
+    def add(self, table, seconds):
+        with self.lock:
+            self.tables[table] = self.tables.get(table, 0) + seconds
+
+    def report(self):
+        if not self.tables:
+            return "No table locked during the dump of the database"
+        return "Tables locked during the dump of the database : " + ", ".join(
+            table + " " + str(round(seconds, 1)) + " s" for table, seconds in sorted(self.tables.items(), key=lambda item: -item[1]))
+
+
+class Session:
+    '''
+    mysql client connected to the database name, running the statements sent to it one after the other
+    '''
+    def __init__(self, host, name):
+        # With --quick, the rows are read from the server as they are written, not buffered by the client
+        self.process = subprocess.Popen(["mysql", "-h", host, "-N", "-B", "-r", "--quick", "--unbuffered", "--default-character-set=utf8mb4", name],
+                                        stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+
+    def rows(self, sql):
+        '''
+        Yield the lines of the result of the statements sql, as bytes ending with a line break
+        The values of a line are separated by tabs and are not escaped
+        '''
+        if self.process.poll() is not None:
+            raise RuntimeError("mysql session closed after an error")
+        self.process.stdin.write((sql + "\nSELECT '" + _END + "';\n").encode())
+        self.process.stdin.flush()
+        end = (_END + "\n").encode()
+        for line in self.process.stdout:
+            if line == end:
+                return
+            yield line
+        # The client stops at the first error
+        raise RuntimeError("mysql exited with code " + str(self.process.wait()))
+
+    def query(self, sql):
+        return [line.decode().rstrip("\n").split("\t") for line in self.rows(sql)]
+
+    def execute(self, sql):
+        for line in self.rows(sql):
+            pass
+
+    def abort(self):
+        '''
+        Close the session while the result of a statement is still being read
+        '''
+        self.process.kill()
+        self.close()
+
+    def close(self):
+        # The transaction is rolled back when the client disconnects
+        try:
+            self.process.stdin.close()
+        except BrokenPipeError:
+            pass
+        self.process.stdout.close()
+        self.process.wait()
+
+
+class Snapshot:
+    '''
+    Pool of sessions reading the database name in the same consistent snapshot
+        - sessions: number of sessions, ie of parts dumped at the same time
+        - timer: optional, LockTimer updated with the time the global read lock is held
+    The global read lock taken while the transactions are started is released
+    once the parts given to hold() are dumped, ie the parts of the tables which
+    are not in the snapshot. close() must be called once all the parts are dumped
+    '''
+    def __init__(self, host, name, sessions=DEFAULT_WORKERS, timer=None):
+        self.host = host
+        self.name = name
+        self.timer = timer
+        self.size = max(1, sessions)
+        self.sessions = queue.Queue()
+        self.mutex = threading.Lock()
+        self.locked = None
+        self.held = set()
+        # The sessions connect before the lock is taken, so that it is held shorter
+        self.lock = Session(host, name)
+        self.all = [Session(host, name) for index in range(self.size)]
+        try:
+            # The writes wait for the lock, so the transactions started meanwhile see the same data
+            self.lock.execute("FLUSH TABLES WITH READ LOCK;")
+            self.locked = time.monotonic()
+            for session in self.all:
+                session.execute("SET NAMES utf8mb4; SET TIME_ZONE='+00:00'; "
+                                "SET SESSION TRANSACTION ISOLATION LEVEL REPEATABLE READ; START TRANSACTION WITH CONSISTENT SNAPSHOT;")
+                self.sessions.put(session)
+        except:
+            self.close()
+            raise
+
+    def query(self, sql):
+        '''
+        Return the rows of the result of sql read in the snapshot, as lists of strings
+        '''
+        session = self.sessions.get()
+        try:
+            return session.query(sql)
+        finally:
+            self.sessions.put(session)
+
+    def rows(self, sql):
+        '''
+        Yield the lines of the result of sql read in the snapshot by a free session
+        '''
+        session = self.sessions.get()
+        complete = False
+        try:
+            yield from session.rows(sql)
+            complete = True
+        finally:
+            # The unread rows would be read as the result of the next statement, and a new
+            # session would not be in the snapshot, so the next statements of this one fail
+            if not complete:
+                session.abort()
+            self.sessions.put(session)
+
+    def hold(self, files):
+        '''
+        Keep the global read lock until the parts files are dumped, release it now if there is none
+        '''
+        with self.mutex:
+            self.held = set(files)
+        if not files:
+            self.release()
+
+    def done(self, file):
+        '''
+        Called once the part file is dumped
+        '''
+        with self.mutex:
+            if file not in self.held:
+                return
+            self.held.discard(file)
+            release = not self.held
+        if release:
+            self.release()
+
+    def release(self):
+        with self.mutex:
+            if self.locked is None:
+                return
+            self.lock.execute("UNLOCK TABLES;")
+            if self.timer is not None:
+                self.timer.add("all tables (global read lock)", time.monotonic() - self.locked)
+            self.locked = None
+
+    def close(self):
+        try:
+            if self.lock.process.poll() is None:
+                self.release()
+        finally:
+            for session in [self.lock] + self.all:
+                session.close()
+
+
+def _timed_dump(fout, host, name, options, tables, limiter, timer, label):
+    start = time.monotonic()
+    pipeline.mysqldump(fout, host, name, options, tables, limiter)
+    if timer is not None and "--lock-tables" in options:
+        timer.add(label, time.monotonic() - start)
+
+
+def dump_database(fout, host, name, limiter=None, timer=None, binlog=False):
+    '''
+    Write to fout the dump of the database name with a single mysqldump
+        - limiter: optional, pipeline.RateLimiter of the dump
+        - timer: optional, LockTimer updated if the tables are locked
+        - binlog: if True, return the binary log position of the dump as a dict (file, position)
+    '''
+    options = snapshot_options(table_engines(host, name).values())
+    if binlog:
+        # With --single-transaction, all the tables are only locked while the snapshot is started
+        options.append("--master-data=2")
+        fout = PositionWriter(fout)
+    _timed_dump(fout, host, name, options, None, limiter, timer, "all tables")
+    if binlog:
+        if fout.position is None:
+            raise RuntimeError("No binary log position in the dump, check that log_bin is enabled")
+        return fout.position
+
+
+def split_indexes(schema):
+    '''
+    Remove the secondary indexes and foreign keys from the CREATE TABLE statements of schema
+    Return the new schema and a dict table -> definitions removed
+    An index whose first column is the AUTO_INCREMENT column is kept, it is needed to create the table
+    '''
+    lines = []
+    indexes = {}
+    table = None
+    auto_increment = None
+    for line in schema.splitlines():
+        match = _CREATE_TABLE.search(line)
+        if match:
+            table = match.group(1).replace("``", "`")
+            auto_increment = None
+        elif table is not None and line.startswith(")"):
+            # The last column or index of the table is not followed by a comma
+            if lines[-1].endswith(","):
+                lines[-1] = lines[-1][:-1]
+            table = None
+        elif table is not None:
+            if "AUTO_INCREMENT" in line and line.lstrip().startswith("`"):
+                auto_increment = line.split("`")[1]
+            first_column = _FIRST_COLUMN.search(line)
+            if _DEFERRED.match(line) and not (first_column and first_column.group(1) == auto_increment):
+                indexes.setdefault(table, []).append(line.strip().rstrip(","))
+                continue
+        lines.append(line)
+    return "\n".join(lines) + "\n", indexes
+
+
+def _dump(args, host, name):
+    # Without data, the tables do not need to be locked, the global read lock of the snapshot stops the changes of the schema
+    return subprocess.run(["mysqldump", "-h", host, "--skip-lock-tables"] + args + [name], stdout=subprocess.PIPE, check=True).stdout.decode()
+
+
+def _parts(snapshot, table, rows, chunk_rows):
+    '''
+    Return the where clauses of the parts of table, None for the whole table
+    '''
+    if not chunk_rows or rows <= chunk_rows:
+        return [None]
+    primary = snapshot.query("SELECT k.COLUMN_NAME, c.DATA_TYPE FROM information_schema.KEY_COLUMN_USAGE k "
+                             "JOIN information_schema.COLUMNS c USING (TABLE_SCHEMA, TABLE_NAME, COLUMN_NAME) "
+                             "WHERE k.TABLE_SCHEMA = DATABASE() AND k.TABLE_NAME = " + quote_value(table) + " AND k.CONSTRAINT_NAME = 'PRIMARY'")
+    if len(primary) != 1 or primary[0][1].lower() not in _INTEGER_TYPES:
+        return [None]
+    column = quote_name(primary[0][0])
+    low, high = snapshot.query("SELECT MIN(" + column + "), MAX(" + column + ") FROM " + quote_name(table))[0]
+    if low == "NULL":
+        return [None]
+    low, high = int(low), int(high)
+    count = math.ceil(rows / chunk_rows)
+    step = max(1, math.ceil((high - low + 1) / count))
+    bounds = list(range(low + step, high + 1, step))
+    if not bounds:
+        return [None]
+    # The first and the last parts are open so that no row is missed
+    wheres = [column + " < " + str(bounds[0])]
+    for start, end in zip(bounds, bounds[1:]):
+        wheres.append(column + " >= " + str(start) + " AND " + column + " < " + str(end))
+    wheres.append(column + " >= " + str(bounds[-1]))
+    return wheres
+
+
+def plan_dump(snapshot, prefix, codec=compress.DEFAULT_CODEC, chunk_rows=0):
+    '''
+    Return the manifest of a dump of the database of snapshot, without dumping the rows
+        - snapshot: Snapshot still holding its global read lock
+        - prefix: name of the files of the parts, followed by their number
+        - codec: compression of the parts
+        - chunk_rows: if not 0, approximate number of rows of each part
+    The tables which are not in the snapshot are first, so that the global read
+    lock is released sooner, then the biggest ones so that they are started first
+    by the pool. The global read lock is released once the schema is read if all
+    the tables are in the snapshot, else once their parts are dumped
+    '''
+    host, name = snapshot.host, snapshot.name
+    schema, indexes = split_indexes(_dump(["--no-data", "--skip-triggers"], host, name))
+    triggers = _dump(["--no-data", "--no-create-info", "--triggers"], host, name)
+    columns = {}
+    # The generated columns are computed again by the import
+    for table, column, data_type in snapshot.query("SELECT TABLE_NAME, COLUMN_NAME, DATA_TYPE FROM information_schema.COLUMNS "
+                                                   "WHERE TABLE_SCHEMA = DATABASE() AND EXTRA NOT LIKE '%GENERATED%' ORDER BY TABLE_NAME, ORDINAL_POSITION"):
+        columns.setdefault(table, []).append([column, data_type.lower()])
+    found = snapshot.query("SELECT TABLE_NAME, COALESCE(TABLE_ROWS, 0), ENGINE FROM information_schema.TABLES "
+                           "WHERE TABLE_SCHEMA = DATABASE() AND TABLE_TYPE = 'BASE TABLE' ORDER BY DATA_LENGTH DESC")
+    found.sort(key=lambda row: row[2] in TRANSACTIONAL_ENGINES)
+    tables = []
+    number = 0
+    for table, rows, engine in found:
+        table_parts = []
+        for where in _parts(snapshot, table, int(rows), chunk_rows):
+            number += 1
+            table_parts.append({"file": prefix + "." + "%04d" % number + compress.extension(codec), "where": where})
+        tables.append({"name": table, "engine": engine, "columns": columns[table], "parts": table_parts, "indexes": indexes.get(table, [])})
+    manifest = {"version": 1, "codec": codec, "schema": schema, "triggers": triggers, "tables": tables}
+    snapshot.hold([part["file"] for table, part in locked_parts(manifest)])
+    return manifest
+
+
+def parts(manifest):
+    '''
+    Return the (table, part) of the manifest, in the order of the dump
+    '''
+    return [(table, part) for table in manifest["tables"] for part in table["parts"]]
+
+
+def locked_parts(manifest):
+    '''
+    Return the (table, part) of the tables which are not in the snapshot, dumped under the global read lock
+    '''
+    return [(table, part) for table, part in parts(manifest) if table["engine"] not in TRANSACTIONAL_ENGINES]
+
+
+def part_files(manifest):
+    return [part["file"] for table, part in parts(manifest)]
+
+
+def _literal(column, data_type):
+    '''
+    Return the SQL expression giving the value of column as a literal of an INSERT statement
+    '''
+    name = quote_name(column)
+    if data_type in _NUMERIC_TYPES:
+        value = "CAST(" + name + " AS CHAR)"
+    elif data_type == "bit":
+        value = "CONCAT('b''', BIN(" + name + "), '''')"
+    elif data_type in _BINARY_TYPES:
+        value = "CONCAT('X''', HEX(" + name + "), '''')"
+    else:
+        # Each row is a line of the result, the line breaks of the strings are escaped
+        value = "REPLACE(REPLACE(QUOTE(" + name + "), '\\n', '\\\\n'), '\\r', '\\\\r')"
+    return "IFNULL(" + value + ", 'NULL')"
+
+
+def dump_part(fout, snapshot, table, part, limiter=None):
+    '''
+    Write to fout the rows of the part of table, both read from the manifest, as INSERT statements
+    Without LOCK TABLES in the output, so that the parts of a table can be imported at the same time
+        - snapshot: Snapshot in which the rows are read
+        - limiter: optional, pipeline.RateLimiter shared by the dumps
+    '''
+    columns = table["columns"]
+    sql = ("SELECT CONCAT('(', CONCAT_WS(',', " + ", ".join(_literal(column, data_type) for column, data_type in columns) + "), ')') FROM "
+           + quote_name(table["name"]) + (" WHERE " + part["where"] if part["where"] else "") + ";")
+    insert = ("INSERT INTO " + quote_name(table["name"]) + " (" + ", ".join(quote_name(column) for column, data_type in columns) + ") VALUES ").encode()
+    fout.write(_PART_HEADER)
+    values = []
+    size = 0
+    for line in snapshot.rows(sql):
+        # The rows are read from the server while they are written, so limiting the writes also limits the reads
+        if limiter is not None:
+            limiter.consume(len(line))
+        values.append(line[:-1])
+        size += len(line)
+        if size >= INSERT_SIZE:
+            fout.write(insert + b",".join(values) + b";\n")
+            values = []
+            size = 0
+    if values:
+        fout.write(insert + b",".join(values) + b";\n")
+    snapshot.done(part["file"])
+
+
+def dump_tables(manifest, snapshot, folder, level=None, limiter=None, items=None):
+    '''
+    Dump each part of the manifest to its compressed file in folder, a part at the same time by session of snapshot
+        - items: optional, the (table, part) to dump, all the parts of the manifest by default
+    '''
+    def dumpPart(item):
+        table, part = item
+        with open(folder + "/" + part["file"], "wb") as f:
+            # The parts are compressed in parallel, a single thread for each one
+            compressor = compress.open_writer(manifest["codec"], f, level, 1)
+            try:
+                dump_part(compressor, snapshot, table, part, limiter)
+            except BaseException:
+                compress.abort_writer(compressor)
+                raise
+            compressor.close()
+
+    with ThreadPoolExecutor(max_workers=snapshot.size) as executor:
+        list(executor.map(dumpPart, parts(manifest) if items is None else items))
+
+
+def import_tables(manifest, host, name, read_part, workers=DEFAULT_WORKERS, VERBOSE=0):
+    '''
+    Import in the database name the dump described by manifest
+        - read_part: function called with the name of a part file and a consumer,
+          calls the consumer with a file object returning the decompressed part
+        - workers: number of parts imported and of indexes built at the same time
+    '''
+    execute(host, name, manifest["schema"])
+
+    def importPart(item):
+        table, part = item
+        read_part(part["file"], lambda f: pipeline.mysqlimport(f, host, name))
+        if VERBOSE == 2:
+            print("Part " + part["file"] + " of " + table["name"] + " imported")
+
+    def buildIndexes(table):
+        execute(host, name, "ALTER TABLE " + quote_name(table["name"]) + " " + ", ".join("ADD " + index for index in table["indexes"]) + ";")
+        if VERBOSE == 2:
+            print(str(len(table["indexes"])) + " indexes of " + table["name"] + " built")
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        list(executor.map(importPart, parts(manifest)))
+        list(executor.map(buildIndexes, [table for table in manifest["tables"] if table["indexes"]]))
+    execute(host, name, manifest["triggers"])
+
+
+def write_manifest(manifest, path, codec=compress.DEFAULT_CODEC):
+    with open(path, "wb") as f:
+        compressor = compress.open_writer(codec, f)
+        compressor.write(json.dumps(manifest).encode())
+        compressor.close()
+
+
+def read_manifest(path, key, codec=compress.DEFAULT_CODEC):
+    '''
+    Return the manifest read from its encrypted file
+    '''
+    with open(path, "rb") as f:
+        return json.loads(compress.open_reader(codec, encrypt.DecryptReader(f, key)).read())
@@ -0,0 +1,388 @@
+import os
+import json
+import stat
+import fcntl
+import random
+import hashlib
+import collections
+import contextlib
+import encrypt
+import compress
+import tools
+import fileindex
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+'''
+Deduplicated backup of the Wordpress site folder
+
+Files are cut in chunks with content-defined chunking (gear rolling hash, same
+principle as FastCDC) so that an insert or a change in a big file only changes
+the chunks around it. Files smaller than MAX_CHUNK are stored as a single chunk.
+The cut points are searched with numpy when it is installed, the python loop
+finding the same cut points is more than 20 times slower.
+
+Each chunk is identified by a keyed BLAKE2b hash of its content, compressed,
+encrypted and stored once in the chunk store :
+
+    LOCALBKPATH/chunks/<2 first characters of id>/<id>
+
+A backup of the site is a manifest listing every file, folder and symlink with
+its metadata, the ids of its chunks and the hash of the content of the files.
+Only chunks which are not already in the store are written, and listed in
+LOCALBKPATH/chunks/pending.txt until they have been copied to BACKUP_DEST.
+
+The store may be shared by several sites backed up with the same key and codec
+(CHUNK_STORE), so that the files common to the sites, ie the core of Wordpress,
+the plugins and the themes, are stored and copied once. Each site writes in
+refs/<site>.json the chunks used by its BACKUP_RETENTION backups, and a chunk is
+deleted by gc() when no site uses it anymore. A site holds a shared lock on the
+store while it adds chunks and writes its references, gc() holds an exclusive
+lock, so a chunk is never deleted between the time a backup finds it in the
+store and the time the backup is in the references.
+'''
+
+MIN_CHUNK = 256 * 1024
+MAX_CHUNK = 4 * 1024 * 1024
+# A cut point is found on average 1 MB after MIN_CHUNK
+CUT_MASK = 0xfffff000
+_random = random.Random(0x5750)
+_GEAR = [_random.getrandbits(32) for i in range(256)]
+# Bytes hashed at a time by _cut_numpy
+NUMPY_BLOCK = 256 * 1024
+
+PENDING_FILE = "pending.txt"
+LOCK_FILE = "lock"
+REFS_FOLDER = "refs"
+# Folder of the chunks on BACKUP_DEST, ie S3 prefix or FTP folder next to DAYJ folders
+REMOTE_FOLDER = "chunks"
+
+
+def _cut(data):
+    '''
+    Return the length of the first chunk of data
+    '''
+    end = min(len(data), MAX_CHUNK)
+    if end <= MIN_CHUNK:
+        return end
+    gear = _GEAR
+    h = 0
+    for i in range(MIN_CHUNK, end):
+        h = ((h << 1) + gear[data[i]]) & 0xffffffff
+        if not h & CUT_MASK:
+            return i + 1
+    return end
+
+
+def _cut_numpy(data):
+    '''
+    Same as _cut, the hashes of a block of data are computed with numpy
+    '''
+    end = min(len(data), MAX_CHUNK)
+    if end <= MIN_CHUNK:
+        return end
+    gear = numpy.array(_GEAR, dtype=numpy.uint32)
+    for start in range(MIN_CHUNK, end, NUMPY_BLOCK):
+        stop = min(start + NUMPY_BLOCK, end)
+        # The hash at i is the sum of gear[data[i - k]] << k, the bits of the bytes
+        # older than 32 are shifted out, so the block is hashed from 31 bytes before it
+        first = max(MIN_CHUNK, start - 31)
+        h = gear[numpy.frombuffer(data, numpy.uint8, stop - first, first)]
+        # Each step adds the sum of the previous shift bytes, shifted, so after
+        # the last one h is the sum over the 32 last bytes
+        shift = 1
+        while shift < 32:
+            h[shift:] += h[:-shift] << shift
+            shift *= 2
+        cuts = numpy.flatnonzero(h[start - first:] & CUT_MASK == 0)
+        if cuts.size:
+            return start + int(cuts[0]) + 1
+    return end
+
+
+# Search of the cut points
+_cut_point = _cut_numpy if numpy is not None else _cut
+
+
+def chunks(f):
+    '''
+    Yield the content of the file object f cut in chunks
+    '''
+    buffer = b""
+    eof = False
+    while True:
+        while not eof and len(buffer) < MAX_CHUNK:
+            data = f.read(MAX_CHUNK - len(buffer))
+            eof = not data
+            buffer += data
+        if not buffer:
+            return
+        if eof:
+            # The rest of the file is the last chunk
+            yield buffer
+            return
+        length = _cut_point(buffer)
+        yield buffer[:length]
+        buffer = buffer[length:]
+
+
+class ChunkStore:
+    '''
+    Content-addressed store of compressed and encrypted chunks
+        - path: folder of the store
+        - key: AES key, also used to compute the chunk ids
+        - codec, level: compression of the chunks
+    '''
+    def __init__(self, path, key, codec=compress.DEFAULT_CODEC, level=None):
+        self.path = path
+        self.key = key
+        self.codec = codec
+        self.level = level
+        os.makedirs(path, exist_ok=True)
+
+    def chunk_id(self, data):
+        return hashlib.blake2b(data, digest_size=32, key=self.key, person=b"backup-wp-chunk").hexdigest()
+
+    def chunk_path(self, chunk_id):
+        return os.path.join(self.path, chunk_id[:2], chunk_id)
+
+    def has(self, chunk_id):
+        return os.path.exists(self.chunk_path(chunk_id))
+
+    def put(self, data):
+        '''
+        Store data if not already present and return its chunk id
+        '''
+        chunk_id = self.chunk_id(data)
+        path = self.chunk_path(chunk_id)
+        if not os.path.exists(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            # Another site sharing the store may write the same chunk at the same time
+            temp = path + "." + str(os.getpid()) + ".tmp"
+            with open(temp, "wb") as f:
+                writer = encrypt.EncryptWriter(f, self.key)
+                # Chunks are small, a single compression thread is enough
+                compressor = compress.open_writer(self.codec, writer, self.level, 1)
+                compressor.write(data)
+                compressor.close()
+                writer.close()
+            os.replace(temp, path)
+            with open(os.path.join(self.path, PENDING_FILE), "a") as pending:
+                # The pending chunks of the other sites are updated at the same time
+                fcntl.flock(pending, fcntl.LOCK_EX)
+                pending.write(chunk_id + "\n")
+        return chunk_id
+
+    def get(self, chunk_id, codec=None):
+        with open(self.chunk_path(chunk_id), "rb") as f:
+            reader = compress.open_reader(codec or self.codec, encrypt.DecryptReader(f, self.key))
+            return reader.read()
+
+    def pending(self):
+        '''
+        Return the ids of the chunks not yet copied to BACKUP_DEST
+        '''
+        try:
+            with open(os.path.join(self.path, PENDING_FILE)) as pending:
+                return list(dict.fromkeys(line.strip() for line in pending if line.strip()))
+        except FileNotFoundError:
+            return []
+
+    def clear_pending(self, chunk_ids):
+        '''
+        Remove chunk_ids, copied to BACKUP_DEST, from the pending chunks
+        The chunks added by other sites in the meantime stay pending
+        '''
+        done = set(chunk_ids)
+        try:
+            with open(os.path.join(self.path, PENDING_FILE), "r+") as pending:
+                fcntl.flock(pending, fcntl.LOCK_EX)
+                lines = [line for line in pending if line.strip() and line.strip() not in done]
+                pending.seek(0)
+                pending.truncate()
+                pending.writelines(lines)
+        except FileNotFoundError:
+            pass
+
+    @contextlib.contextmanager
+    def lock(self, exclusive=False):
+        '''
+        Hold a lock on the store, shared by the backups adding chunks, exclusive for gc()
+        '''
+        with open(os.path.join(self.path, LOCK_FILE), "a") as f:
+            fcntl.flock(f, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+            yield
+
+    def set_refs(self, owner, referenced):
+        '''
+        Record the chunks used by the backups of owner, ie the name of the site
+        '''
+        os.makedirs(os.path.join(self.path, REFS_FOLDER), exist_ok=True)
+        path = os.path.join(self.path, REFS_FOLDER, owner + ".json")
+        with open(path + ".tmp", "w") as f:
+            json.dump(sorted(referenced), f)
+        os.replace(path + ".tmp", path)
+
+    def ref_counts(self):
+        '''
+        Return for each chunk used by a site the number of sites using it
+        '''
+        counts = collections.Counter()
+        try:
+            names = os.listdir(os.path.join(self.path, REFS_FOLDER))
+        except FileNotFoundError:
+            return counts
+        for name in names:
+            if name.endswith(".json"):
+                with open(os.path.join(self.path, REFS_FOLDER, name)) as f:
+                    counts.update(json.load(f))
+        return counts
+
+    def all_chunks(self):
+        for folder in os.listdir(self.path):
+            if len(folder) == 2 and os.path.isdir(os.path.join(self.path, folder)):
+                for name in os.listdir(os.path.join(self.path, folder)):
+                    if not name.endswith(".tmp"):
+                        yield name
+
+    def gc(self):
+        '''
+        Delete the chunks which are not used by any site and return their ids
+        '''
+        removed = []
+        with self.lock(exclusive=True):
+            counts = self.ref_counts()
+            for chunk_id in list(self.all_chunks()):
+                if not counts[chunk_id]:
+                    os.remove(self.chunk_path(chunk_id))
+                    removed.append(chunk_id)
+        # Chunks deleted before they were copied
+        self.clear_pending(removed)
+        return removed
+
+
+def backup_folder(store, path, previous=None, limiter=None):
+    '''
+    Store the content of the folder path and return its manifest
+        - store: ChunkStore
+        - path: folder to backup
+        - previous: optional, manifest of the previous backup. Files with the
+          same size and modification time are not read again
+        - limiter: optional, pipeline.RateLimiter of the read of the files
+    '''
+    known = {}
+    if previous:
+        for entry in previous["entries"]:
+            if entry["type"] == "file":
+                known[entry["path"]] = entry
+    entries = []
+    for root, dirs, files in os.walk(path):
+        dirs.sort()
+        for name in [None] + sorted(files) + [d for d in dirs if os.path.islink(os.path.join(root, d))]:
+            fullpath = root if name is None else os.path.join(root, name)
+            st = os.lstat(fullpath)
+            entry = {
+                # Same names as tar, ie without the leading /
+                "path": fullpath.lstrip("/"),
+                "mode": stat.S_IMODE(st.st_mode),
+                "uid": st.st_uid,
+                "gid": st.st_gid,
+                "mtime": st.st_mtime_ns,
+            }
+            if stat.S_ISLNK(st.st_mode):
+                entry["type"] = "symlink"
+                entry["target"] = os.readlink(fullpath)
+            elif stat.S_ISDIR(st.st_mode):
+                entry["type"] = "dir"
+            elif stat.S_ISREG(st.st_mode):
+                entry["type"] = "file"
+                entry["size"] = st.st_size
+                old = known.get(entry["path"])
+                # Manifests of previous versions have no hash of the files, they are read again
+                if old and old["size"] == st.st_size and old["mtime"] == st.st_mtime_ns and "hash" in old and all(store.has(c) for c in old["chunks"]):
+                    entry["chunks"] = old["chunks"]
+                    entry["hash"] = old["hash"]
+                else:
+                    with open(fullpath, "rb") as f:
+                        reader = fileindex.HashReader(f, limiter)
+                        entry["chunks"] = [store.put(data) for data in chunks(reader)]
+                        entry["hash"] = reader.hexdigest()
+            else:
+                # Sockets, fifos and devices are not saved, like with tar
+                continue
+            entries.append(entry)
+    return {"version": 1, "codec": store.codec, "entries": entries}
+
+
+def write_manifest(manifest, path, codec=compress.DEFAULT_CODEC):
+    with open(path, "wb") as f:
+        compressor = compress.open_writer(codec, f)
+        compressor.write(json.dumps(manifest).encode())
+        compressor.close()
+
+
+def read_manifest(path, key, codec=compress.DEFAULT_CODEC):
+    '''
+    Return the manifest read from its encrypted file
+    '''
+    with open(path, "rb") as f:
+        return json.loads(compress.open_reader(codec, encrypt.DecryptReader(f, key)).read())
+
+
+def read_backup_manifest(folder, key):
+    '''
+    Return the manifest of the backup in the local folder (DAYJ, DAYJ-1...)
+    or None if it is not a deduplicated backup
+    '''
+    metadata = tools.readMetadata(os.path.join(folder, "backup.json.bin"), key)
+    path = os.path.join(folder, metadata["site"] + ".bin")
+    if metadata.get("site_mode") != "dedup" or not os.path.exists(path):
+        return None
+    return read_manifest(path, key, metadata["codec"])
+
+
+def referenced_chunks(manifest):
+    referenced = set()
+    for entry in manifest["entries"]:
+        referenced.update(entry.get("chunks", []))
+    return referenced
+
+
+def restore_folder(store, manifest, dest="/"):
+    '''
+    Rebuild in dest every entry of the manifest with chunks read from store
+    '''
+    folders = []
+    for entry in manifest["entries"]:
+        fullpath = os.path.join(dest, entry["path"])
+        if entry["type"] == "dir":
+            os.makedirs(fullpath, exist_ok=True)
+            folders.append((fullpath, entry))
+            continue
+        os.makedirs(os.path.dirname(fullpath), exist_ok=True)
+        if os.path.lexists(fullpath) and not os.path.isdir(fullpath):
+            os.remove(fullpath)
+        if entry["type"] == "symlink":
+            os.symlink(entry["target"], fullpath)
+            _set_owner(fullpath, entry, follow_symlinks=False)
+            continue
+        with open(fullpath, "wb") as f:
+            for chunk_id in entry["chunks"]:
+                f.write(store.get(chunk_id, manifest["codec"]))
+        _set_owner(fullpath, entry)
+        os.chmod(fullpath, entry["mode"])
+        os.utime(fullpath, ns=(entry["mtime"], entry["mtime"]))
+    # Folders last, their modification time changes while files are created
+    for fullpath, entry in reversed(folders):
+        _set_owner(fullpath, entry)
+        os.chmod(fullpath, entry["mode"])
+        os.utime(fullpath, ns=(entry["mtime"], entry["mtime"]))
+
+
+def _set_owner(path, entry, follow_symlinks=True):
+    # Like tar, the owner is only restored when running as root
+    if os.geteuid() == 0:
+        os.chown(path, entry["uid"], entry["gid"], follow_symlinks=follow_symlinks)
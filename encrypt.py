@@ -1,37 +1,311 @@
 import sys
 import os
+import mmap
+import struct
 from Crypto.Cipher import AES
 from Crypto import Random
 from binascii import b2a_hex
 from pathlib import Path
 
-def encrypt_file(path,key):
-    # get the plaintext
-    with open(path,"rb") as f:
-        clear_data = f.read()
+'''
+Format of the .bin files
 
-    # The key length must be 16 (AES-128), 24 (AES-192), or 32 (AES-256) Bytes.
-    cipher = AES.new(key, AES.MODE_GCM)
-    cipher_data, tag = cipher.encrypt_and_digest(clear_data)
+Version 1 (framed) :
 
-    # output
-    file_out = open(path + ".bin", "wb")
-    [ file_out.write(x) for x in (cipher.nonce, tag, cipher_data) ]
-    file_out.close()
+    header : MAGIC (6 bytes) + version (1 byte) + chunk size (4 bytes) + nonce prefix (8 bytes)
+    frames : length (4 bytes) + ciphertext + GCM tag (16 bytes)
 
+The plaintext is cut in chunks of "chunk size" bytes, each one encrypted and
+authenticated separately so that memory usage does not depend on the file size.
+The nonce of a frame is the nonce prefix followed by the frame counter, and the
+header is authenticated with every frame. The high bit of the length flags the
+last frame so that a truncated file is detected.
+Every frame but the last one holds exactly "chunk size" bytes of plaintext, so
+the frames holding a range of the plaintext are found from the header only
+(see frame_span).
+
+Version 0 (legacy, single-shot) :
+
+    nonce (16 bytes) + GCM tag (16 bytes) + ciphertext
+'''
+
+MAGIC = b"WPBKP\x00"
+VERSION = 1
+HEADER_SIZE = len(MAGIC) + 1 + 4 + 8
+TAG_SIZE = 16
+FRAME_OVERHEAD = 4 + TAG_SIZE
+LAST_FRAME = 0x80000000
+CHUNK_SIZE = 1024 * 1024
+# Frames read from a single mapping of the input file by encrypt_file
+MAP_FRAMES = 8
+
+
+def _frame_cipher(key, header, counter, last):
+    nonce = header[-8:] + struct.pack(">I", counter)
+    cipher = AES.new(key, AES.MODE_GCM, nonce=nonce)
+    cipher.update(header + (b"\x01" if last else b"\x00"))
+    return cipher
+
+
+def _new_header(chunk_size):
+    return MAGIC + struct.pack(">BI", VERSION, chunk_size) + Random.get_random_bytes(8)
+
+
+def _encrypt_frame(key, header, counter, plaintext, frame, last=False):
+    '''
+    Encrypt plaintext into frame, a writable buffer of at least len(plaintext) +
+    FRAME_OVERHEAD bytes, and return the size of the frame
+    '''
+    length = len(plaintext)
+    cipher = _frame_cipher(key, header, counter, last)
+    struct.pack_into(">I", frame, 0, length | (LAST_FRAME if last else 0))
+    tag = cipher.encrypt_and_digest(plaintext, output=frame[4:4 + length])[1]
+    frame[4 + length:4 + length + TAG_SIZE] = tag
+    return length + FRAME_OVERHEAD
+
+
+class EncryptWriter:
+    '''
+    File-like object encrypting everything written to it in the framed format
+        - fileobj: destination opened in binary write mode
+        - key: AES key (16, 24 or 32 bytes)
+        - chunk_size: plaintext size of a frame
+    close() writes the last frame but does not close fileobj
+    '''
+    def __init__(self, fileobj, key, chunk_size=CHUNK_SIZE):
+        self.fileobj = fileobj
+        self.key = key
+        self.chunk_size = chunk_size
+        self.header = _new_header(chunk_size)
+        self.counter = 0
+        self.buffer = bytearray()
+        self.closed = False
+        self.fileobj.write(self.header)
+
+    def _write_frame(self, data, last=False):
+        cipher = _frame_cipher(self.key, self.header, self.counter, last)
+        cipher_data, tag = cipher.encrypt_and_digest(data)
+        length = len(cipher_data) | (LAST_FRAME if last else 0)
+        self.fileobj.write(struct.pack(">I", length))
+        self.fileobj.write(cipher_data)
+        self.fileobj.write(tag)
+        self.counter += 1
+
+    def write(self, data):
+        self.buffer += data
+        while len(self.buffer) >= self.chunk_size:
+            self._write_frame(bytes(self.buffer[:self.chunk_size]))
+            del self.buffer[:self.chunk_size]
+        return len(data)
+
+    def writable(self):
+        return True
+
+    def flush(self):
+        pass
+
+    def close(self):
+        if not self.closed:
+            self._write_frame(bytes(self.buffer), last=True)
+            self.buffer = bytearray()
+            self.closed = True
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
 
-def decrypt_file(path,key):
-    # get the plaintext
-    with open(path,"rb") as f:
-        nonce, tag, cipher_data = [ f.read(x) for x in (16, 16, -1) ]
 
-    # let's assume that the key is somehow available again
-    cipher = AES.new(key, AES.MODE_GCM, nonce)
-    clear_data = cipher.decrypt_and_verify(cipher_data, tag)
+class DecryptReader:
+    '''
+    File-like object returning the plaintext of a .bin stream
+        - fileobj: source opened in binary read mode
+        - key: AES key used for the encryption
+    Both framed and legacy formats are supported. Framed data is verified frame
+    by frame, legacy data is only verified when the end of the stream is reached.
+    ValueError is raised if the data has been tampered with or truncated, or
+    if data follows the last frame.
+        - header, counter: optional, to read a framed stream from the frame
+          counter, fileobj being positioned at this frame (see frame_span).
+          The end of fileobj is not checked in this case
+    '''
+    def __init__(self, fileobj, key, header=None, counter=0):
+        self.fileobj = fileobj
+        self.key = key
+        self.buffer = bytearray()
+        self.eof = False
+        self.counter = counter
+        self.check_end = header is None
+        if header is not None:
+            self.header = header
+            self.legacy = None
+            self.chunk_size = _chunk_size(header)
+            return
+        start = _read_exact(fileobj, HEADER_SIZE)
+        if len(start) == HEADER_SIZE and start[:len(MAGIC)] == MAGIC and start[len(MAGIC)] == VERSION:
+            self.header = start
+            self.legacy = None
+            self.chunk_size = _chunk_size(start)
+        else:
+            # Legacy format : nonce + tag then the ciphertext up to the end
+            start += _read_exact(fileobj, 32 - len(start)) if len(start) < 32 else b""
+            if len(start) < 32:
+                raise ValueError("Encrypted file is truncated")
+            self.header = None
+            self.legacy = AES.new(key, AES.MODE_GCM, start[:16])
+            self.legacy_tag = start[16:32]
+            self.buffer += self.legacy.decrypt(start[32:])
 
+    def _read_frame(self):
+        if self.legacy is not None:
+            data = self.fileobj.read(CHUNK_SIZE)
+            if data:
+                self.buffer += self.legacy.decrypt(data)
+            else:
+                self.legacy.verify(self.legacy_tag)
+                self.eof = True
+            return
+        length = _read_exact(self.fileobj, 4)
+        if len(length) < 4:
+            raise ValueError("Encrypted file is truncated")
+        length = struct.unpack(">I", length)[0]
+        last = bool(length & LAST_FRAME)
+        length &= ~LAST_FRAME
+        # Checked before the frame is read, the length is not authenticated yet
+        if length > self.chunk_size:
+            raise ValueError("Encrypted file is corrupted, frame of " + str(length) + " bytes")
+        data = _read_exact(self.fileobj, length + TAG_SIZE)
+        if len(data) < length + TAG_SIZE:
+            raise ValueError("Encrypted file is truncated")
+        cipher = _frame_cipher(self.key, self.header, self.counter, last)
+        self.buffer += cipher.decrypt_and_verify(data[:length], data[length:])
+        self.counter += 1
+        self.eof = last
+        if last and self.check_end and self.fileobj.read(1):
+            raise ValueError("Encrypted file is corrupted, data after the last frame")
+
+    def read(self, size=-1):
+        while not self.eof and (size < 0 or len(self.buffer) < size):
+            self._read_frame()
+        if size < 0:
+            size = len(self.buffer)
+        data = bytes(self.buffer[:size])
+        del self.buffer[:size]
+        return data
+
+    def readable(self):
+        return True
+
+    def close(self):
+        pass
+
+
+def _read_exact(fileobj, size):
+    data = b""
+    while len(data) < size:
+        block = fileobj.read(size - len(data))
+        if not block:
+            break
+        data += block
+    return data
+
+
+def _chunk_size(header):
+    return struct.unpack(">I", header[len(MAGIC) + 1:len(MAGIC) + 5])[0]
+
+
+def read_header(fileobj):
+    '''
+    Return the header of a framed .bin stream read from fileobj
+    '''
+    header = _read_exact(fileobj, HEADER_SIZE)
+    if len(header) < HEADER_SIZE or header[:len(MAGIC)] != MAGIC or header[len(MAGIC)] != VERSION:
+        raise ValueError("Encrypted file is not in the framed format")
+    return header
+
+
+def frame_span(header, start, size):
+    '''
+    Return the frames holding size bytes of plaintext from start, as a tuple :
+    offset and size of the frames in the .bin file, counter of the first frame
+    and number of bytes of plaintext to skip in it
+    '''
+    chunk_size = _chunk_size(header)
+    first = start // chunk_size
+    last = (start + max(size, 1) - 1) // chunk_size
+    frame_size = chunk_size + FRAME_OVERHEAD
+    return HEADER_SIZE + first * frame_size, (last - first + 1) * frame_size, first, start - first * chunk_size
+
+
+def encrypt_stream(fin, fout, key, chunk_size=CHUNK_SIZE):
+    writer = EncryptWriter(fout, key, chunk_size)
+    while True:
+        data = fin.read(chunk_size)
+        if not data:
+            break
+        writer.write(data)
+    writer.close()
+
+
+def decrypt_stream(fin, fout, key):
+    reader = DecryptReader(fin, key)
+    while True:
+        data = reader.read(CHUNK_SIZE)
+        if not data:
+            break
+        fout.write(data)
+
+
+def encrypt_file(path,key,chunk_size=CHUNK_SIZE,tee=None):
+    '''
+    Encrypt the local file path to path.bin, in the same format as encrypt_stream
+    The file is mapped in memory MAP_FRAMES frames at a time, and each frame is
+    encrypted from the mapping into a buffer allocated once, so the memory used
+    does not depend on the size of the file and the plaintext is never copied
+        - tee: optional, file object the encrypted data is written to as well,
+          for example a checksums.Digest
+    '''
+    # The key length must be 16 (AES-128), 24 (AES-192), or 32 (AES-256) Bytes.
+    with open(path,"rb") as f, open(path + ".bin", "wb") as file_out:
+        outputs = [file_out] + ([tee] if tee else [])
+        header = _new_header(chunk_size)
+        for output in outputs:
+            output.write(header)
+        frame = memoryview(bytearray(chunk_size + FRAME_OVERHEAD))
+        size = os.fstat(f.fileno()).st_size
+        # Every frame but the last one is full, the last one may be empty
+        frames = size // chunk_size + 1
+        for first in range(0, frames, MAP_FRAMES):
+            count = min(MAP_FRAMES, frames - first)
+            offset = first * chunk_size
+            end = min(size, (first + count) * chunk_size)
+            # The offset of a mapping is a multiple of the allocation granularity
+            start = offset - offset % mmap.ALLOCATIONGRANULARITY
+            window = mmap.mmap(f.fileno(), end - start, access=mmap.ACCESS_READ, offset=start) if end > start else None
+            try:
+                with memoryview(window if window is not None else b"") as view:
+                    for counter in range(first, first + count):
+                        begin = counter * chunk_size - start
+                        frame_size = _encrypt_frame(key, header, counter, view[begin:min(begin + chunk_size, end - start)], frame, counter == frames - 1)
+                        for output in outputs:
+                            output.write(frame[:frame_size])
+            finally:
+                if window is not None:
+                    window.close()
+
+
+def decrypt_file(path,key):
     # output
     fullpath = Path(path)
     path_dest = fullpath.with_suffix('')
+    path_part = str(path_dest) + ".part"
 
-    with open(path_dest, "wb") as file_out:
-        file_out.write(clear_data)
\ No newline at end of file
+    # The plaintext is only moved in place once it has been fully verified
+    try:
+        with open(path,"rb") as f, open(path_part, "wb") as file_out:
+            decrypt_stream(f, file_out, key)
+    except:
+        os.remove(path_part)
+        raise
+    os.replace(path_part, path_dest)
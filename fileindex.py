@@ -0,0 +1,191 @@
+import os
+import json
+import stat
+import gzip
+import hashlib
+import tarfile
+import compress
+
+'''
+File-state index of the Wordpress site folder, used by differential backups
+
+The index is kept in LOCALBKPATH/index.json.gz and gives for each path of the
+site folder : size, modification time, inode and content hash at the time of
+the last backup. A file whose size, modification time and inode did not change
+is considered unchanged with a single stat. Other files are read and hashed,
+and only the files whose content changed are saved in the differential tar,
+with the list of the deleted paths.
+
+The index of the previous day is kept in LOCALBKPATH/index.previous.json.gz so
+that a second backup on the same day is made against the same base.
+
+The new index is written to LOCALBKPATH/index.pending.json.gz until the backup
+has been copied to BACKUP_DEST, so that an interrupted copy can be resumed.
+'''
+
+INDEX_FILE = "index.json.gz"
+PREVIOUS_INDEX_FILE = "index.previous.json.gz"
+PENDING_INDEX_FILE = "index.pending.json.gz"
+BUFFER_SIZE = 1024 * 1024
+
+
+def file_hash(path, limiter=None):
+    '''
+    Return the BLAKE2b hash of the content of path
+        - limiter: optional, pipeline.RateLimiter of the read of the file
+    '''
+    digest = hashlib.blake2b(digest_size=32)
+    with open(path, "rb") as f:
+        while True:
+            data = f.read(BUFFER_SIZE)
+            if not data:
+                break
+            if limiter is not None:
+                limiter.consume(len(data))
+            digest.update(data)
+    return digest.hexdigest()
+
+
+class HashReader:
+    '''
+    File object returning the data of fileobj and computing the same hash as file_hash
+        - limiter: optional, pipeline.RateLimiter of the read of fileobj
+    '''
+    def __init__(self, fileobj, limiter=None):
+        self.fileobj = fileobj
+        self.limiter = limiter
+        self.digest = hashlib.blake2b(digest_size=32)
+
+    def read(self, size=-1):
+        data = self.fileobj.read(size)
+        if self.limiter is not None:
+            self.limiter.consume(len(data))
+        self.digest.update(data)
+        return data
+
+    def hexdigest(self):
+        return self.digest.hexdigest()
+
+
+def read_index(path):
+    with gzip.open(path, "rt") as f:
+        return json.load(f)
+
+
+def write_index(path, index):
+    with gzip.open(path + ".tmp", "wt") as f:
+        json.dump(index, f)
+    os.replace(path + ".tmp", path)
+
+
+def load_index(folder, today):
+    '''
+    Return the index to use as base for a backup made today, or None
+    '''
+    for name in [INDEX_FILE, PREVIOUS_INDEX_FILE]:
+        try:
+            index = read_index(os.path.join(folder, name))
+        except FileNotFoundError:
+            continue
+        if index["date"] != today:
+            return index
+    return None
+
+
+def save_index(folder, index):
+    path = os.path.join(folder, INDEX_FILE)
+    try:
+        with gzip.open(path, "rt") as f:
+            current_date = json.load(f)["date"]
+    except FileNotFoundError:
+        current_date = None
+    # The index of a previous day is kept as base for another backup today
+    if current_date is not None and current_date != index["date"]:
+        os.replace(path, os.path.join(folder, PREVIOUS_INDEX_FILE))
+    write_index(path, index)
+    try:
+        os.remove(os.path.join(folder, PENDING_INDEX_FILE))
+    except FileNotFoundError:
+        pass
+
+
+def scan(path, base=None, limiter=None):
+    '''
+    Walk the folder path and compare it with the base index
+        - limiter: optional, pipeline.RateLimiter of the read of the files to hash
+    Return the new files dict of the index, the list of changed or new paths
+    and the list of deleted paths
+    Files dict : path -> [size, modification time in ns, inode, hash]
+    '''
+    old_files = base["files"] if base else {}
+    files = {}
+    changed = []
+    for root, dirs, names in os.walk(path):
+        dirs.sort()
+        for name in [None] + sorted(names) + [d for d in dirs if os.path.islink(os.path.join(root, d))]:
+            fullpath = root if name is None else os.path.join(root, name)
+            try:
+                st = os.lstat(fullpath)
+            except FileNotFoundError:
+                continue
+            old = old_files.get(fullpath)
+            if stat.S_ISREG(st.st_mode):
+                if old and old[:3] == [st.st_size, st.st_mtime_ns, st.st_ino]:
+                    # Unchanged, the file is not read
+                    files[fullpath] = old
+                    continue
+                content_hash = file_hash(fullpath, limiter)
+            elif stat.S_ISLNK(st.st_mode):
+                content_hash = "link:" + os.readlink(fullpath)
+            elif stat.S_ISDIR(st.st_mode):
+                content_hash = "dir"
+            else:
+                # Sockets, fifos and devices are not saved
+                continue
+            files[fullpath] = [st.st_size, st.st_mtime_ns, st.st_ino, content_hash]
+            if not old or old[3] != content_hash or (content_hash == "dir" and old[1] != st.st_mtime_ns):
+                changed.append(fullpath)
+    deleted = [p for p in old_files if p not in files]
+    return files, changed, deleted
+
+
+def tar_paths(fout, paths):
+    '''
+    Write to fout a tar stream of paths, without recursion in folders
+    '''
+    tar = tarfile.open(fileobj=fout, mode="w|")
+    for path in paths:
+        try:
+            tar.add(path, recursive=False)
+        except FileNotFoundError:
+            # Deleted since the scan
+            pass
+    tar.close()
+
+
+def write_deleted(deleted, path, codec=compress.DEFAULT_CODEC):
+    with open(path, "wb") as f:
+        compressor = compress.open_writer(codec, f)
+        compressor.write(json.dumps(deleted).encode())
+        compressor.close()
+
+
+def read_deleted(path, codec=compress.DEFAULT_CODEC):
+    with open(path, "rb") as f:
+        return json.loads(compress.open_reader(codec, f).read())
+
+
+def apply_deleted(deleted, dest="/"):
+    '''
+    Delete in dest the paths deleted since the previous backup
+    Paths are sorted in reverse order so that files are deleted before their folder
+    '''
+    for path in sorted(deleted, reverse=True):
+        fullpath = os.path.join(dest, path.lstrip("/"))
+        if os.path.islink(fullpath) or os.path.isfile(fullpath):
+            os.remove(fullpath)
+        elif os.path.isdir(fullpath):
+            try:
+                os.rmdir(fullpath)
+            except OSError:
+                pass
@@ -0,0 +1,107 @@
+import os
+import json
+import time
+import threading
+
+'''
+Journal of the transfers to and from BACKUP_DEST
+
+The journal is kept in LOCALBKPATH/transfers.json and records, while a file is
+transferred, what has already been done :
+
+    S3 multipart upload : upload id and ETag of each part already uploaded
+    S3 download         : parts already written in the local file
+    FTP upload          : byte offset reached on the FTP server
+    FTP download        : byte offset reached in each segment of the local file
+
+Each transfer is recorded with the state of its source (size, modification
+time or ETag). With --resume, a transfer whose source did not change continues
+from the journal instead of starting again from byte zero. The entry of a
+transfer is removed once it is completed.
+
+backup-wp.py also records the list of the files of the backup being copied so
+that --resume can copy them again without making a new backup.
+'''
+
+JOURNAL_FILE = "transfers.json"
+# Minimum delay in seconds between two writes of progress which is not forced
+SAVE_INTERVAL = 1
+
+
+class TransferJournal:
+    '''
+    Journal of the transfers, shared by the transfer threads
+        - path: journal file
+        - resume: if False, entries already in the journal are never resumed
+    '''
+    def __init__(self, path, resume=False):
+        self.path = path
+        self.resume = resume
+        self.lock = threading.RLock()
+        self.last_save = 0
+        try:
+            with open(path) as f:
+                self.data = json.load(f)
+        except FileNotFoundError:
+            self.data = {"transfers": {}}
+
+    def get(self, name):
+        return self.data["transfers"].get(name)
+
+    def resumable(self, name, state):
+        '''
+        Return the entry of the transfer name if it can be resumed, ie --resume
+        is used and its source is still in the same state, else None
+        '''
+        entry = self.get(name)
+        if self.resume and entry and entry["state"] == state:
+            return entry
+        return None
+
+    def start(self, name, state, **fields):
+        entry = dict(fields, state=state)
+        with self.lock:
+            self.data["transfers"][name] = entry
+            self.save()
+        return entry
+
+    def set(self, name, field, value, force=True):
+        with self.lock:
+            self.data["transfers"][name][field] = value
+            self.save(force)
+
+    def set_item(self, name, field, key, value, force=True):
+        with self.lock:
+            self.data["transfers"][name][field][key] = value
+            self.save(force)
+
+    def finish(self, name):
+        with self.lock:
+            self.data["transfers"].pop(name, None)
+            self.save()
+
+    def backup(self):
+        '''
+        Return the backup whose copy to BACKUP_DEST is not completed, or None
+        '''
+        return self.data.get("backup")
+
+    def start_backup(self, backup):
+        with self.lock:
+            self.data["backup"] = backup
+            self.save()
+
+    def clear_backup(self):
+        with self.lock:
+            self.data.pop("backup", None)
+            self.save()
+
+    def save(self, force=True):
+        with self.lock:
+            now = time.monotonic()
+            if not force and now - self.last_save < SAVE_INTERVAL:
+                return
+            with open(self.path + ".tmp", "w") as f:
+                json.dump(self.data, f)
+            os.replace(self.path + ".tmp", self.path)
+            self.last_save = now
@@ -0,0 +1,294 @@
+import io
+import os
+import random
+import time
+import shutil
+import tarfile
+import threading
+import subprocess
+import encrypt
+import compress
+
+'''
+Streaming of backup artifacts
+
+An artifact is produced (mysqldump output, tar of the site folder), compressed
+and encrypted in a single pass. The encrypted stream can be read by an upload
+function (S3 upload_fileobj, FTP storbinary) and optionally written at the same
+time to a local file.
+'''
+
+BUFFER_SIZE = 1024 * 1024
+
+
+class TeeWriter:
+    '''
+    File-like object writing the same data to several file objects
+    '''
+    def __init__(self, outputs):
+        self.outputs = outputs
+
+    def write(self, data):
+        for output in self.outputs:
+            output.write(data)
+        return len(data)
+
+    def flush(self):
+        for output in self.outputs:
+            output.flush()
+
+
+class RateLimiter:
+    '''
+    Token bucket limiting to rate bytes per second the total throughput of
+    the streams using it, shared by threads
+    A rate of 0 means no limit, the bytes are still counted in consumed so that
+    throttle.AdaptiveThrottle can measure the throughput and set a rate later
+    '''
+    def __init__(self, rate):
+        self.rate = rate
+        self.tokens = rate
+        self.last = time.monotonic()
+        self.consumed = 0
+        self.lock = threading.Lock()
+
+    def set_rate(self, rate):
+        with self.lock:
+            self.rate = rate
+            self.tokens = min(self.tokens, rate)
+            self.last = time.monotonic()
+
+    def consume(self, amount):
+        '''
+        Wait until amount bytes can be used
+        '''
+        with self.lock:
+            self.consumed += amount
+            if not self.rate:
+                return
+            now = time.monotonic()
+            # At most one second of unused throughput is kept
+            self.tokens = min(self.rate, self.tokens + (now - self.last) * self.rate)
+            self.last = now
+            self.tokens -= amount
+            wait = -self.tokens / self.rate
+        if wait > 0:
+            time.sleep(wait)
+
+
+def copyStream(fin, fout, limiter=None):
+    '''
+    Copy fin to fout, at the throughput allowed by limiter if any
+    '''
+    if limiter is None:
+        shutil.copyfileobj(fin, fout, BUFFER_SIZE)
+        return
+    while True:
+        data = fin.read(BUFFER_SIZE)
+        if not data:
+            break
+        limiter.consume(len(data))
+        fout.write(data)
+
+
+def mysqldump(fout, host, name, options=None, tables=None, limiter=None):
+    '''
+    Write the output of mysqldump for the database name to fout
+        - options: additional options of mysqldump
+        - tables: optional, list of the tables to dump
+        - limiter: optional, RateLimiter of the read of the output
+    As mysqldump reads the rows while they are written, limiting the read of its
+    output also limits the rate at which the rows are read from the server
+    '''
+    process = subprocess.Popen(["mysqldump", "-h", host] + (options or []) + [name] + (tables or []), stdout=subprocess.PIPE)
+    try:
+        copyStream(process.stdout, fout, limiter)
+    except:
+        # mysqldump would keep its locks while waiting for its output to be read
+        process.kill()
+        raise
+    finally:
+        process.stdout.close()
+        process.wait()
+    if process.returncode != 0:
+        raise RuntimeError("mysqldump exited with code " + str(process.returncode))
+
+
+def mysqlimport(fin, host, name):
+    '''
+    Import in the database name the SQL statements read from fin
+    '''
+    process = subprocess.Popen(["mysql", "-h", host, name], stdin=subprocess.PIPE)
+    try:
+        shutil.copyfileobj(fin, process.stdin, BUFFER_SIZE)
+    finally:
+        process.stdin.close()
+    if process.wait() != 0:
+        raise RuntimeError("mysql exited with code " + str(process.returncode))
+
+
+def sampleMysqldump(host, name, size):
+    '''
+    Return the first size bytes of the mysqldump output for the database name
+    '''
+    process = subprocess.Popen(["mysqldump", "-h", host, name], stdout=subprocess.PIPE)
+    data = process.stdout.read(size)
+    process.stdout.close()
+    process.kill()
+    process.wait()
+    return data
+
+
+def sampleFolder(path, size):
+    '''
+    Return a tar of files picked at random in the folder path, up to size bytes
+    '''
+    files = []
+    for root, dirs, names in os.walk(path):
+        files.extend(os.path.join(root, name) for name in names)
+    random.shuffle(files)
+    sample = io.BytesIO()
+    tar = tarfile.open(fileobj=sample, mode="w|")
+    for file in files:
+        if sample.tell() >= size:
+            break
+        try:
+            tar.add(file)
+        except OSError:
+            pass
+    tar.close()
+    return sample.getvalue()[:size]
+
+
+def tarfolder(fout, path):
+    '''
+    Write a tar stream of the folder path to fout
+    '''
+    tar = tarfile.open(fileobj=fout, mode="w|")
+    tar.add(path)
+    tar.close()
+
+
+def untar(fin, path="/", select=None):
+    '''
+    Extract the tar stream read from fin in the folder path
+        - select: optional, function called with the name of each member, only
+          the members for which it returns True are extracted
+    '''
+    tar = tarfile.open(fileobj=fin, mode="r|")
+    tar.extractall(path, members=(tarinfo for tarinfo in tar if select(tarinfo.name)) if select else None)
+    tar.close()
+
+
+def readArtifact(fin, key, consumer, codec=compress.DEFAULT_CODEC):
+    '''
+    Call consumer with a file object returning the content of the encrypted
+    artifact read from fin, decrypted then decompressed with codec
+    The artifact is read until its end, so that its last frame is verified,
+    and fin is closed
+    '''
+    try:
+        reader = compress.open_reader(codec, encrypt.DecryptReader(fin, key))
+        consumer(reader)
+        while reader.read(BUFFER_SIZE):
+            pass
+    finally:
+        fin.close()
+
+
+def readRange(open_source, key, header, offset, size, consumer):
+    '''
+    Call consumer with a file object returning the content of the encrypted
+    artifact from offset, decrypted, for at least size bytes
+    Only the frames holding these bytes are read
+        - open_source: function called with an offset and a size, returning a
+          file object reading these bytes of the encrypted artifact
+        - header: header of the encrypted artifact (encrypt.read_header)
+    '''
+    source_offset, source_size, counter, skip = encrypt.frame_span(header, offset, size)
+    fin = open_source(source_offset, source_size)
+    try:
+        reader = encrypt.DecryptReader(fin, key, header, counter)
+        reader.read(skip)
+        consumer(reader)
+    finally:
+        fin.close()
+
+
+def writeArtifact(fout, key, producer, codec=compress.DEFAULT_CODEC, level=None, workers=None):
+    '''
+    Call producer with a file object whose content is compressed with codec
+    then encrypted to fout
+    '''
+    writer = encrypt.EncryptWriter(fout, key)
+    compressor = compress.open_writer(codec, writer, level, workers)
+    try:
+        producer(compressor)
+    except BaseException:
+        compress.abort_writer(compressor)
+        raise
+    compressor.close()
+    writer.close()
+
+
+class ArtifactStream:
+    '''
+    Readable file object returning an encrypted artifact while it is produced
+        - producer: function called with the file object to write the artifact into
+        - key: AES key
+        - localpath: optional, local copy of the encrypted artifact
+        - codec, level, workers: compression codec, level and number of compression threads
+        - digest: optional, checksums.Digest of the encrypted artifact
+    If the producer fails, read() raises its error instead of returning the end
+    of the stream, so that the upload is aborted instead of committing a
+    truncated artifact. close() must be called once the stream has been
+    consumed, it raises the error of the producer as well.
+    '''
+    def __init__(self, producer, key, localpath=None, codec=compress.DEFAULT_CODEC, level=None, workers=None, digest=None):
+        rfd, wfd = os.pipe()
+        self.reader = os.fdopen(rfd, "rb")
+        self.writer = os.fdopen(wfd, "wb")
+        self.localpath = localpath
+        self.digest = digest
+        self.error = None
+        self.thread = threading.Thread(target=self._run, args=(producer, key, codec, level, workers), daemon=True)
+        self.thread.start()
+
+    def _run(self, producer, key, codec, level, workers):
+        local = None
+        try:
+            outputs = [self.writer]
+            if self.localpath:
+                local = open(self.localpath, "wb")
+                outputs.append(local)
+            if self.digest:
+                outputs.append(self.digest)
+            writeArtifact(TeeWriter(outputs), key, producer, codec, level, workers)
+        except BaseException as e:
+            self.error = e
+        finally:
+            try:
+                self.writer.close()
+            except BrokenPipeError:
+                pass
+            if local:
+                local.close()
+
+    def read(self, size=-1):
+        data = self.reader.read(size)
+        if not data and size != 0:
+            # The pipe is closed once the producer is done, successfully or not
+            self.thread.join()
+            if self.error:
+                raise self.error
+        return data
+
+    def readable(self):
+        return True
+
+    def close(self):
+        # Closing the read end first stops a producer whose consumer gave up
+        self.reader.close()
+        self.thread.join()
+        if self.error:
+            raise self.error
@@ -0,0 +1,261 @@
+import os
+import json
+import time
+import resource
+import threading
+
+'''
+Report of a run of backup-wp.py
+
+Each stage of the run (rotation, dump, site, encrypt, upload...) is timed with
+the bytes it read and wrote and the peak resident memory during the stage. The
+report is written at the end of the run, whether it succeeded or not :
+
+    {"run": "daily", "binlog" or "resume", "site": ..., "date": "YYYYMMDD", "status": "success" or "failed",
+     "failed_stage": ..., "started": unix time, "duration": ...,
+     "stages": [{"name": ..., "duration": ..., "bytes_in": ..., "bytes_out": ..., "mb_per_s": ...,
+                 "peak_rss": ..., "peak_rss_children": ..., "overlapped": false}, ...]}
+
+site is the name of the site given by backup-sites-wp.py, else null.
+
+bytes_in is the data read by the stage (uncompressed dump, files of the site,
+plain files to encrypt...), bytes_out the data it wrote. mb_per_s is computed
+on the bigger of the two.
+
+In stream mode, the dump and the archive of the site are produced during the
+upload : they are overlapped stages, measured from the start of their first
+producer to the end of the last one.
+
+peak_rss is the peak resident memory of the process during the stage, reset at
+the start of each stage through /proc/self/clear_refs on Linux, else the peak
+since the start of the run. peak_rss_children is the biggest peak of the child
+processes (mysqldump, mysqlbinlog) ended so far.
+'''
+
+PROMETHEUS_PREFIX = "wordpress_backup"
+
+
+def _peak_rss():
+    '''
+    Return the peak resident memory of the process in bytes since the last reset
+    '''
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def _reset_peak_rss():
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+    except OSError:
+        # Not Linux or not allowed, the peak of the whole run is reported
+        pass
+
+
+def _peak_rss_children():
+    return resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * 1024
+
+
+class Stage:
+    '''
+    Duration, bytes read and written and peak memory of a stage, add() may be called by several threads
+    '''
+    def __init__(self, name, overlapped=False):
+        self.name = name
+        self.overlapped = overlapped
+        self.duration = 0.0
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.peak_rss = 0
+        self.peak_rss_children = 0
+        # Duration before the first producer, first start and last end of the producers of an overlapped stage
+        self.base = 0.0
+        self.first = None
+        self.last = None
+        self.lock = threading.Lock()
+
+    def add(self, bytes_in=0, bytes_out=0):
+        with self.lock:
+            self.bytes_in += bytes_in
+            self.bytes_out += bytes_out
+
+    def _measured(self):
+        self.peak_rss = max(self.peak_rss, _peak_rss())
+        self.peak_rss_children = max(self.peak_rss_children, _peak_rss_children())
+
+    def to_dict(self):
+        volume = max(self.bytes_in, self.bytes_out)
+        return {"name": self.name, "duration": round(self.duration, 3),
+                "bytes_in": self.bytes_in, "bytes_out": self.bytes_out,
+                "mb_per_s": round(volume / 1048576 / self.duration, 2) if self.duration else 0,
+                "peak_rss": self.peak_rss, "peak_rss_children": self.peak_rss_children,
+                "overlapped": self.overlapped}
+
+
+class CountingWriter:
+    '''
+    File object writing to fout and adding the bytes written to the bytes_in of stage
+    '''
+    def __init__(self, fout, stage):
+        self.fout = fout
+        self.stage = stage
+
+    def write(self, data):
+        self.stage.add(bytes_in=len(data))
+        return self.fout.write(data)
+
+    def flush(self):
+        self.fout.flush()
+
+
+class RunReport:
+    '''
+    Stages of a run, started one after the other with start(), or overlapped with measure()
+        - site: optional, name of the site, added to the labels of the Prometheus metrics
+    '''
+    def __init__(self, run, date, site=None):
+        self.run = run
+        self.date = date
+        self.site = site
+        self.started = time.time()
+        self.start_time = time.monotonic()
+        self.stages = {}
+        self.current = None
+        self.current_start = None
+        self.status = None
+        self.failed_stage = None
+        self.duration = 0.0
+
+    def stage(self, name, overlapped=False):
+        if name not in self.stages:
+            self.stages[name] = Stage(name, overlapped)
+        return self.stages[name]
+
+    def start(self, name):
+        '''
+        End the current stage and start the stage name, a stage started again adds to its duration
+        '''
+        self.end()
+        _reset_peak_rss()
+        self.current = self.stage(name)
+        self.current_start = time.monotonic()
+        return self.current
+
+    def end(self):
+        if self.current is None:
+            return
+        self.current.duration += time.monotonic() - self.current_start
+        self.current._measured()
+        self.current = None
+
+    def measure(self, name, producer, count=True):
+        '''
+        Return producer measured in the stage name, which becomes an overlapped stage
+        The time from the start of the first producer to the end of the last one
+        is added to the duration of the stage
+            - count: if True, the bytes written by producer are added to bytes_in
+        '''
+        stage = self.stage(name)
+        stage.overlapped = True
+
+        def measured(fout):
+            return self._overlap(stage, lambda: producer(CountingWriter(fout, stage) if count else fout))
+        return measured
+
+    def measure_call(self, name, function):
+        '''
+        Return function, called without argument, measured in the stage name as by measure()
+        '''
+        stage = self.stage(name)
+        stage.overlapped = True
+        return lambda: self._overlap(stage, function)
+
+    def _overlap(self, stage, function):
+        with stage.lock:
+            if stage.first is None:
+                stage.base = stage.duration
+                stage.first = time.monotonic()
+        try:
+            return function()
+        finally:
+            with stage.lock:
+                stage.last = max(stage.last or 0, time.monotonic())
+                stage.duration = stage.base + stage.last - stage.first
+            stage._measured()
+
+    def finish(self, success):
+        if not success and self.current is not None:
+            self.failed_stage = self.current.name
+        self.end()
+        self.status = "success" if success else "failed"
+        self.duration = time.monotonic() - self.start_time
+
+    def path(self, path):
+        '''
+        Return the path of the report of this run, the runs --binlog and --resume do not replace the report of the daily backup
+        '''
+        if self.run == "daily":
+            return path
+        root, extension = os.path.splitext(path)
+        return root + "-" + self.run + extension
+
+    def to_dict(self):
+        return {"run": self.run, "site": self.site, "date": self.date, "status": self.status, "failed_stage": self.failed_stage,
+                "started": int(self.started), "duration": round(self.duration, 3),
+                "stages": [stage.to_dict() for stage in self.stages.values()]}
+
+    def write_json(self, path):
+        with open(path + ".tmp", "w") as f:
+            json.dump(self.to_dict(), f, indent=1)
+        os.replace(path + ".tmp", path)
+
+    def write_prometheus(self, path):
+        '''
+        Write the report in the text format of Prometheus, for the textfile collector of node_exporter
+        The file is replaced in a single rename so that it is never read partially written
+        '''
+        labels = 'run="' + self.run + '"'
+        if self.site:
+            labels += ',site="' + self.site + '"'
+        lines = []
+
+        def metric(name, help, samples):
+            lines.append("# HELP " + PROMETHEUS_PREFIX + "_" + name + " " + help)
+            lines.append("# TYPE " + PROMETHEUS_PREFIX + "_" + name + " gauge")
+            for sample_labels, value in samples:
+                lines.append(PROMETHEUS_PREFIX + "_" + name + "{" + sample_labels + "} " + str(value))
+
+        metric("success", "1 if the last backup succeeded, else 0", [(labels, int(self.status == "success"))])
+        metric("last_run_timestamp_seconds", "Start time of the last backup", [(labels, int(self.started))])
+        metric("duration_seconds", "Duration of the last backup", [(labels, round(self.duration, 3))])
+        stages = [(labels + ',stage="' + stage.name + '"', stage.to_dict()) for stage in self.stages.values()]
+        for name, field, help in [("stage_duration_seconds", "duration", "Duration of the stage"),
+                                  ("stage_bytes_in", "bytes_in", "Bytes read by the stage"),
+                                  ("stage_bytes_out", "bytes_out", "Bytes written by the stage"),
+                                  ("stage_throughput_mb_per_second", "mb_per_s", "Throughput of the stage in MB/s"),
+                                  ("stage_peak_rss_bytes", "peak_rss", "Peak resident memory of the process during the stage")]:
+            metric(name, help + " in the last backup", [(stage_labels, values[field]) for stage_labels, values in stages])
+        with open(path + ".tmp", "w") as f:
+            f.write("\n".join(lines) + "\n")
+        os.replace(path + ".tmp", path)
+
+    def summary(self):
+        '''
+        Return the stages as a text table, for the mail sent at the end of the run
+        '''
+        lines = ["%-16s %9s %11s %11s %9s %10s" % ("Stage", "Seconds", "MB in", "MB out", "MB/s", "Peak RSS")]
+        for stage in self.stages.values():
+            values = stage.to_dict()
+            lines.append("%-16s %9.1f %11.1f %11.1f %9.1f %7.0f MB" % (stage.name + (" *" if stage.overlapped else ""), values["duration"],
+                                                                       values["bytes_in"] / 1048576, values["bytes_out"] / 1048576,
+                                                                       values["mb_per_s"], values["peak_rss"] / 1048576))
+        lines.append("%-16s %9.1f" % ("Total", self.duration))
+        if any(stage.overlapped for stage in self.stages.values()):
+            lines.append("* produced during the upload")
+        return "\n".join(lines)
@@ -29,26 +29,56 @@ import datetime
 import pipes
 import sys
 import configparser
-import tarfile
 import boto3
 import ftplib
 import tools
 import random
 import argparse
 import encrypt
+import compress
+import pipeline
+import dedup
+import fileindex
+import journal
+import dbdump
+import binlog
+import archive
+import transfer
 from botocore.config import Config
+from concurrent.futures import ThreadPoolExecutor
 
 
 # By Default, this script will read configuration from file /etc/backup-wp.conf
 #
-# Todo : Add the option -f to read parameters from a specified filename in the command line parameter
+# The option -f reads the configuration from another file
 '''
 1) Copy files from remote location ie FTP or S3 to /data/backup/RESTORE-DATE
 2) Decrypt files
 3) Import SQL backup in MySQL
-4) Untar Site backup
+4) Untar Site backup, at the same time as 3)
+With --stream, the database dump and the site archive are not copied : they are
+read from the remote location, decrypted and decompressed while they are imported
+With --include or --exclude, only the blocks of the site archive holding the
+selected files are read from the remote location
 '''
-CONFIG_FILE = "/etc/backup-wp.conf"
+# create parser
+parser = argparse.ArgumentParser()
+
+# add arguments to the parser
+parser.add_argument("-d","--day",type=int,default=0,help="index of day in the past to be restored. Possible value from 0 to BACKUP_RETENTION - 1")
+parser.add_argument("-l","--local",action='store_true', help="Restore from local backup folders only")
+parser.add_argument("--resume",action='store_true',help="Resume the downloads of a restore interrupted by an error the same day")
+parser.add_argument("-s","--stream",action='store_true',help="Import the database and extract the site while they are downloaded, without temporary files")
+parser.add_argument("--include",action='append',metavar="GLOB",help="Restore only the files of the site matching GLOB, relative to WP_PATH, without the database. Can be repeated")
+parser.add_argument("--exclude",action='append',metavar="GLOB",help="Do not restore the files of the site matching GLOB, relative to WP_PATH. Can be repeated")
+parser.add_argument("--until",help="Replay the binary logs copied by backup-wp.py --binlog after the dump up to this time, format \"YYYY-MM-DD HH:MM:SS\"")
+parser.add_argument("-v","--verbose",type=int,default=0,choices=[0,1,2],help="0 disable verbose, 1 minimal verbose, 2 debug mode")
+parser.add_argument("-f","--config",default="/etc/backup-wp.conf",help="Configuration file, /etc/backup-wp.conf by default")
+
+# parse the arguments
+args = parser.parse_args()
+
+CONFIG_FILE = args.config
 
 config = configparser.ConfigParser()
 config.read(CONFIG_FILE)
@@ -56,6 +86,10 @@ config.read(CONFIG_FILE)
 WP_PATH = config.get('WP','WP_PATH')
 DB_HOST = config.get('DB','DB_HOST')
 DB_NAME = config.get('DB','DB_NAME')
+# Number of parts imported at the same time for a database dumped table by table
+DB_DUMP_WORKERS = config.getint('DB','DB_DUMP_WORKERS',fallback=dbdump.DEFAULT_WORKERS)
+# Number of runs of blocks of an indexed site archive extracted at the same time
+SITE_WORKERS = config.getint('BACKUP','SITE_WORKERS',fallback=archive.DEFAULT_WORKERS)
 
 SMTP_HOST = config.get('SMTP','SMTP_HOST')
 SMTP_FROM = config.get('SMTP','SMTP_FROM')
@@ -64,23 +98,31 @@ SMTP_TO = config.get('SMTP','SMTP_TO')
 BACKUP_DEST = config.get('BACKUP','BACKUP_DEST')
 BACKUP_PATH = config.get('BACKUP','LOCALBKPATH')
 BACKUP_RETENTION = config.get('BACKUP','BACKUP_RETENTION')
+CHUNK_STORE = config.get('BACKUP','CHUNK_STORE',fallback=BACKUP_PATH + "/chunks")
 
 ENCRYPTION_KEYPATH = config.get('ENCRYPT','KEYPATH')
 
-# create parser
-parser = argparse.ArgumentParser()
-
-# add arguments to the parser
-parser.add_argument("-d","--day",type=int,default=0,help="index of day in the past to be restored. Possible value from 0 to BACKUP_RETENTION - 1")
-parser.add_argument("-l","--local",action='store_true', help="Restore from local backup folders only")
-parser.add_argument("-v","--verbose",type=int,default=0,choices=[0,1,2],help="0 disable verbose, 1 minimal verbose, 2 debug mode")
-
-# parse the arguments
-args = parser.parse_args()
-
 DAYTORESTORE=args.day
 VERBOSE = args.verbose
 LOCALRESTORE = args.local
+RESUME = args.resume
+STREAM = args.stream
+UNTIL = args.until
+# Function telling if a file of the site is restored, None to restore the whole site
+SITE_SELECT = archive.selector(args.include,args.exclude,WP_PATH)
+# Only the selected files of the site are restored with --include
+RESTORE_DATABASE = not args.include
+
+if UNTIL and not RESTORE_DATABASE:
+    print("--until can not be used with --include, the database is not restored. Exiting")
+    exit(1)
+
+if UNTIL:
+    try:
+        time.strptime(UNTIL,binlog.TIME_FORMAT)
+    except ValueError:
+        print("Bad value of --until " + UNTIL + ", format should be \"YYYY-MM-DD HH:MM:SS\". Exiting")
+        exit(1)
 
 if LOCALRESTORE:
     BACKUP_DEST = 'LOCAL'
@@ -90,15 +132,25 @@ if BACKUP_DEST == 'S3':
     S3_ACCESS_KEY = config.get('BACKUP','S3_ACCESS_KEY')
     S3_SECRET_ACCESS_KEY = config.get('BACKUP','S3_SECRET_ACCESS_KEY')
     S3_DEFAULT_REGION = config.get('BACKUP','S3_DEFAULT_REGION')
+    S3_ENDPOINT_URL = config.get('BACKUP','S3_ENDPOINT_URL',fallback=None)
+    S3_LAYOUT = config.get('BACKUP','S3_LAYOUT',fallback='slots')
+    S3_MULTIPART_CHUNKSIZE = config.getint('BACKUP','S3_MULTIPART_CHUNKSIZE',fallback=8)
+    S3_MAX_CONCURRENCY = config.getint('BACKUP','S3_MAX_CONCURRENCY',fallback=10)
+    S3_FILES_IN_FLIGHT = config.getint('BACKUP','S3_FILES_IN_FLIGHT',fallback=3)
+    CHUNK_S3_BUCKET = config.get('BACKUP','CHUNK_S3_BUCKET',fallback=S3_BUCKET)
 elif BACKUP_DEST == 'FTP':
     FTP_SERVER = config.get('BACKUP','FTP_SERVER')
     FTP_USER = config.get('BACKUP','FTP_USER')
     FTP_PASSWD = config.get('BACKUP','FTP_PASSWD')
     FTP_PATH = config.get('BACKUP','FTP_PATH')
+    FTP_SESSIONS = config.getint('BACKUP','FTP_SESSIONS',fallback=4)
+    FTP_BLOCK_SIZE = config.getint('BACKUP','FTP_BLOCK_SIZE',fallback=256) * 1024
+    FTP_SEGMENT_SIZE = config.getint('BACKUP','FTP_SEGMENT_SIZE',fallback=64) * 1024 * 1024
+    CHUNK_FTP_PATH = config.get('BACKUP','CHUNK_FTP_PATH',fallback=dedup.REMOTE_FOLDER)
 elif BACKUP_DEST == 'LOCAL':
     pass
 else:
-    print("Bad value in " + CONFIG_FILE + ". Value of BACKUP_DEST should be S3 or FTP only. Exiting")
+    print("Bad value in " + CONFIG_FILE + ". Value of BACKUP_DEST should be S3, FTP or LOCAL only. Exiting")
     exit(1)
 
 if BACKUP_DEST == 'LOCAL':
@@ -123,10 +175,122 @@ else:
 
 
 
+fdKey = open(ENCRYPTION_KEYPATH,'rb')
+ENCRYPTION_KEY = fdKey.read()
+
+# Parts or offsets of the downloads already done, used by --resume
+TRANSFER_JOURNAL = journal.TransferJournal(BACKUP_PATH + "/" + journal.JOURNAL_FILE,RESUME)
+
+# Local path of each file which is not downloaded -> function called with an optional offset
+# and size, opening it on BACKUP_DEST
+STREAM_SOURCES = {}
+# Header of the encrypted files read by ranges
+STREAM_HEADERS = {}
+
+def sourceFilenames(metadata, filenames):
+    '''
+    Return the files of filenames which are read directly from BACKUP_DEST instead of being downloaded,
+    ie with --stream the database dump and the site archive, and with --include or --exclude an indexed site archive
+    '''
+    sources = tools.streamFilenames(metadata) if STREAM else []
+    if SITE_SELECT and "site_index" in metadata:
+        sources.append(metadata["site"] + ".bin")
+    return [filename for filename in filenames if filename in sources]
+
+def openS3(key, offset=0, size=None):
+    if size is None:
+        return s3_client.get_object(Bucket=S3_BUCKET,Key=key)["Body"]
+    return s3_client.get_object(Bucket=S3_BUCKET,Key=key,Range="bytes=" + str(offset) + "-" + str(offset + size - 1))["Body"]
+
+def openLocal(path, offset=0, size=None):
+    f = open(path,"rb")
+    f.seek(offset)
+    return f
+
+def restoreRange(path, offset, size, consumer):
+    '''
+    Call consumer with a file object returning the decrypted content of the backup file path from offset, for at least size bytes
+    Only the frames holding them are read if the file is streamed, else the local decrypted file is read
+    '''
+    source = path + ".bin"
+    if source in STREAM_SOURCES:
+        if source not in STREAM_HEADERS:
+            fin = STREAM_SOURCES[source](0,encrypt.HEADER_SIZE)
+            try:
+                STREAM_HEADERS[source] = encrypt.read_header(fin)
+            finally:
+                fin.close()
+        pipeline.readRange(STREAM_SOURCES[source],ENCRYPTION_KEY,STREAM_HEADERS[source],offset,size,consumer)
+    else:
+        with open(path,"rb") as f:
+            f.seek(offset)
+            consumer(f)
+
+def manifestFilenames(metadata):
+    '''
+    Return the .bin files of a backup read without being decrypted, ie the manifests
+    of a deduplicated backup and of a database dumped table by table
+    '''
+    filenames = []
+    if metadata.get("database_mode") == "tables":
+        filenames.append(metadata["database"] + ".bin")
+    if metadata.get("site_mode") == "dedup":
+        filenames.append(metadata["site"] + ".bin")
+    return filenames
+
+# Downloads and decryptions, each file being decrypted while the next ones are downloaded
+TRANSFER_ENGINE = transfer.TransferEngine({"network": S3_FILES_IN_FLIGHT if BACKUP_DEST == 'S3' else FTP_SESSIONS if BACKUP_DEST == 'FTP' else 1,
+                                           "cpu": transfer.DECRYPTIONS})
+# Files decrypted by TRANSFER_ENGINE
+DECRYPTED = set()
+
+def decryptFile(file):
+    print("Decrypting " + os.path.basename(file))
+    encrypt.decrypt_file(file,ENCRYPTION_KEY)
+    DECRYPTED.add(file)
+
+def retrieveFiles(transfers, encrypted=()):
+    '''
+    Submit to TRANSFER_ENGINE the download of transfers, list of (local path, remote path), one operation per file
+    Each file is decrypted once downloaded, except the ones whose name is in encrypted
+    '''
+    for path, remote in transfers:
+        if BACKUP_DEST == 'S3':
+            TRANSFER_ENGINE.submit("download of " + path,"network",tools.downloadFilesS3,s3_client,S3_BUCKET,[(path,remote)],transfer_config,1,VERBOSE,TRANSFER_JOURNAL)
+        else:
+            TRANSFER_ENGINE.submit("download of " + path,"network",tools.downloadFilesftp,ftppool,[(path,remote)],FTP_BLOCK_SIZE,FTP_SEGMENT_SIZE,VERBOSE,TRANSFER_JOURNAL)
+        if os.path.basename(path) not in encrypted:
+            TRANSFER_ENGINE.submit("decryption of " + path,"cpu",decryptFile,path,after=["download of " + path])
+
+def waitTransfers(names=None):
+    '''
+    Wait for the operations names of TRANSFER_ENGINE, all of them by default, exit if one failed
+    '''
+    try:
+        TRANSFER_ENGINE.wait(None if names is None else [name for name in names if name in TRANSFER_ENGINE.operations])
+    except transfer.TransferError as e:
+        print("Error during " + str(e) + ". Exiting")
+        exit(1)
+
+def restoreArtifact(path, codec, consumer):
+    '''
+    Call consumer with a file object returning the decompressed content of the backup file path
+    The encrypted file is read from BACKUP_DEST if it is streamed, else the local decrypted file is read
+    '''
+    if path + ".bin" in STREAM_SOURCES:
+        pipeline.readArtifact(STREAM_SOURCES[path + ".bin"](),ENCRYPTION_KEY,consumer,codec)
+    else:
+        with open(path,"rb") as f:
+            consumer(compress.open_reader(codec,f))
+
 # Part1 : Retrieve backup files
+# The metadata file gives the codec and the names of the other files
 
-MysqlBackupFilename="wordpress.sql.gz.bin"
-WordPressBackupFilename="wordpress.site.tar.gz.bin"
+MetadataFilename="backup.json.bin"
+
+# Metadata of a previous restore must not be used
+if BACKUP_DEST != 'LOCAL' and os.path.exists(TODAYRESTOREPATH + "/" + MetadataFilename):
+    os.remove(TODAYRESTOREPATH + "/" + MetadataFilename)
 
 if BACKUP_DEST == 'S3':
     print ("")
@@ -139,36 +303,42 @@ if BACKUP_DEST == 'S3':
         retries = {
             'max_attempts': 10,
             'mode': 'standard'
-        }
+        },
+        max_pool_connections = max(10, S3_MAX_CONCURRENCY * S3_FILES_IN_FLIGHT)
     )
-
+    transfer_config = tools.s3TransferConfig(S3_MULTIPART_CHUNKSIZE, S3_MAX_CONCURRENCY)
 
     s3_client = boto3.client(
         's3',
+        endpoint_url=S3_ENDPOINT_URL,
         aws_access_key_id=S3_ACCESS_KEY,
         aws_secret_access_key=S3_SECRET_ACCESS_KEY,
         config=my_config
     )
 
-    if DAYTORESTORE == 0:
-        S3_PATH = "DAYJ"
-    else:
-        S3_PATH = "DAYJ-" + str(DAYTORESTORE)
+    # Prefix of DAYJ, DAYJ-1..., read from the index with the dated layout
+    S3_SLOTS = tools.slotPathsS3(s3_client,S3_BUCKET,S3_LAYOUT,BACKUP_RETENTION)
+    if DAYTORESTORE >= len(S3_SLOTS):
+        print("No backup for DAYJ-" + str(DAYTORESTORE) + " in " + S3_BUCKET + ". Exiting")
+        exit(1)
+    S3_PATH = S3_SLOTS[DAYTORESTORE]
+    if VERBOSE >= 1:
+        print("Restore of " + S3_PATH)
 
-    for filename in [MysqlBackupFilename,WordPressBackupFilename]:
-        FileFullPath=pipes.quote(TODAYRESTOREPATH) + "/" + filename
-        KEY=S3_PATH + "/" + filename
-        with open(FileFullPath, 'wb') as f:
-            try:
-                s3_client.download_file(Bucket=S3_BUCKET,Key=KEY,Filename=FileFullPath)
-            except:
-                if VERBOSE == 2:
-                    print("Error during download of " + KEY)
-                exit(1)
-
-
-    print ("")
-    print ("Download from AWS S3 completed")
+    try:
+        s3_client.download_file(Bucket=S3_BUCKET,Key=S3_PATH + "/" + MetadataFilename,Filename=TODAYRESTOREPATH + "/" + MetadataFilename)
+    except:
+        if VERBOSE == 2:
+            print("No metadata in " + S3_PATH + ", backup made by a previous version")
+    METADATA = tools.readMetadata(TODAYRESTOREPATH + "/" + MetadataFilename,ENCRYPTION_KEY)
+    MysqlBackupFilename = METADATA["database"] + ".bin"
+    WordPressBackupFilename = METADATA["site"] + ".bin"
+
+    FILENAMES = ([MysqlBackupFilename] if RESTORE_DATABASE else []) + tools.siteFilenames(METADATA)
+    for filename in sourceFilenames(METADATA,FILENAMES):
+        FILENAMES.remove(filename)
+        STREAM_SOURCES[TODAYRESTOREPATH + "/" + filename] = lambda offset=0, size=None, key=S3_PATH + "/" + filename: openS3(key,offset,size)
+    retrieveFiles([(TODAYRESTOREPATH + "/" + filename, S3_PATH + "/" + filename) for filename in FILENAMES],manifestFilenames(METADATA))
 
 elif BACKUP_DEST == 'FTP':
     print ("")
@@ -181,51 +351,260 @@ elif BACKUP_DEST == 'FTP':
     ftpserver=tools.connectftp(FTP_SERVER,FTP_USER,FTP_PASSWD)
     ftpserver.cwd(FTP_PATH + "/" + RESTORE_FOLDER)
 
-    for file in [MysqlBackupFilename,WordPressBackupFilename]:
-        print("Transfering" + file)
-        result=tools.downloadftp(ftpserver,file,TODAYRESTOREPATH)
+    try:
+        tools.downloadftp(ftpserver,MetadataFilename,TODAYRESTOREPATH)
+    except ftplib.error_perm:
+        os.remove(TODAYRESTOREPATH + "/" + MetadataFilename)
+        if VERBOSE == 2:
+            print("No metadata in " + RESTORE_FOLDER + ", backup made by a previous version")
+    METADATA = tools.readMetadata(TODAYRESTOREPATH + "/" + MetadataFilename,ENCRYPTION_KEY)
+    MysqlBackupFilename = METADATA["database"] + ".bin"
+    WordPressBackupFilename = METADATA["site"] + ".bin"
+
+    ftppool = tools.FTPPool(FTP_SERVER,FTP_USER,FTP_PASSWD,FTP_SESSIONS,FTP_PATH + "/" + RESTORE_FOLDER)
+    FILENAMES = ([MysqlBackupFilename] if RESTORE_DATABASE else []) + tools.siteFilenames(METADATA)
+    for filename in sourceFilenames(METADATA,FILENAMES):
+        FILENAMES.remove(filename)
+        STREAM_SOURCES[TODAYRESTOREPATH + "/" + filename] = lambda offset=0, size=None, ficftp=filename: ftppool.open(ficftp,offset)
+    retrieveFiles([(TODAYRESTOREPATH + "/" + file, file) for file in FILENAMES],manifestFilenames(METADATA))
 
-    tools.closeftp(ftpserver)
 
+else:
+    METADATA = tools.readMetadata(TODAYRESTOREPATH + "/" + MetadataFilename,ENCRYPTION_KEY)
+    MysqlBackupFilename = METADATA["database"] + ".bin"
+    WordPressBackupFilename = METADATA["site"] + ".bin"
+    FILENAMES = ([MysqlBackupFilename] if RESTORE_DATABASE else []) + tools.siteFilenames(METADATA)
+    for filename in sourceFilenames(METADATA,FILENAMES):
+        STREAM_SOURCES[TODAYRESTOREPATH + "/" + filename] = lambda offset=0, size=None, path=TODAYRESTOREPATH + "/" + filename: openLocal(path,offset,size)
+
+CODEC = METADATA["codec"]
+SITE_DEDUP = METADATA.get("site_mode") == "dedup"
+
+# Deduplicated backup : the chunks used by the manifest which are not in the local store are retrieved
+if SITE_DEDUP:
+    waitTransfers(["download of " + TODAYRESTOREPATH + "/" + WordPressBackupFilename])
+    manifest = dedup.read_manifest(TODAYRESTOREPATH + "/" + WordPressBackupFilename,ENCRYPTION_KEY,CODEC)
+    if SITE_SELECT:
+        manifest["entries"] = [entry for entry in manifest["entries"] if SITE_SELECT(entry["path"])]
+    store = dedup.ChunkStore(CHUNK_STORE,ENCRYPTION_KEY,manifest["codec"])
+    missing = [chunk_id for chunk_id in dedup.referenced_chunks(manifest) if not store.has(chunk_id)]
     print ("")
-    print ("Copy to FTP Server completed")
+    print ("Retrieving " + str(len(missing)) + " chunks")
+    if BACKUP_DEST == 'S3':
+        tools.downloadChunksS3(s3_client,CHUNK_S3_BUCKET,store,missing,dedup.REMOTE_FOLDER,transfer_config,S3_FILES_IN_FLIGHT,VERBOSE)
+    elif BACKUP_DEST == 'FTP':
+        tools.downloadChunksftp(ftppool,store,missing,"../" + CHUNK_FTP_PATH,FTP_BLOCK_SIZE,VERBOSE)
+    elif missing:
+        print("Missing chunks in local store " + CHUNK_STORE + ". Exiting")
+        exit(1)
+
+# Database dumped table by table : the parts listed by the manifest are retrieved
+DB_TABLES = RESTORE_DATABASE and METADATA.get("database_mode") == "tables"
+if DB_TABLES:
+    waitTransfers(["download of " + TODAYRESTOREPATH + "/" + MysqlBackupFilename])
+    DB_MANIFEST = dbdump.read_manifest(TODAYRESTOREPATH + "/" + MysqlBackupFilename,ENCRYPTION_KEY,CODEC)
+    DB_PARTS = [file + ".bin" for file in dbdump.part_files(DB_MANIFEST)]
+    print ("")
+    print ("Retrieving " + str(len(DB_PARTS)) + " parts of the database dump")
+    try:
+        if BACKUP_DEST == 'S3':
+            if STREAM:
+                for file in DB_PARTS:
+                    STREAM_SOURCES[TODAYRESTOREPATH + "/" + file] = lambda key=S3_PATH + "/" + file: s3_client.get_object(Bucket=S3_BUCKET,Key=key)["Body"]
+            else:
+                retrieveFiles([(TODAYRESTOREPATH + "/" + file, S3_PATH + "/" + file) for file in DB_PARTS])
+        elif BACKUP_DEST == 'FTP':
+            if STREAM:
+                for file in DB_PARTS:
+                    STREAM_SOURCES[TODAYRESTOREPATH + "/" + file] = lambda ficftp=file: ftppool.open(ficftp)
+            else:
+                retrieveFiles([(TODAYRESTOREPATH + "/" + file, file) for file in DB_PARTS])
+        elif STREAM:
+            for file in DB_PARTS:
+                STREAM_SOURCES[TODAYRESTOREPATH + "/" + file] = lambda path=TODAYRESTOREPATH + "/" + file: open(path,"rb")
+    except Exception as e:
+        print("Error during download of the parts of the database dump : " + str(e))
+        exit(1)
+
+# Point-in-time recovery : the binary logs written after the dump up to UNTIL are retrieved
+BINLOG_LOGS = []
+if UNTIL:
+    BinlogIndexFilename = binlog.INDEX_FILE + ".bin"
+    try:
+        if BACKUP_DEST == 'S3':
+            s3_client.download_file(Bucket=S3_BUCKET,Key=S3_PATH + "/" + BinlogIndexFilename,Filename=TODAYRESTOREPATH + "/" + BinlogIndexFilename)
+        elif BACKUP_DEST == 'FTP':
+            tools.downloadftp(ftpserver,BinlogIndexFilename,TODAYRESTOREPATH)
+        BINLOG_INDEX = binlog.read_index(TODAYRESTOREPATH + "/" + BinlogIndexFilename,ENCRYPTION_KEY)
+    except Exception as e:
+        print("No binary logs in the backup, made without DB_BINLOG=yes : " + str(e) + ". Exiting")
+        exit(1)
+    BINLOG_LOGS = [log["file"] + ".bin" for log in binlog.select_logs(BINLOG_INDEX,UNTIL)]
+    print ("")
+    print ("Retrieving " + str(len(BINLOG_LOGS)) + " binary logs")
+    try:
+        if BACKUP_DEST == 'S3':
+            retrieveFiles([(TODAYRESTOREPATH + "/" + file, S3_PATH + "/" + file) for file in BINLOG_LOGS])
+        elif BACKUP_DEST == 'FTP':
+            retrieveFiles([(TODAYRESTOREPATH + "/" + file, file) for file in BINLOG_LOGS])
+    except Exception as e:
+        print("Error during download of the binary logs : " + str(e))
+        exit(1)
+
+# Differential backup : the older backups are needed back to the last full backup
+# SITE_CHAIN gives the local folder and the metadata of each one, from the most recent
+SITE_CHAIN = [(TODAYRESTOREPATH,METADATA)]
+if METADATA.get("site_mode") == "diff":
+    index = DAYTORESTORE
+    while SITE_CHAIN[-1][1]["site_base"] != "full":
+        index += 1
+        if index >= int(BACKUP_RETENTION) or (BACKUP_DEST == 'S3' and index >= len(S3_SLOTS)):
+            print("No full backup of the site found before DAYJ-" + str(DAYTORESTORE) + ". Exiting")
+            exit(1)
+        SLOT = "DAYJ-" + str(index)
+        if BACKUP_DEST == 'LOCAL':
+            SLOT_PATH = BACKUP_PATH + "/" + SLOT
+        else:
+            SLOT_PATH = TODAYRESTOREPATH + "/" + SLOT
+            os.makedirs(SLOT_PATH,exist_ok=True)
+        if VERBOSE >= 1:
+            print("Site backup of " + SLOT + " needed")
+        try:
+            if BACKUP_DEST == 'S3':
+                s3_client.download_file(Bucket=S3_BUCKET,Key=S3_SLOTS[index] + "/" + MetadataFilename,Filename=SLOT_PATH + "/" + MetadataFilename)
+                SLOT_METADATA = tools.readMetadata(SLOT_PATH + "/" + MetadataFilename,ENCRYPTION_KEY)
+                FILENAMES = tools.siteFilenames(SLOT_METADATA)
+                for filename in sourceFilenames(SLOT_METADATA,FILENAMES):
+                    FILENAMES.remove(filename)
+                    STREAM_SOURCES[SLOT_PATH + "/" + filename] = lambda offset=0, size=None, key=S3_SLOTS[index] + "/" + filename: openS3(key,offset,size)
+                retrieveFiles([(SLOT_PATH + "/" + filename, S3_SLOTS[index] + "/" + filename) for filename in FILENAMES])
+            elif BACKUP_DEST == 'FTP':
+                tools.downloadftp(ftpserver,"../" + SLOT + "/" + MetadataFilename,SLOT_PATH,MetadataFilename)
+                SLOT_METADATA = tools.readMetadata(SLOT_PATH + "/" + MetadataFilename,ENCRYPTION_KEY)
+                FILENAMES = tools.siteFilenames(SLOT_METADATA)
+                for filename in sourceFilenames(SLOT_METADATA,FILENAMES):
+                    FILENAMES.remove(filename)
+                    STREAM_SOURCES[SLOT_PATH + "/" + filename] = lambda offset=0, size=None, ficftp="../" + SLOT + "/" + filename: ftppool.open(ficftp,offset)
+                retrieveFiles([(SLOT_PATH + "/" + filename, "../" + SLOT + "/" + filename) for filename in FILENAMES])
+            else:
+                SLOT_METADATA = tools.readMetadata(SLOT_PATH + "/" + MetadataFilename,ENCRYPTION_KEY)
+                for filename in sourceFilenames(SLOT_METADATA,tools.siteFilenames(SLOT_METADATA)):
+                    STREAM_SOURCES[SLOT_PATH + "/" + filename] = lambda offset=0, size=None, path=SLOT_PATH + "/" + filename: openLocal(path,offset,size)
+        except:
+            print("Error during download of the site backup of " + SLOT + ". Exiting")
+            exit(1)
+        if SLOT_METADATA.get("site_mode") != "diff":
+            print("Backup of " + SLOT + " is not a differential backup. Exiting")
+            exit(1)
+        SITE_CHAIN.append((SLOT_PATH,SLOT_METADATA))
+
+# The files still downloaded or decrypted
+waitTransfers()
+if BACKUP_DEST != 'LOCAL':
+    print ("")
+    print ("Download from " + BACKUP_DEST + " completed")
 
+if BACKUP_DEST == 'FTP':
+    tools.closeftp(ftpserver)
+    # The sessions of the pool are still used to read the streamed files
+    if not STREAM_SOURCES:
+        ftppool.close()
 
 # Part 2 : Decrypt files
-fdKey = open(ENCRYPTION_KEYPATH,'rb')
-ENCRYPTION_KEY = fdKey.read()
-
-for file in [MysqlBackupFilename,WordPressBackupFilename]:
-    print("Decrypting " + file)
-    result=encrypt.decrypt_file(TODAYRESTOREPATH + "/" + file,ENCRYPTION_KEY)
+# The manifests of a deduplicated backup and of a database dumped table by table are read directly from their encrypted file
+# Streamed files are decrypted while they are read, the downloaded ones once downloaded
+if DB_TABLES:
+    DECRYPT_FILES = [TODAYRESTOREPATH + "/" + file for file in DB_PARTS]
+elif RESTORE_DATABASE:
+    DECRYPT_FILES = [TODAYRESTOREPATH + "/" + MysqlBackupFilename]
+else:
+    DECRYPT_FILES = []
+DECRYPT_FILES += [TODAYRESTOREPATH + "/" + file for file in BINLOG_LOGS]
+if not SITE_DEDUP:
+    for folder, metadata in SITE_CHAIN:
+        DECRYPT_FILES += [folder + "/" + filename for filename in tools.siteFilenames(metadata)]
+for file in DECRYPT_FILES:
+    if file in STREAM_SOURCES or file in DECRYPTED:
+        continue
+    decryptFile(file)
+TRANSFER_ENGINE.close()
 
 # Part3 : Database Restore.
-print ("")
-print ("Starting Import of MySQL Dump")
-
-importcmd = "zcat " + pipes.quote(TODAYRESTOREPATH) + "/" + DB_NAME + ".sql.gz | mysql -h " + DB_HOST + " " + DB_NAME
-
-os.system(importcmd)
-
+# The import runs in a thread while the site folder is restored
+RESTORE_POOL = ThreadPoolExecutor(1)
+DB_IMPORT = None
+if RESTORE_DATABASE:
+    print ("")
+    print ("Starting Import of MySQL Dump")
 
-print ("")
-print ("Dump of MySQL imported")
+if DB_TABLES:
+    # Parts imported in parallel, then the indexes of each table are built
+    DB_IMPORT = RESTORE_POOL.submit(dbdump.import_tables,DB_MANIFEST,DB_HOST,DB_NAME,lambda file, consumer: restoreArtifact(TODAYRESTOREPATH + "/" + file,CODEC,consumer),DB_DUMP_WORKERS,VERBOSE)
+elif RESTORE_DATABASE:
+    DB_IMPORT = RESTORE_POOL.submit(restoreArtifact,TODAYRESTOREPATH + "/" + METADATA["database"],CODEC,lambda f: pipeline.mysqlimport(f,DB_HOST,DB_NAME))
 
 # Part3 : WP Site Restore.
 
 print ("")
 print ("Starting Restore of Wordpress Site folder")
-#declare filename
-wp_archive= TODAYRESTOREPATH + "/" + "wordpress.site.tar.gz"
-
-#open file in read mode
-tar = tarfile.open(wp_archive,"r:gz")
-tar.extractall("/")
-tar.close()
+if SITE_DEDUP:
+    dedup.restore_folder(store,manifest,"/")
+else:
+    # Full backup first then each differential backup in order
+    for folder, metadata in reversed(SITE_CHAIN):
+        if len(SITE_CHAIN) > 1:
+            print("Restore of " + metadata["site_base"] + " backup of " + metadata["date"])
+        if "site_index" in metadata:
+            # Blocks holding the selected files, extracted in parallel
+            index = archive.read_index(folder + "/" + metadata["site_index"],metadata["codec"])
+            count = archive.extract_archive(index,lambda offset, size, consumer, path=folder + "/" + metadata["site"]: restoreRange(path,offset,size,consumer),"/",SITE_SELECT,SITE_WORKERS,metadata["codec"])
+            if VERBOSE >= 1:
+                print(str(count) + " of " + str(len(index["members"])) + " members of the site archive restored")
+        else:
+            restoreArtifact(folder + "/" + metadata["site"],metadata["codec"],lambda f: pipeline.untar(f,"/",SITE_SELECT))
+        if "deleted" in metadata:
+            deleted = fileindex.read_deleted(folder + "/" + metadata["deleted"],metadata["codec"])
+            fileindex.apply_deleted([path for path in deleted if SITE_SELECT is None or SITE_SELECT(path)],"/")
 
 print ("")
 print ("Restore of  Wordpress Site folder completed")
 
+try:
+    if DB_IMPORT:
+        DB_IMPORT.result()
+except Exception as e:
+    print("Error during import of MySQL Dump : " + str(e))
+    exit(1)
+finally:
+    RESTORE_POOL.shutdown()
+    if BACKUP_DEST == 'FTP' and STREAM_SOURCES:
+        ftppool.close()
+
+if RESTORE_DATABASE:
+    print ("")
+    print ("Dump of MySQL imported")
+
+# Part3 : Replay of the binary logs
+if UNTIL:
+    print ("")
+    print ("Replay of " + str(len(BINLOG_LOGS)) + " binary logs up to " + UNTIL)
+    try:
+        BINLOG_PATHS = []
+        for file in BINLOG_LOGS:
+            # mysqlbinlog reads the uncompressed binary logs
+            path = TODAYRESTOREPATH + "/" + file[:-len(".bin")]
+            binlog.decompress_log(path,path + ".binlog",CODEC)
+            BINLOG_PATHS.append(path + ".binlog")
+        if BINLOG_PATHS:
+            binlog.replay(DB_HOST,DB_NAME,BINLOG_PATHS,BINLOG_INDEX["start"]["position"],UNTIL)
+        for path in BINLOG_PATHS:
+            os.remove(path)
+    except Exception as e:
+        print("Error during replay of the binary logs : " + str(e))
+        exit(1)
+    print ("")
+    print ("Binary logs replayed")
+
 
 print ("")
 print ("Restore script completed")
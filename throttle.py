@@ -0,0 +1,157 @@
+import os
+import threading
+import subprocess
+
+'''
+Throttling of a backup so that it does not slow down the Wordpress site
+
+The backup runs on the server of the site. Three settings trade the duration
+of the backup for the latency of the site :
+
+- rate limits (pipeline.RateLimiter) of the read of the files of the site, of
+  the dump of the database and of the uploads to BACKUP_DEST
+- the CPU (nice) and IO (ionice) scheduling priority of the script, inherited
+  by the threads and by the processes it starts (mysqldump, mysqlbinlog)
+- an adaptive mode : every interval, the load average per CPU and the share of
+  time the CPUs waited for IO are compared with thresholds. While one is
+  crossed, the rates of the limiters are halved, down to a minimum rate. Once
+  the system is below the thresholds again, the rates grow by half at each
+  interval until they are back to their configured value, no limit included
+'''
+
+IONICE_CLASSES = {"realtime": 1, "best-effort": 2, "idle": 3}
+DEFAULT_INTERVAL = 5
+# Factors applied to the rates when the system is loaded, and when it is not anymore
+BACKOFF = 0.5
+RECOVERY = 1.5
+
+
+def set_priority(nice=0, ionice_class=None, ionice_level=None):
+    '''
+    Lower the CPU and IO priority of the process, before it starts threads and processes
+        - nice: increment of the nice value, 0 to keep it
+        - ionice_class: realtime, best-effort or idle, None to keep it
+        - ionice_level: level of the best-effort and realtime classes, 0 (highest) to 7
+    '''
+    if nice:
+        os.nice(nice)
+    if ionice_class:
+        if ionice_class not in IONICE_CLASSES:
+            raise ValueError("IO class should be " + ", ".join(IONICE_CLASSES) + " only")
+        command = ["ionice", "-c", str(IONICE_CLASSES[ionice_class])]
+        if ionice_level is not None and ionice_class != "idle":
+            command += ["-n", str(ionice_level)]
+        subprocess.run(command + ["-p", str(os.getpid())], check=True, stdout=subprocess.DEVNULL)
+
+
+def load_per_cpu():
+    '''
+    Return the load average of the last minute divided by the number of CPUs
+    '''
+    return os.getloadavg()[0] / (os.cpu_count() or 1)
+
+
+def cpu_times():
+    '''
+    Return the total and iowait times of the CPUs from /proc/stat, None if unknown
+    '''
+    try:
+        with open("/proc/stat") as f:
+            values = [int(value) for value in f.readline().split()[1:]]
+    except (OSError, ValueError):
+        return None
+    # user nice system idle iowait irq softirq steal, guest times are already in user and nice
+    return sum(values[:8]), values[4]
+
+
+class AdaptiveThrottle:
+    '''
+    Thread adjusting the rates of limiters to the load of the system
+        - limiters: list of pipeline.RateLimiter, a rate of 0 being no limit
+        - load_threshold: load average per CPU above which the rates are lowered, 0 to ignore it
+        - iowait_threshold: percentage of iowait above which the rates are lowered, 0 to ignore it
+        - min_rate: the rates are never lowered below min_rate bytes per second
+    '''
+    def __init__(self, limiters, load_threshold=0, iowait_threshold=0, min_rate=1048576, interval=DEFAULT_INTERVAL, VERBOSE=0):
+        self.limiters = limiters
+        # Configured rate of each limiter, and throughput measured when a limiter without rate was first lowered
+        self.rates = [limiter.rate for limiter in limiters]
+        self.ceilings = [0] * len(limiters)
+        self.load_threshold = load_threshold
+        self.iowait_threshold = iowait_threshold
+        self.min_rate = min_rate
+        self.interval = interval
+        self.VERBOSE = VERBOSE
+        self.backoffs = 0
+        self.throttled = 0.0
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def loaded(self, previous, current):
+        '''
+        Return a description of the threshold crossed, or None
+        previous and current are results of cpu_times
+        '''
+        if self.load_threshold:
+            load = load_per_cpu()
+            if load > self.load_threshold:
+                return "load %.2f per CPU" % load
+        if self.iowait_threshold and previous and current and current[0] > previous[0]:
+            iowait = (current[1] - previous[1]) * 100 / (current[0] - previous[0])
+            if iowait > self.iowait_threshold:
+                return "iowait %.0f%%" % iowait
+        return None
+
+    def adjust(self, reason, consumed):
+        '''
+        Lower the rates if reason is not None, else raise them toward their configured value
+        consumed gives the bytes used by each limiter during the last interval
+        '''
+        for index, limiter in enumerate(self.limiters):
+            rate = limiter.rate
+            if reason:
+                if not rate:
+                    # No limit until now, the backoff starts from the throughput measured
+                    self.ceilings[index] = consumed[index] / self.interval
+                    rate = self.ceilings[index]
+                rate = max(self.min_rate, rate * BACKOFF)
+            elif rate and rate != self.rates[index]:
+                rate = rate * RECOVERY
+                if self.rates[index] and rate >= self.rates[index]:
+                    rate = self.rates[index]
+                elif not self.rates[index] and rate >= self.ceilings[index]:
+                    rate = 0
+            if rate != limiter.rate:
+                limiter.set_rate(rate)
+        if reason:
+            self.backoffs += 1
+        if self.VERBOSE == 2 and (reason or any(limiter.rate != rate for limiter, rate in zip(self.limiters, self.rates))):
+            print(("Throttled, " + reason if reason else "Recovering") + " : " +
+                  ", ".join("%.1f MB/s" % (limiter.rate / 1048576) if limiter.rate else "no limit" for limiter in self.limiters))
+
+    def run(self):
+        previous = cpu_times()
+        consumed = [limiter.consumed for limiter in self.limiters]
+        while not self.stopped.wait(self.interval):
+            current = cpu_times()
+            reason = self.loaded(previous, current)
+            used = [limiter.consumed - before for limiter, before in zip(self.limiters, consumed)]
+            if any(limiter.rate != rate for limiter, rate in zip(self.limiters, self.rates)):
+                self.throttled += self.interval
+            self.adjust(reason, used)
+            previous = current
+            consumed = [limiter.consumed for limiter in self.limiters]
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        '''
+        Stop the thread and give back their configured rate to the limiters
+        '''
+        self.stopped.set()
+        if self.thread:
+            self.thread.join()
+        for limiter, rate in zip(self.limiters, self.rates):
+            limiter.set_rate(rate)
@@ -1,8 +1,16 @@
 import os
+import ssl
+import time
 import ftplib
+import queue
+import threading
 import boto3
+from boto3.s3.transfer import TransferConfig
 from botocore.config import Config
+from concurrent.futures import ThreadPoolExecutor
+import json
 import smtplib
+import encrypt
 from email.message import EmailMessage
 from Crypto.Cipher import AES
 from Crypto.Random import get_random_bytes
@@ -24,69 +32,775 @@ def sendmail(mailfrom="address@example.com",mailto="imaneamirat08@gmail.com",mes
     s.quit()
 
 
-def moveFolderS3(s3,bucket,pathFrom, pathTo, VERBOSE=0):
-    response = s3.list_objects(Bucket=bucket,Prefix=pathFrom + "/")
-    for content in response.get('Contents', []):
-        old_key = content.get('Key')
-        filename = old_key.split("/")[-1]
-        new_key = pathTo + "/" + filename
+def readMetadata(path, key):
+    '''
+    Return the metadata of a backup as a dict, read from its encrypted file backup.json.bin
+        - path: local path of backup.json.bin
+        - key: AES key
+    Backups made by previous versions have no metadata file, the codec and
+    file names used by these versions are returned in this case
+    '''
+    if not os.path.exists(path):
+        return {"codec": "gzip", "database": "wordpress.sql.gz", "site": "wordpress.site.tar.gz"}
+    with open(path, "rb") as f:
+        return json.loads(encrypt.DecryptReader(f, key).read())
+
+def siteFilenames(metadata):
+    '''
+    Return the names of the encrypted files of the site backup described by metadata
+    '''
+    filenames = [metadata["site"] + ".bin"]
+    if "site_index" in metadata:
+        filenames.append(metadata["site_index"] + ".bin")
+    if "deleted" in metadata:
+        filenames.append(metadata["deleted"] + ".bin")
+    return filenames
+
+# Limit of delete_objects and size of a page of list_objects_v2
+S3_BATCH_SIZE = 1000
+# copy_object is limited to objects of 5 GB, bigger objects need a multipart copy
+S3_MAX_COPY_SIZE = 5 * 1024 * 1024 * 1024
+
+def _listObjectsS3(s3,bucket,prefix):
+    '''
+    Return the list of (key, size) of the objects under prefix and the number of list calls
+    '''
+    objects = []
+    calls = 0
+    for page in s3.get_paginator("list_objects_v2").paginate(Bucket=bucket,Prefix=prefix):
+        calls += 1
+        objects.extend((content["Key"], content["Size"]) for content in page.get("Contents", []))
+    return objects, calls
+
+def _deleteObjectsS3(s3,bucket,keys,workers=8):
+    '''
+    Delete keys with batches of delete_objects run by a pool of threads
+    Return the number of delete calls
+    '''
+    batches = [keys[index:index + S3_BATCH_SIZE] for index in range(0, len(keys), S3_BATCH_SIZE)]
+
+    def deleteBatch(batch):
+        response = s3.delete_objects(Bucket=bucket,Delete={"Objects": [{"Key": key} for key in batch],"Quiet": True})
+        if response.get("Errors"):
+            error = response["Errors"][0]
+            raise RuntimeError("Delete of " + error["Key"] + " failed : " + error["Message"])
+
+    with ThreadPoolExecutor(max(1, workers)) as pool:
+        list(pool.map(deleteBatch, batches))
+    return len(batches)
+
+def streamFilenames(metadata):
+    '''
+    Return the .bin files of a backup which restore-wp.py --stream reads directly from BACKUP_DEST
+    ie the database dump and the site archive, but not the manifests of a deduplicated backup
+    and of a database dumped table by table
+    '''
+    filenames = []
+    if metadata.get("database_mode") != "tables":
+        filenames.append(metadata["database"] + ".bin")
+    if metadata.get("site_mode") != "dedup":
+        filenames.append(metadata["site"] + ".bin")
+    return filenames
+
+def moveFolderS3(s3,bucket,pathFrom, pathTo, VERBOSE=0, workers=8):
+    start = time.monotonic()
+    objects, list_calls = _listObjectsS3(s3,bucket,pathFrom + "/")
+
+    def copyObject(item):
+        old_key, size = item
+        new_key = pathTo + "/" + old_key[len(pathFrom) + 1:]
         if VERBOSE == 2:
             print("Copy " + old_key + " to " + new_key + " in Bucket " + bucket)
-        s3.copy_object(Bucket=bucket,CopySource="/" + bucket + "/" + old_key,Key=new_key)
-        s3.delete_object(Bucket=bucket,Key=old_key)
+        if size > S3_MAX_COPY_SIZE:
+            s3.copy({"Bucket": bucket, "Key": old_key}, bucket, new_key)
+        else:
+            s3.copy_object(Bucket=bucket,CopySource={"Bucket": bucket, "Key": old_key},Key=new_key)
 
-def deleteFolderS3(s3,bucket,prefix,VERBOSE=0):
-    response = s3.list_objects(Bucket=bucket,Prefix=prefix + "/")
-    for content in response.get('Contents', []):
-        key=content.get('Key')
-        if VERBOSE == 2:
-            print("Delete file " + key + " in Bucket " + bucket)
-        s3.delete_object(Bucket=bucket,Key=key)
+    with ThreadPoolExecutor(max(1, workers)) as pool:
+        list(pool.map(copyObject, objects))
+    # Objects are only deleted once every copy succeeded
+    delete_calls = _deleteObjectsS3(s3,bucket,[key for key, size in objects],workers)
+    if VERBOSE == 2:
+        print("Move of %d files from %s to %s : %d list, %d copy and %d delete calls in %.2f s" % (len(objects), pathFrom, pathTo, list_calls, len(objects), delete_calls, time.monotonic() - start))
+
+def deleteFolderS3(s3,bucket,prefix,VERBOSE=0,workers=8):
+    start = time.monotonic()
+    objects, list_calls = _listObjectsS3(s3,bucket,prefix + "/")
+    delete_calls = _deleteObjectsS3(s3,bucket,[key for key, size in objects],workers)
+    if VERBOSE == 2:
+        print("Delete of %d files in %s : %d list and %d delete calls in %.2f s" % (len(objects), prefix, list_calls, delete_calls, time.monotonic() - start))
+    return len(objects)
+
+# Layout "dated" : each backup in an immutable prefix backups/YYYYMMDD and an
+# index object listing these dates from the most recent one, ie DAYJ, DAYJ-1...
+S3_DATED_PREFIX = "backups"
+S3_INDEX_KEY = S3_DATED_PREFIX + "/index.json"
+
+def readBackupIndexS3(s3,bucket):
+    '''
+    Return the dates listed in the index of the dated layout, from the most recent
+    '''
+    try:
+        response = s3.get_object(Bucket=bucket,Key=S3_INDEX_KEY)
+    except s3.exceptions.NoSuchKey:
+        return []
+    return json.loads(response["Body"].read())["backups"]
+
+def writeBackupIndexS3(s3,bucket,dates):
+    s3.put_object(Bucket=bucket,Key=S3_INDEX_KEY,Body=json.dumps({"backups": dates}).encode(),ContentType="application/json")
+
+def datedPathS3(date):
+    return S3_DATED_PREFIX + "/" + date
+
+def slotPathsS3(s3,bucket,layout,retention):
+    '''
+    Return the S3 prefix of DAYJ, DAYJ-1... for the layout "slots" or "dated"
+    '''
+    if layout == "dated":
+        return [datedPathS3(date) for date in readBackupIndexS3(s3,bucket)]
+    return ["DAYJ"] + ["DAYJ-" + str(index) for index in range(1,int(retention))]
+
+def deletePrefixesS3(s3,bucket,prefixes,VERBOSE=0,workers=8):
+    '''
+    Delete every object of the given prefixes
+    Return the number of objects deleted
+    '''
+    return sum(deleteFolderS3(s3,bucket,prefix,VERBOSE,workers) for prefix in prefixes)
+
+def s3TransferConfig(chunksize_mb=8, max_concurrency=10):
+    '''
+    Return the TransferConfig used for S3 uploads and downloads
+        - chunksize_mb: size in MB of the parts of multipart transfers
+        - max_concurrency: number of threads transferring the parts of one file
+    '''
+    chunksize = chunksize_mb * 1024 * 1024
+    return TransferConfig(multipart_threshold=chunksize, multipart_chunksize=chunksize,
+                          max_concurrency=max_concurrency, use_threads=max_concurrency > 1)
+
+class _TransferCounter:
+    # Callback of boto3 transfers, called from several threads
+    # The transfer waits in the callback while limiter does not allow more bytes
+    def __init__(self, limiter=None):
+        self.bytes = 0
+        self.limiter = limiter
+        self.lock = threading.Lock()
+
+    def __call__(self, amount):
+        with self.lock:
+            self.bytes += amount
+        if self.limiter is not None:
+            self.limiter.consume(amount)
+
+# S3 limit of the number of parts of a multipart upload
+S3_MAX_PARTS = 10000
+
+def _partSizeS3(size, transfer_config):
+    return max(transfer_config.multipart_chunksize, -(-size // S3_MAX_PARTS))
+
+def _uploadFileS3Journal(s3, bucket, path, key, transfer_config, journal, callback):
+    '''
+    Multipart upload of the file path whose parts are recorded in journal
+    An upload of the same file interrupted before is resumed if journal allows it
+    '''
+    size = os.path.getsize(path)
+    if size <= transfer_config.multipart_threshold:
+        s3.upload_file(path, bucket, key, Config=transfer_config, Callback=callback)
+        return
+    name = "upload s3://" + bucket + "/" + key
+    part_size = _partSizeS3(size, transfer_config)
+    state = {"size": size, "mtime": os.stat(path).st_mtime_ns, "part_size": part_size}
+    entry = journal.resumable(name, state)
+    if entry:
+        try:
+            s3.list_parts(Bucket=bucket, Key=key, UploadId=entry["upload_id"], MaxParts=1)
+        except s3.exceptions.NoSuchUpload:
+            entry = None
+    if entry is None:
+        old = journal.get(name)
+        if old:
+            # Parts of an upload which will never be completed are not kept by S3
+            try:
+                s3.abort_multipart_upload(Bucket=bucket, Key=key, UploadId=old["upload_id"])
+            except s3.exceptions.ClientError:
+                pass
+        upload_id = s3.create_multipart_upload(Bucket=bucket, Key=key)["UploadId"]
+        entry = journal.start(name, state, upload_id=upload_id, parts={})
+    parts_count = max(1, -(-size // part_size))
+    todo = [number for number in range(1, parts_count + 1) if str(number) not in entry["parts"]]
+
+    def uploadPart(number):
+        with open(path, "rb") as f:
+            f.seek((number - 1) * part_size)
+            data = f.read(part_size)
+        response = s3.upload_part(Bucket=bucket, Key=key, PartNumber=number, UploadId=entry["upload_id"], Body=data)
+        journal.set_item(name, "parts", str(number), response["ETag"])
+        callback(len(data))
+
+    with ThreadPoolExecutor(max(1, transfer_config.max_concurrency)) as pool:
+        list(pool.map(uploadPart, todo))
+    parts = [{"PartNumber": int(number), "ETag": etag} for number, etag in entry["parts"].items()]
+    s3.complete_multipart_upload(Bucket=bucket, Key=key, UploadId=entry["upload_id"],
+                                 MultipartUpload={"Parts": sorted(parts, key=lambda part: part["PartNumber"])})
+    journal.finish(name)
+
+def _downloadFileS3Journal(s3, bucket, path, key, transfer_config, journal, callback):
+    '''
+    Download of the object key in parts recorded in journal
+    A download of the same object interrupted before is resumed if journal allows it
+    '''
+    head = s3.head_object(Bucket=bucket, Key=key)
+    size = head["ContentLength"]
+    if size <= transfer_config.multipart_threshold:
+        s3.download_file(bucket, key, path, Config=transfer_config, Callback=callback)
+        return
+    name = "download s3://" + bucket + "/" + key
+    part_size = _partSizeS3(size, transfer_config)
+    state = {"size": size, "etag": head["ETag"], "part_size": part_size}
+    entry = None
+    if os.path.exists(path) and os.path.getsize(path) == size:
+        entry = journal.resumable(name, state)
+    if entry is None:
+        with open(path, "wb") as f:
+            f.truncate(size)
+        entry = journal.start(name, state, parts={})
+    parts_count = -(-size // part_size)
+    todo = [number for number in range(1, parts_count + 1) if str(number) not in entry["parts"]]
+
+    def downloadPart(number):
+        offset = (number - 1) * part_size
+        last = min(offset + part_size, size) - 1
+        body = s3.get_object(Bucket=bucket, Key=key, Range="bytes=%d-%d" % (offset, last), IfMatch=head["ETag"])["Body"]
+        with open(path, "r+b") as f:
+            f.seek(offset)
+            while True:
+                data = body.read(1024 * 1024)
+                if not data:
+                    break
+                f.write(data)
+                callback(len(data))
+        journal.set_item(name, "parts", str(number), True)
+
+    with ThreadPoolExecutor(max(1, transfer_config.max_concurrency)) as pool:
+        list(pool.map(downloadPart, todo))
+    journal.finish(name)
+
+def _transferS3(s3, bucket, source, key, transfer_config, upload, journal, limiter, VERBOSE):
+    counter = _TransferCounter(limiter)
+    start = time.monotonic()
+    if not upload:
+        os.makedirs(os.path.dirname(source) or ".", exist_ok=True)
+        if journal:
+            _downloadFileS3Journal(s3, bucket, source, key, transfer_config or s3TransferConfig(), journal, counter)
+        else:
+            s3.download_file(bucket, key, source, Config=transfer_config, Callback=counter)
+    elif callable(source):
+        # Stream, for example a pipeline.ArtifactStream, created when its transfer starts
+        stream = source()
+        try:
+            s3.upload_fileobj(stream, bucket, key, Config=transfer_config, Callback=counter)
+        finally:
+            stream.close()
+    elif journal:
+        _uploadFileS3Journal(s3, bucket, source, key, transfer_config or s3TransferConfig(), journal, counter)
+    else:
+        s3.upload_file(source, bucket, key, Config=transfer_config, Callback=counter)
+    elapsed = time.monotonic() - start
+    stats = {"key": key, "bytes": counter.bytes, "seconds": elapsed,
+             "mbps": counter.bytes / 1048576 / max(elapsed, 1e-6)}
+    if VERBOSE >= 1:
+        print(("Upload of " if upload else "Download of ") + key + " : %.1f MB in %.1f s, %.1f MB/s" % (counter.bytes / 1048576, elapsed, stats["mbps"]))
+    return stats
+
+def _transferFilesS3(s3, bucket, transfers, transfer_config, files_in_flight, upload, journal, limiter, VERBOSE):
+    start = time.monotonic()
+    with ThreadPoolExecutor(max(1, files_in_flight)) as pool:
+        futures = [pool.submit(_transferS3, s3, bucket, source, key, transfer_config, upload, journal, limiter, VERBOSE) for source, key in transfers]
+        stats = [future.result() for future in futures]
+    elapsed = time.monotonic() - start
+    total = sum(stat["bytes"] for stat in stats)
+    if VERBOSE >= 1 and len(stats) > 1:
+        print("Total : %d files, %.1f MB in %.1f s, %.1f MB/s" % (len(stats), total / 1048576, elapsed, total / 1048576 / max(elapsed, 1e-6)))
+    return stats
+
+def uploadFilesS3(s3, bucket, transfers, transfer_config=None, files_in_flight=1, VERBOSE=0, journal=None, limiter=None):
+    '''
+    Upload several files to S3 concurrently
+        - s3: boto3 S3 client
+        - bucket: name of the bucket
+        - transfers: list of (source, key). source is either a local path or a
+          function returning a readable stream which has a close() method
+        - transfer_config: TransferConfig of each file, see s3TransferConfig
+        - files_in_flight: number of files transferred at the same time
+        - journal: optional, journal.TransferJournal recording the parts of the
+          multipart uploads of local files so that they can be resumed
+        - limiter: optional, pipeline.RateLimiter shared by the transfers
+    Return a list of dict with the key, the bytes transferred, the duration and the MB/s of each file
+    The first error of a transfer is raised once all transfers are finished
+    '''
+    return _transferFilesS3(s3, bucket, transfers, transfer_config, files_in_flight, True, journal, limiter, VERBOSE)
+
+def downloadFilesS3(s3, bucket, transfers, transfer_config=None, files_in_flight=1, VERBOSE=0, journal=None, limiter=None):
+    '''
+    Download several files from S3 concurrently
+        - transfers: list of (local path, key)
+    See uploadFilesS3 for the other parameters
+    '''
+    return _transferFilesS3(s3, bucket, transfers, transfer_config, files_in_flight, False, journal, limiter, VERBOSE)
+
+def uploadChunksS3(s3,bucket,store,chunk_ids,prefix="chunks",transfer_config=None,files_in_flight=1,VERBOSE=0,limiter=None):
+    transfers = [(store.chunk_path(chunk_id), prefix + "/" + chunk_id) for chunk_id in chunk_ids]
+    return uploadFilesS3(s3, bucket, transfers, transfer_config, files_in_flight, VERBOSE - 1, limiter=limiter)
+
+def downloadChunksS3(s3,bucket,store,chunk_ids,prefix="chunks",transfer_config=None,files_in_flight=1,VERBOSE=0):
+    transfers = [(store.chunk_path(chunk_id), prefix + "/" + chunk_id) for chunk_id in chunk_ids]
+    return downloadFilesS3(s3, bucket, transfers, transfer_config, files_in_flight, VERBOSE - 1)
+
+def deleteChunksS3(s3,bucket,chunk_ids,prefix="chunks",VERBOSE=0,workers=8):
+    start = time.monotonic()
+    delete_calls = _deleteObjectsS3(s3,bucket,[prefix + "/" + chunk_id for chunk_id in chunk_ids],workers)
+    if VERBOSE == 2:
+        print("Delete of %d chunks : %d delete calls in %.2f s" % (len(chunk_ids), delete_calls, time.monotonic() - start))
+
+def listSizesS3(s3,bucket,prefix):
+    '''
+    Return the size of each object of the folder prefix, by name relative to prefix
+    '''
+    objects, calls = _listObjectsS3(s3,bucket,prefix + "/")
+    return {key[len(prefix) + 1:]: size for key, size in objects}
+
+def readRangeS3(s3,bucket,key,offset,length):
+    '''
+    Return length bytes of the object key from offset
+    '''
+    return s3.get_object(Bucket=bucket,Key=key,Range="bytes=%d-%d" % (offset, offset + length - 1))["Body"].read()
 
 def listObjectFolderS3(s3,bucket,prefix,VERBOSE=0):
-    response = s3.list_objects(Bucket=bucket,Prefix=prefix + "/")
-    for content in response.get('Contents', []):
-        key=content.get('Key')
+    objects, calls = _listObjectsS3(s3,bucket,prefix + "/")
+    for key, size in objects:
         print("key = " + key)
 
 def connectftp(ftpserver = "172.16.30.32" , username = 'anonymous', password = 'anonymous@', passive = False):
     """connect to ftp server and open a session
-       - ftpserver: IP address of the ftp server
+       - ftpserver: IP address of the ftp server, optionally followed by :port
        - username: login of the ftp user ('anonymous' by défaut)
        - password: password of the ftp user ('anonymous@' by défaut)
        - passive: activate or disable ftp passive mode (False par défaut)
        return the object 'ftplib.FTP' after connection and opening of a session
     """
     ftp = ftplib.FTP_TLS()
-    ftp.connect(ftpserver)
+    host, _, port = ftpserver.partition(":")
+    ftp.connect(host, int(port) if port else 0)
     ftp.login(username, password)
     ftp.set_pasv(passive)
     ftp.prot_p()
     return ftp
 
-def uploadftp(ftp, ficdsk,ftpPath):
+# Size of the blocks sent to or read from the data connection, ftplib uses 8 KB
+FTP_BLOCK_SIZE = 256 * 1024
+
+def uploadftp(ftp, ficdsk,ftpPath,blocksize=FTP_BLOCK_SIZE):
     '''
     Upload the file ficdsk from local folder to the current ftp folder
         - ftp: object 'ftplib.FTP' on an open session
         - ficdsk: local name of the file to upload
         - ficPath: FTP path where to store the file
+        - blocksize: size of the blocks written to the data connection
     '''
     repdsk, ficdsk2 = os.path.split(ficdsk)
     ficftp = ftpPath + "/" + ficdsk2
     with open(ficdsk, "rb") as f:
-        ftp.storbinary("STOR " + ficftp, f)
+        ftp.storbinary("STOR " + ficftp, f, blocksize)
 
-def downloadftp(ftp, ficftp, repdsk='.', ficdsk=None):
+def uploadftpStream(ftp, fileobj, ficftp, blocksize=FTP_BLOCK_SIZE):
+    '''
+    Upload the content of a readable file object to the ftp file ficftp
+        - ftp: object 'ftplib.FTP' on an open session
+        - fileobj: file object to read until its end, for example a pipeline.ArtifactStream
+        - ficftp: FTP path of the file to create
+    '''
+    ftp.storbinary("STOR " + ficftp, fileobj, blocksize)
+
+def downloadftp(ftp, ficftp, repdsk='.', ficdsk=None, blocksize=FTP_BLOCK_SIZE):
     """Download the file ficftp from ftpserver and put it in the local folder repdsk
        - ftp: object 'ftplib.FTP' from an open session
        - ficftp: name of the file to download
        - repdsk: local folder where you want to store the file
        - ficdsk: optional, if you want to rename the file locally
+       - blocksize: size of the blocks read from the data connection
     """
     if ficdsk==None:
         ficdsk=ficftp
     with open(os.path.join(repdsk, ficdsk), 'wb') as f:
-        ftp.retrbinary('RETR ' + ficftp, f.write)
+        ftp.retrbinary('RETR ' + ficftp, f.write, blocksize)
+
+def downloadftpRange(ftp, ficftp, path, offset, length, blocksize=FTP_BLOCK_SIZE, callback=None):
+    '''
+    Download length bytes of the ftp file ficftp, starting at offset (REST command),
+    and write them at the same offset in the local file path which must already exist
+        - callback: optional, called with each block written
+    '''
+    ftp.voidcmd("TYPE I")
+    with open(path, "r+b") as f:
+        f.seek(offset)
+        conn = ftp.transfercmd("RETR " + ficftp, rest=offset)
+        try:
+            while length > 0:
+                data = conn.recv(min(blocksize, length))
+                if not data:
+                    break
+                f.write(data)
+                length -= len(data)
+                if callback:
+                    callback(data)
+        finally:
+            conn.close()
+    try:
+        # The server answers 226 if the end of the file was reached or 426 if the transfer was stopped before
+        ftp.voidresp()
+    except (ftplib.error_temp, ftplib.error_perm):
+        pass
+    if length > 0:
+        raise EOFError("Transfer of " + ficftp + " stopped " + str(length) + " bytes before the end of the range")
+
+def sizeftp(ftp, ficftp):
+    '''
+    Return the size of the ftp file ficftp, or None if it does not exist
+    '''
+    ftp.voidcmd("TYPE I")
+    try:
+        return ftp.size(ficftp)
+    except ftplib.error_perm:
+        return None
+
+def readftpRange(ftp, ficftp, offset, length, blocksize=FTP_BLOCK_SIZE):
+    '''
+    Return length bytes of the ftp file ficftp from offset, less if the end of the file is reached
+    '''
+    ftp.voidcmd("TYPE I")
+    data = bytearray()
+    conn = ftp.transfercmd("RETR " + ficftp, rest=offset or None)
+    try:
+        while len(data) < length:
+            block = conn.recv(min(blocksize, length - len(data)))
+            if not block:
+                break
+            data += block
+    finally:
+        conn.close()
+    try:
+        ftp.voidresp()
+    except (ftplib.error_temp, ftplib.error_perm):
+        pass
+    return bytes(data)
+
+def listSizesftp(ftp, ftpPath):
+    '''
+    Return the size of each file of the ftp folder ftpPath, by name, with a single MLSD command
+    if the server supports it, else with a SIZE command per file
+    '''
+    try:
+        return {name: int(facts["size"]) for name, facts in ftp.mlsd(ftpPath, ["type", "size"]) if facts.get("type") == "file"}
+    except ftplib.error_perm as e:
+        if not str(e).startswith("500") and not str(e).startswith("502"):
+            raise
+    sizes = {}
+    for path in ftp.nlst(ftpPath):
+        name = path.rsplit("/", 1)[-1]
+        size = sizeftp(ftp, ftpPath + "/" + name)
+        if size is not None:
+            sizes[name] = size
+    return sizes
+
+class FTPReader:
+    '''
+    Readable file object on the data connection of a RETR command
+    close() ends the transfer and calls onclose with the session
+        - offset: optional, the file is read from offset (REST command)
+    '''
+    def __init__(self, ftp, ficftp, onclose=None, offset=0):
+        ftp.voidcmd("TYPE I")
+        self.ftp = ftp
+        self.conn = ftp.transfercmd("RETR " + ficftp, rest=offset or None)
+        self.file = self.conn.makefile("rb")
+        self.onclose = onclose
+        self.eof = False
+
+    def read(self, size=-1):
+        data = self.file.read(size)
+        if not data and size != 0:
+            self.eof = True
+        return data
+
+    def readable(self):
+        return True
+
+    def close(self):
+        if self.file is None:
+            return
+        self.file.close()
+        self.file = None
+        try:
+            if self.eof and isinstance(self.conn, ssl.SSLSocket):
+                self.conn.unwrap()
+        except (OSError, ValueError):
+            pass
+        self.conn.close()
+        try:
+            self.ftp.voidresp()
+        except (ftplib.error_temp, ftplib.error_perm):
+            # 426 if the file was not read until its end
+            pass
+        finally:
+            if self.onclose:
+                self.onclose(self.ftp)
+
+class FTPPool:
+    '''
+    Pool of authenticated FTPS sessions used to transfer several files, or
+    several segments of a file, at the same time
+        - size: number of sessions
+        - path: optional, folder where each session is moved after login
+    Other parameters are those of connectftp
+    '''
+    def __init__(self, ftpserver, username, password, size=4, path=None, passive=False):
+        self.server = ftpserver
+        self.path = path or ""
+        self.size = max(1, size)
+        self.sessions = queue.Queue()
+        for index in range(self.size):
+            ftp = connectftp(ftpserver, username, password, passive)
+            if path:
+                ftp.cwd(path)
+            self.sessions.put(ftp)
+
+    def url(self, ficftp):
+        return "ftp://" + self.server + os.path.normpath("/" + self.path + "/" + ficftp)
+
+    def open(self, ficftp, offset=0):
+        '''
+        Return a FTPReader on the ftp file ficftp, from offset, using a free session
+        The session is given back to the pool when the reader is closed
+        '''
+        ftp = self.sessions.get()
+        try:
+            return FTPReader(ftp, ficftp, self.sessions.put, offset)
+        except:
+            self.sessions.put(ftp)
+            raise
+
+    def run(self, function, *args):
+        '''
+        Call function with a free session followed by args
+        '''
+        ftp = self.sessions.get()
+        try:
+            return function(ftp, *args)
+        finally:
+            self.sessions.put(ftp)
+
+    def close(self):
+        for index in range(self.size):
+            closeftp(self.sessions.get())
+
+def _uploadFileftp(ftp, path, ficftp, blocksize, journal, name, counter):
+    '''
+    Upload of the file path whose offset is recorded in journal
+    An upload of the same file interrupted before continues at the size of the ftp file
+    '''
+    size = os.path.getsize(path)
+    state = {"size": size, "mtime": os.stat(path).st_mtime_ns}
+    offset = 0
+    if journal.resumable(name, state):
+        offset = min(sizeftp(ftp, ficftp) or 0, size)
+    else:
+        journal.start(name, state, offset=0)
+    position = [offset]
+
+    def progress(block):
+        position[0] += len(block)
+        counter(len(block))
+        journal.set(name, "offset", position[0], force=False)
+
+    with open(path, "rb") as f:
+        f.seek(offset)
+        # REST then STOR writes at offset in the ftp file
+        ftp.storbinary("STOR " + ficftp, f, blocksize, progress, rest=offset or None)
+    journal.finish(name)
+
+class _StreamReader:
+    # Stream read by storbinary, recording the error raised by its read()
+    def __init__(self, stream):
+        self.stream = stream
+        self.error = None
+
+    def read(self, size):
+        try:
+            return self.stream.read(size)
+        except BaseException as e:
+            self.error = e
+            raise
+
+def _uploadStreamftp(ftp, stream, ficftp, blocksize, counter):
+    '''
+    Upload of a stream, the ftp file is deleted if the stream fails, the server
+    would otherwise keep a truncated file when the data connection is closed
+    '''
+    reader = _StreamReader(stream)
+    try:
+        ftp.storbinary("STOR " + ficftp, reader, blocksize, lambda block: counter(len(block)))
+    except BaseException:
+        if reader.error is not None:
+            try:
+                # Reply to the STOR, left unread by storbinary
+                ftp.voidresp()
+            except (ftplib.Error, OSError, EOFError):
+                pass
+            try:
+                ftp.delete(ficftp)
+            except (ftplib.Error, OSError, EOFError):
+                pass
+        raise
+
+def _downloadFileftp(pool, path, ficftp, blocksize, segment_size, journal, counter):
+    '''
+    Download of the ftp file ficftp in segments, by several sessions for big files
+    The offset reached in each segment is recorded in journal when given
+    '''
+    size = pool.run(sizeftp, ficftp)
+    if size is None:
+        raise ftplib.error_perm("550 " + ficftp + " does not exist")
+    name = "download " + pool.url(ficftp)
+    state = {"size": size}
+    entry = None
+    if journal and os.path.exists(path) and os.path.getsize(path) == size:
+        entry = journal.resumable(name, state)
+    if entry is None:
+        with open(path, "wb") as f:
+            f.truncate(size)
+        entry = journal.start(name, state, segments={}) if journal else {"segments": {}}
+    if pool.size == 1:
+        segment_size = max(size, 1)
+    segments = [(offset, min(segment_size, size - offset)) for offset in range(0, size, segment_size)]
+
+    def downloadSegment(offset, length):
+        done = [entry["segments"].get(str(offset), 0)]
+
+        def progress(block):
+            done[0] += len(block)
+            counter(len(block))
+            if journal:
+                journal.set_item(name, "segments", str(offset), done[0], force=False)
+
+        if done[0] < length:
+            pool.run(downloadftpRange, ficftp, path, offset + done[0], length - done[0], blocksize, progress)
+        if journal:
+            journal.set_item(name, "segments", str(offset), length)
+
+    with ThreadPoolExecutor(max(1, min(pool.size, len(segments)))) as segment_pool:
+        futures = [segment_pool.submit(downloadSegment, offset, length) for offset, length in segments]
+        for future in futures:
+            future.result()
+    if journal:
+        journal.finish(name)
+
+def _transferftp(pool, source, ficftp, upload, blocksize, segment_size, journal, limiter, VERBOSE):
+    counter = _TransferCounter(limiter)
+    start = time.monotonic()
+    if not upload:
+        os.makedirs(os.path.dirname(source) or ".", exist_ok=True)
+        _downloadFileftp(pool, source, ficftp, blocksize, segment_size, journal, counter)
+    elif callable(source):
+        # Stream, for example a pipeline.ArtifactStream, created when its transfer starts
+        stream = source()
+        try:
+            pool.run(_uploadStreamftp, stream, ficftp, blocksize, counter)
+        finally:
+            stream.close()
+    elif journal:
+        pool.run(_uploadFileftp, source, ficftp, blocksize, journal, "upload " + pool.url(ficftp), counter)
+    else:
+        with open(source, "rb") as f:
+            pool.run(lambda ftp: ftp.storbinary("STOR " + ficftp, f, blocksize, lambda block: counter(len(block))))
+    elapsed = time.monotonic() - start
+    stats = {"key": ficftp, "bytes": counter.bytes, "seconds": elapsed, "mbps": counter.bytes / 1048576 / max(elapsed, 1e-6)}
+    if VERBOSE >= 1:
+        print(("Upload of " if upload else "Download of ") + ficftp + " : %.1f MB in %.1f s, %.1f MB/s" % (counter.bytes / 1048576, elapsed, stats["mbps"]))
+    return stats
+
+def _transferFilesftp(pool, transfers, upload, blocksize, segment_size, journal, limiter, VERBOSE):
+    start = time.monotonic()
+    with ThreadPoolExecutor(pool.size) as executor:
+        futures = [executor.submit(_transferftp, pool, source, ficftp, upload, blocksize, segment_size, journal, limiter, VERBOSE) for source, ficftp in transfers]
+        stats = [future.result() for future in futures]
+    elapsed = time.monotonic() - start
+    total = sum(stat["bytes"] for stat in stats)
+    if VERBOSE >= 1 and len(stats) > 1:
+        print("Total : %d files, %.1f MB in %.1f s, %.1f MB/s" % (len(stats), total / 1048576, elapsed, total / 1048576 / max(elapsed, 1e-6)))
+    return stats
+
+def uploadFilesftp(pool, transfers, blocksize=FTP_BLOCK_SIZE, VERBOSE=0, journal=None, limiter=None):
+    '''
+    Upload several files at the same time over the sessions of pool
+        - pool: FTPPool
+        - transfers: list of (source, FTP path). source is either a local path or a
+          function returning a readable stream which has a close() method
+        - journal: optional, journal.TransferJournal recording the offset reached
+          by the upload of local files so that they can be resumed
+        - limiter: optional, pipeline.RateLimiter shared by the transfers
+    Return a list of dict with the FTP path, the bytes transferred, the duration and the MB/s of each file
+    '''
+    return _transferFilesftp(pool, transfers, True, blocksize, None, journal, limiter, VERBOSE)
+
+def downloadFilesftp(pool, transfers, blocksize=FTP_BLOCK_SIZE, segment_size=64 * 1024 * 1024, VERBOSE=0, journal=None, limiter=None):
+    '''
+    Download several files at the same time over the sessions of pool
+        - transfers: list of (local path, FTP path)
+        - segment_size: files bigger than segment_size are downloaded in segments
+          of this size, each one by a different session
+        - journal: optional, journal.TransferJournal recording the offset reached
+          in each segment so that the download can be resumed
+    '''
+    return _transferFilesftp(pool, transfers, False, blocksize, segment_size, journal, limiter, VERBOSE)
+
+def uploadChunksftp(pool, store, chunk_ids, ftpPath="chunks", blocksize=FTP_BLOCK_SIZE, VERBOSE=0, limiter=None):
+    transfers = [(store.chunk_path(chunk_id), ftpPath + "/" + chunk_id) for chunk_id in chunk_ids]
+    return uploadFilesftp(pool, transfers, blocksize, VERBOSE - 1, limiter=limiter)
+
+def downloadChunksftp(pool, store, chunk_ids, ftpPath="chunks", blocksize=FTP_BLOCK_SIZE, VERBOSE=0):
+    transfers = [(store.chunk_path(chunk_id), ftpPath + "/" + chunk_id) for chunk_id in chunk_ids]
+    return downloadFilesftp(pool, transfers, blocksize, VERBOSE=VERBOSE - 1)
+
+def deleteChunksftp(ftp, chunk_ids, ftpPath="chunks", VERBOSE=0):
+    for chunk_id in chunk_ids:
+        if VERBOSE == 2:
+            print("Delete chunk " + chunk_id)
+        try:
+            ftp.delete(ftpPath + "/" + chunk_id)
+        except ftplib.error_perm:
+            # Chunk never copied to the FTP server
+            pass
+
+def deleteFolderftp(ftp, ftpPath, VERBOSE=0):
+    '''
+    Delete the files of the ftp folder ftpPath, then the folder
+    An empty folder is deleted without being listed, an empty listing fails with some FTPS servers
+    '''
+    try:
+        ftp.rmd(ftpPath)
+    except ftplib.error_perm:
+        pass
+    else:
+        if VERBOSE == 2:
+            print("Delete folder " + ftpPath)
+        return
+    for file in ftp.nlst(ftpPath):
+        if VERBOSE == 2:
+            print("Delete file " + file)
+        # Some servers list the names only, others the paths
+        ftp.delete(file if "/" in file else ftpPath + "/" + file)
+    if VERBOSE == 2:
+        print("Delete folder " + ftpPath)
+    ftp.rmd(ftpPath)
 
 def closeftp(ftp):
     """Close FTP connection
@@ -0,0 +1,113 @@
+import asyncio
+import functools
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+'''
+Asyncio engine of the transfers with BACKUP_DEST
+
+boto3 and ftplib are blocking : each operation (rotation of the slots, upload
+of a list of files, download or decryption of a file) runs in a thread of the
+engine, while an event loop running in a thread of its own starts it as soon
+as the operations it depends on are done. The operations which do not depend
+on each other overlap :
+
+- backup-wp.py : the rotation of the old slots with the upload of the new
+  chunks and files, on S3 once the previous DAYJ is moved away, and on FTP the
+  deletion of the expired slot with the uploads to DAYJ
+- restore-wp.py : the decryption of each file with the download of the others
+
+The operations are submitted to a group (for example "network" or "cpu")
+limiting how many of them run at the same time. Each operation keeps the
+concurrency of its own transfers (S3_FILES_IN_FLIGHT, FTP_SESSIONS...)
+'''
+
+# Operations of a backup running at the same time : rotation, chunks, files and manifest
+OPERATIONS = 4
+# Files decrypted at the same time by restore-wp.py
+DECRYPTIONS = 2
+
+
+class TransferError(Exception):
+    '''
+    Error of the operation name, error is the exception it raised
+    '''
+    def __init__(self, name, error):
+        super().__init__(name + " : " + str(error))
+        self.name = name
+        self.error = error
+
+
+class TransferEngine:
+    '''
+    Event loop running blocking operations in threads, in the order given by their dependencies
+        - limits: {group: number of operations of the group running at the same time}
+    '''
+    def __init__(self, limits):
+        self.limits = limits
+        self.semaphores = {}
+        self.operations = {}
+        self.executor = ThreadPoolExecutor(sum(limits.values()))
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, daemon=True)
+        self.thread.start()
+
+    async def _run(self, name, group, function, args, after):
+        for dependency in after:
+            try:
+                await asyncio.wrap_future(self.operations[dependency])
+            except Exception:
+                raise TransferError(name, "not started, " + dependency + " failed")
+        # Created in the thread of the loop
+        if group not in self.semaphores:
+            self.semaphores[group] = asyncio.Semaphore(self.limits[group])
+        async with self.semaphores[group]:
+            try:
+                return await self.loop.run_in_executor(self.executor, functools.partial(function, *args))
+            except Exception as e:
+                raise TransferError(name, e)
+
+    def submit(self, name, group, function, *args, after=()):
+        '''
+        Run function(*args) in group once the operations named in after are done, return a concurrent.futures.Future
+        An operation whose dependency failed fails without being started
+        '''
+        if name in self.operations:
+            raise ValueError("Operation " + name + " already submitted")
+        for dependency in after:
+            if dependency not in self.operations:
+                raise ValueError("Operation " + dependency + " not submitted")
+        future = asyncio.run_coroutine_threadsafe(self._run(name, group, function, args, after), self.loop)
+        self.operations[name] = future
+        return future
+
+    def wait(self, names=None):
+        '''
+        Wait for the operations names, all the operations submitted by default, and return their results
+        The first error, in the order of submission, is raised as a TransferError
+        '''
+        names = list(self.operations) if names is None else names
+        error = None
+        results = {}
+        for name in names:
+            try:
+                results[name] = self.operations[name].result()
+            except TransferError as e:
+                error = error or e
+        if error:
+            raise error
+        return results
+
+    def close(self):
+        '''
+        Stop the loop once the operations submitted are done
+        '''
+        for future in self.operations.values():
+            try:
+                future.result()
+            except TransferError:
+                pass
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+        self.loop.close()
+        self.executor.shutdown()
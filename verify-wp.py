@@ -0,0 +1,390 @@
+#!/usr/bin/python3
+
+###########################################################
+#
+# This python script is used to verify the backups of the Wordpress website
+# without restoring them. It checks the copies of each backup in :
+# - the local backup folders
+# and in BACKUP_DEST :
+# - AWS S3
+# or
+# - FTP server
+# against the checksums recorded by backup-wp.py when the backup was written
+#
+# Written by : Imane AMIRAT
+# Created date: Sept 30, 2021
+# Last modified: Oct 22, 2021
+# Tested with : Python 3.8
+# Script Revision: 0.9
+#
+##########################################################
+
+# Import required python libraries
+
+import io
+import os
+import time
+import random
+import configparser
+import json
+import boto3
+import ftplib
+import tools
+import argparse
+import encrypt
+import compress
+import dedup
+import checksums
+from concurrent.futures import ThreadPoolExecutor
+from botocore.config import Config
+
+
+# By Default, this script will read configuration from file /etc/backup-wp.conf
+'''
+1) Read the metadata and the checksums of each backup of BACKUP_RETENTION, or of the days given
+2) Check each .bin file of the backup, in the local folder and on BACKUP_DEST : its size,
+   and the BLAKE2b of a sample of its blocks read with ranged reads, or of the whole file with --full
+3) Check the chunks used by the deduplicated backups : the size of each one, and the content of
+   a sample of them, decrypted and hashed again with the key
+4) Print the result of each copy, send it by mail with --mail, and exit with 1 if an error was found
+'''
+# create parser
+parser = argparse.ArgumentParser()
+
+# add arguments to the parser
+parser.add_argument("-d","--day",type=int,action='append',help="index of day in the past to be verified, from 0 to BACKUP_RETENTION - 1. Can be repeated, all the days by default")
+parser.add_argument("-l","--local",action='store_true',help="Verify the local backup folders only")
+parser.add_argument("-r","--remote",action='store_true',help="Verify the copies on BACKUP_DEST only")
+parser.add_argument("--full",action='store_true',help="Read the whole files and all the chunks instead of a sample")
+parser.add_argument("--samples",type=int,default=4,help="Number of blocks of 4 MB read in each file, 4 by default")
+parser.add_argument("--chunk-samples",type=int,default=32,help="Number of chunks of deduplicated backups decrypted, 32 by default")
+parser.add_argument("--mail",action='store_true',help="Send the result by mail")
+parser.add_argument("-v","--verbose",type=int,default=0,choices=[0,1,2],help="0 disable verbose, 1 minimal verbose, 2 debug mode")
+parser.add_argument("-f","--config",default="/etc/backup-wp.conf",help="Configuration file, /etc/backup-wp.conf by default")
+
+# parse the arguments
+args = parser.parse_args()
+
+CONFIG_FILE = args.config
+
+config = configparser.ConfigParser()
+config.read(CONFIG_FILE)
+
+SMTP_HOST = config.get('SMTP','SMTP_HOST')
+SMTP_FROM = config.get('SMTP','SMTP_FROM')
+SMTP_TO = config.get('SMTP','SMTP_TO')
+
+BACKUP_DEST = config.get('BACKUP','BACKUP_DEST')
+BACKUP_PATH = config.get('BACKUP','LOCALBKPATH')
+BACKUP_RETENTION = config.get('BACKUP','BACKUP_RETENTION')
+CHUNK_STORE = config.get('BACKUP','CHUNK_STORE',fallback=BACKUP_PATH + "/chunks")
+
+ENCRYPTION_KEYPATH = config.get('ENCRYPT','KEYPATH')
+
+VERBOSE = args.verbose
+SAMPLES = None if args.full else args.samples
+
+if args.local and args.remote:
+    print("--local and --remote can not be used together. Exiting")
+    exit(1)
+
+if BACKUP_DEST == 'S3':
+    S3_BUCKET = config.get('BACKUP','S3_BUCKET')
+    S3_ACCESS_KEY = config.get('BACKUP','S3_ACCESS_KEY')
+    S3_SECRET_ACCESS_KEY = config.get('BACKUP','S3_SECRET_ACCESS_KEY')
+    S3_DEFAULT_REGION = config.get('BACKUP','S3_DEFAULT_REGION')
+    S3_ENDPOINT_URL = config.get('BACKUP','S3_ENDPOINT_URL',fallback=None)
+    S3_LAYOUT = config.get('BACKUP','S3_LAYOUT',fallback='slots')
+    S3_MAX_CONCURRENCY = config.getint('BACKUP','S3_MAX_CONCURRENCY',fallback=10)
+    CHUNK_S3_BUCKET = config.get('BACKUP','CHUNK_S3_BUCKET',fallback=S3_BUCKET)
+    WORKERS = S3_MAX_CONCURRENCY
+elif BACKUP_DEST == 'FTP':
+    FTP_SERVER = config.get('BACKUP','FTP_SERVER')
+    FTP_USER = config.get('BACKUP','FTP_USER')
+    FTP_PASSWD = config.get('BACKUP','FTP_PASSWD')
+    FTP_PATH = config.get('BACKUP','FTP_PATH')
+    FTP_SESSIONS = config.getint('BACKUP','FTP_SESSIONS',fallback=4)
+    FTP_BLOCK_SIZE = config.getint('BACKUP','FTP_BLOCK_SIZE',fallback=256) * 1024
+    CHUNK_FTP_PATH = config.get('BACKUP','CHUNK_FTP_PATH',fallback=dedup.REMOTE_FOLDER)
+    WORKERS = FTP_SESSIONS
+elif BACKUP_DEST == 'LOCAL':
+    WORKERS = 4
+else:
+    print("Bad value in " + CONFIG_FILE + ". Value of BACKUP_DEST should be S3, FTP or LOCAL only. Exiting")
+    exit(1)
+
+if args.remote and BACKUP_DEST == 'LOCAL':
+    print("BACKUP_DEST is LOCAL, there is no copy to verify with --remote. Exiting")
+    exit(1)
+
+fdKey = open(ENCRYPTION_KEYPATH,'rb')
+ENCRYPTION_KEY = fdKey.read()
+
+MetadataFilename = "backup.json.bin"
+SLOTS = ["DAYJ"] + ["DAYJ-" + str(index) for index in range(1,int(BACKUP_RETENTION))]
+DAYS = sorted(set(args.day)) if args.day else range(len(SLOTS))
+for day in DAYS:
+    if day < 0 or day >= len(SLOTS):
+        print("Bad value of --day " + str(day) + ", it should be from 0 to " + str(len(SLOTS) - 1) + ". Exiting")
+        exit(1)
+
+class LocalCopy:
+    '''
+    Backups in the local folders
+    '''
+    name = "local"
+
+    def __init__(self):
+        self.paths = [BACKUP_PATH + "/" + slot for slot in SLOTS]
+
+    def sizes(self, day):
+        try:
+            return {name: os.path.getsize(self.paths[day] + "/" + name) for name in os.listdir(self.paths[day])}
+        except FileNotFoundError:
+            return {}
+
+    def read(self, day, name, offset=0, length=None):
+        with open(self.paths[day] + "/" + name,"rb") as f:
+            f.seek(offset)
+            return f.read(-1 if length is None else length)
+
+    def check_full(self, day, name, digest):
+        with open(self.paths[day] + "/" + name,"rb") as f:
+            return checksums.check_full(digest, f)
+
+    def chunk_sizes(self, chunk_ids):
+        store = dedup.ChunkStore(CHUNK_STORE,ENCRYPTION_KEY)
+        return {chunk_id: os.path.getsize(store.chunk_path(chunk_id)) for chunk_id in chunk_ids if store.has(chunk_id)}
+
+    def read_chunk(self, chunk_id):
+        with open(dedup.ChunkStore(CHUNK_STORE,ENCRYPTION_KEY).chunk_path(chunk_id),"rb") as f:
+            return f.read()
+
+    def close(self):
+        pass
+
+class S3Copy:
+    '''
+    Backups in S3_BUCKET, with the slots or dated layout
+    '''
+    name = "S3"
+
+    def __init__(self):
+        self.s3 = boto3.client(
+            's3',
+            endpoint_url=S3_ENDPOINT_URL,
+            aws_access_key_id=S3_ACCESS_KEY,
+            aws_secret_access_key=S3_SECRET_ACCESS_KEY,
+            config=Config(region_name=S3_DEFAULT_REGION,retries={'max_attempts': 10,'mode': 'standard'},max_pool_connections=max(10,WORKERS))
+        )
+        # Prefix of DAYJ, DAYJ-1..., read from the index with the dated layout
+        self.paths = tools.slotPathsS3(self.s3,S3_BUCKET,S3_LAYOUT,BACKUP_RETENTION)
+
+    def sizes(self, day):
+        if day >= len(self.paths):
+            return {}
+        return tools.listSizesS3(self.s3,S3_BUCKET,self.paths[day])
+
+    def read(self, day, name, offset=0, length=None):
+        key = self.paths[day] + "/" + name
+        if length is None:
+            return self.s3.get_object(Bucket=S3_BUCKET,Key=key)["Body"].read()
+        return tools.readRangeS3(self.s3,S3_BUCKET,key,offset,length)
+
+    def check_full(self, day, name, digest):
+        return checksums.check_full(digest, self.s3.get_object(Bucket=S3_BUCKET,Key=self.paths[day] + "/" + name)["Body"])
+
+    def chunk_sizes(self, chunk_ids):
+        return tools.listSizesS3(self.s3,CHUNK_S3_BUCKET,dedup.REMOTE_FOLDER)
+
+    def read_chunk(self, chunk_id):
+        return self.s3.get_object(Bucket=CHUNK_S3_BUCKET,Key=dedup.REMOTE_FOLDER + "/" + chunk_id)["Body"].read()
+
+    def close(self):
+        pass
+
+class FTPCopy:
+    '''
+    Backups in FTP_PATH, read with FTP_SESSIONS sessions
+    '''
+    name = "FTP"
+
+    def __init__(self):
+        self.pool = tools.FTPPool(FTP_SERVER,FTP_USER,FTP_PASSWD,WORKERS,FTP_PATH)
+        self.paths = SLOTS
+
+    def sizes(self, day):
+        try:
+            return self.pool.run(tools.listSizesftp,self.paths[day])
+        except ftplib.error_perm:
+            # No backup in this folder
+            return {}
+
+    def read(self, day, name, offset=0, length=None):
+        if length is None:
+            data = io.BytesIO()
+            self.pool.run(lambda ftp: ftp.retrbinary("RETR " + self.paths[day] + "/" + name,data.write,FTP_BLOCK_SIZE))
+            return data.getvalue()
+        return self.pool.run(tools.readftpRange,self.paths[day] + "/" + name,offset,length,FTP_BLOCK_SIZE)
+
+    def check_full(self, day, name, digest):
+        reader = self.pool.open(self.paths[day] + "/" + name)
+        try:
+            return checksums.check_full(digest, reader)
+        finally:
+            reader.close()
+
+    def chunk_sizes(self, chunk_ids):
+        try:
+            return self.pool.run(tools.listSizesftp,CHUNK_FTP_PATH)
+        except ftplib.error_perm:
+            return {}
+
+    def read_chunk(self, chunk_id):
+        data = io.BytesIO()
+        self.pool.run(lambda ftp: ftp.retrbinary("RETR " + CHUNK_FTP_PATH + "/" + chunk_id,data.write,FTP_BLOCK_SIZE))
+        return data.getvalue()
+
+    def close(self):
+        self.pool.close()
+
+COPIES = []
+try:
+    if not args.remote:
+        COPIES.append(LocalCopy())
+    if not args.local and BACKUP_DEST == 'S3':
+        COPIES.append(S3Copy())
+    elif not args.local and BACKUP_DEST == 'FTP':
+        COPIES.append(FTPCopy())
+except Exception as e:
+    print("Error during connection to " + BACKUP_DEST + " : " + str(e) + ". Exiting")
+    exit(1)
+
+# Part 1 and 2 : Check the files of each backup
+
+START = time.monotonic()
+BYTES_READ = 0
+ERRORS = 0
+LINES = []
+# Size and codec of each chunk used by the deduplicated backups verified
+CHUNKS = {}
+
+def output(line):
+    LINES.append(line)
+    print(line)
+
+def checkFile(copy, day, name, digest, sizes):
+    '''
+    Return the errors found in the copy of the file name, and the number of bytes read
+    An error during the read of the file is an error of this file, the other files are checked
+    '''
+    if name not in sizes:
+        return ["missing"], 0
+    read = []
+    def readRange(offset, length):
+        data = copy.read(day, name, offset, length)
+        read.append(len(data))
+        return data
+    try:
+        if SAMPLES is None:
+            return copy.check_full(day, name, digest), sizes[name]
+        return checksums.check_copy(digest, sizes[name], readRange, SAMPLES), sum(read)
+    except Exception as e:
+        return ["error during read, " + str(e)], sum(read)
+
+for copy in COPIES:
+    for day in DAYS:
+        slot = SLOTS[day]
+        head = slot.ljust(8) + copy.name.ljust(7)
+        try:
+            sizes = copy.sizes(day)
+            if MetadataFilename not in sizes:
+                output(head + "no backup")
+                continue
+            metadata = json.loads(encrypt.DecryptReader(io.BytesIO(copy.read(day,MetadataFilename)),ENCRYPTION_KEY).read())
+            head += metadata.get("date","").ljust(10)
+            if "checksums" not in metadata:
+                # Backups made by previous versions
+                output(head + "no checksums")
+                continue
+            name = metadata["checksums"] + ".bin"
+            if name not in sizes:
+                output(head + "failed : " + name + " missing")
+                ERRORS += 1
+                continue
+            # The GCM tags of the checksums file are checked when it is decrypted
+            backup_checksums = json.loads(encrypt.DecryptReader(io.BytesIO(copy.read(day,name)),ENCRYPTION_KEY).read())
+        except Exception as e:
+            output(head + "failed : error during read of the metadata, " + str(e))
+            ERRORS += 1
+            continue
+        for chunk_id, size in backup_checksums.get("chunks",{}).items():
+            CHUNKS[chunk_id] = (size, metadata["codec"])
+        # Files streamed with --no-local are only on BACKUP_DEST
+        files = {name: digest for name, digest in backup_checksums["files"].items() if digest["local"] or not isinstance(copy, LocalCopy)}
+        if VERBOSE == 2:
+            print("Checking " + str(len(files)) + " files of " + slot + " on " + copy.name)
+        with ThreadPoolExecutor(WORKERS) as executor:
+            results = list(executor.map(lambda item: (item[0],) + checkFile(copy, day, item[0], item[1], sizes), files.items()))
+        failures = []
+        for name, errors, read in results:
+            BYTES_READ += read
+            failures.extend(name + " : " + error for error in errors)
+        size = sum(digest["size"] for digest in files.values())
+        output(head + (str(len(files)) + " files").rjust(10) + (str(round(size / 1048576,1)) + " MB").rjust(12) + "  " + ("failed" if failures else "ok"))
+        for failure in failures:
+            output("    " + failure)
+        ERRORS += len(failures)
+
+# Part 3 : Check the chunks of the deduplicated backups
+
+if CHUNKS:
+    for copy in COPIES:
+        head = "chunks".ljust(8) + copy.name.ljust(7)
+        try:
+            sizes = copy.chunk_sizes(CHUNKS)
+        except Exception as e:
+            output(head + "failed : error during list of the chunks, " + str(e))
+            ERRORS += 1
+            continue
+        failures = [chunk_id + " : " + ("missing" if chunk_id not in sizes else "size " + str(sizes[chunk_id]) + " instead of " + str(size))
+                    for chunk_id, (size, codec) in CHUNKS.items() if sizes.get(chunk_id) != size]
+        # The id of a chunk is the keyed BLAKE2b of its content, a sample is decrypted and hashed again
+        present = [chunk_id for chunk_id in CHUNKS if chunk_id in sizes]
+        sample = present if args.full else random.sample(present, min(len(present), args.chunk_samples))
+        store = dedup.ChunkStore(CHUNK_STORE,ENCRYPTION_KEY)
+        def checkChunk(chunk_id):
+            try:
+                data = copy.read_chunk(chunk_id)
+            except Exception as e:
+                return 0, "error during read, " + str(e)
+            try:
+                content = compress.open_reader(CHUNKS[chunk_id][1],encrypt.DecryptReader(io.BytesIO(data),ENCRYPTION_KEY)).read()
+            except Exception as e:
+                return len(data), "content can not be decrypted, " + str(e)
+            return len(data), None if store.chunk_id(content) == chunk_id else "content differs from its id"
+        with ThreadPoolExecutor(WORKERS) as executor:
+            for chunk_id, (read, error) in zip(sample, executor.map(checkChunk, sample)):
+                BYTES_READ += read
+                if error:
+                    failures.append(chunk_id + " : " + error)
+        output(head + "".ljust(10) + (str(len(CHUNKS)) + " chunks").rjust(10) + (str(len(sample)) + " read").rjust(12) + "  " + ("failed" if failures else "ok"))
+        for failure in failures:
+            output("    " + failure)
+        ERRORS += len(failures)
+
+for copy in COPIES:
+    copy.close()
+
+# Part 4 : Result
+
+ELAPSED = time.monotonic() - START
+output("")
+output(("Verification failed, " + str(ERRORS) + " errors" if ERRORS else "Verification completed, no error") +
+       " : " + str(round(BYTES_READ / 1048576,1)) + " MB read in " + str(round(ELAPSED,1)) + " s")
+
+if args.mail:
+    MESSAGE = "\n".join(LINES)
+    tools.sendmail(mailfrom=SMTP_FROM,mailto=SMTP_TO,message=MESSAGE,subject="Verification of the backups of Wordpress" + (" failed" if ERRORS else ""), smtphost=SMTP_HOST)
+if ERRORS:
+    exit(1)